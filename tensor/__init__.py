@@ -6,6 +6,6 @@
 
 from tensor import service
 
-def makeService(config):
+def makeService(config, configFile=None, overrides=None):
     # Create TensorService
-    return service.TensorService(config)
+    return service.TensorService(config, configFile, overrides)
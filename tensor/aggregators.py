@@ -1,3 +1,24 @@
+import math
+
+from array import array
+
+# numpy is slow to import, so it is only loaded for the first batch big
+# enough to use it. False until then, and None if it isn't installed.
+numpy = False
+
+def _getNumpy():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as _numpy
+            numpy = _numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+# Smallest batch worth handing to numpy
+NUMPY_MIN = 64
+
 def Counter32(a, b, delta):
     """32bit counter aggregator with wrapping
     """
@@ -20,6 +41,244 @@ def Counter(a, b, delta):
     """Counter derivative
     """
     if b < a:
-        return None 
+        return None
 
     return (b - a) / float(delta)
+
+def _toArray(values):
+    """Converts a sequence of counter values to a numpy array without
+    losing precision, or returns None if that isn't possible"""
+    try:
+        return numpy.frombuffer(array('q', values), dtype=numpy.int64)
+    except OverflowError:
+        try:
+            return numpy.frombuffer(array('Q', values), dtype=numpy.uint64)
+        except (OverflowError, TypeError, ValueError):
+            return None
+    except TypeError:
+        # Not all integers, so only allow plain floats
+        if set(map(type, values)) == set([float]):
+            return numpy.frombuffer(array('d', values), dtype=numpy.float64)
+        return None
+
+def _numpyCounter(a, b, delta, wrap):
+    """Computes counter derivatives with numpy, or returns None if the
+    values can't be handled exactly (mixed types, negatives or values
+    outside the counter range)"""
+    a = _toArray(a)
+    b = _toArray(b)
+
+    if (a is None) or (b is None):
+        return None
+
+    kinds = a.dtype.kind + b.dtype.kind
+
+    if kinds in ('ii', 'iu', 'ui', 'uu'):
+        limit = wrap if wrap is not None else 9223372036854775807
+        if (a.min() < 0) or (b.min() < 0) or (a.max() > limit) or (
+                b.max() > limit):
+            return None
+        dtype = numpy.uint64
+    elif kinds == 'ff':
+        dtype = numpy.float64
+    else:
+        return None
+
+    a = a.astype(dtype)
+    b = b.astype(dtype)
+    delta = numpy.asarray(delta, dtype=numpy.float64)
+
+    wrapped = b < a
+
+    # Unsigned subtraction wraps harmlessly in the branch we discard
+    with numpy.errstate(over='ignore', invalid='ignore'):
+        if wrap is None:
+            diff = b - a
+        else:
+            diff = numpy.where(wrapped, (dtype(wrap) - a) + b, b - a)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = (diff.astype(numpy.float64) / delta).tolist()
+
+    drop = delta <= 0
+    if wrap is None:
+        # Counter suppresses negative deltas
+        drop |= wrapped
+
+    for i in numpy.flatnonzero(drop):
+        result[i] = None
+
+    return result
+
+def _counterBatch(fn, wrap, a, b, delta):
+    if (len(a) >= NUMPY_MIN) and (_getNumpy() is not None):
+        result = _numpyCounter(a, b, delta, wrap)
+        if result is not None:
+            return result
+
+    return [
+        fn(x, y, d) if d > 0 else None for x, y, d in zip(a, b, delta)
+    ]
+
+def Counter32Batch(a, b, delta):
+    """Batch form of :func:`Counter32` taking sequences of previous values,
+    current values and time deltas. Returns a list of derivatives, with
+    None where the time delta is not positive.
+    """
+    return _counterBatch(Counter32, 4294967295, a, b, delta)
+
+def Counter64Batch(a, b, delta):
+    """Batch form of :func:`Counter64`
+    """
+    return _counterBatch(Counter64, 18446744073709551615, a, b, delta)
+
+def CounterBatch(a, b, delta):
+    """Batch form of :func:`Counter`, with None for negative deltas
+    """
+    return _counterBatch(Counter, None, a, b, delta)
+
+# Aggregators which can be evaluated over a whole batch at once
+batchAggregators = {
+    Counter32: Counter32Batch,
+    Counter64: Counter64Batch,
+    Counter: CounterBatch,
+}
+
+class DDSketch(object):
+    """Mergeable quantile sketch with bounded relative error
+
+    Values are counted in logarithmically sized bins, so any quantile is
+    returned to within `accuracy` of the true value however many values
+    are added. Memory is bounded by `maxBins`, past which the bins nearest
+    zero are merged together.
+
+    :param accuracy: Relative accuracy of quantiles (default 0.01)
+    :type accuracy: float.
+    :param maxBins: Maximum number of bins for each sign (default 2048)
+    :type maxBins: int.
+    """
+    # Values closer to zero than this are counted as zero
+    minValue = 1e-9
+
+    def __init__(self, accuracy=0.01, maxBins=2048):
+        if not (0 < accuracy < 1):
+            raise ValueError("accuracy must be between 0 and 1")
+
+        self.accuracy = accuracy
+        self.maxBins = maxBins
+
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.logGamma = math.log(self.gamma)
+
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) / self.logGamma))
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def _collapse(self, bins):
+        keys = sorted(bins)
+        extra = len(keys) - self.maxBins + 1
+        bins[keys[extra]] += sum(bins.pop(k) for k in keys[:extra])
+
+    def add(self, value, count=1):
+        """Adds `value` to the sketch `count` times"""
+        if value > self.minValue:
+            bins = self.positive
+            key = self._key(value)
+        elif value < -self.minValue:
+            bins = self.negative
+            key = self._key(-value)
+        else:
+            bins = None
+
+        if bins is None:
+            self.zero += count
+        else:
+            bins[key] = bins.get(key, 0) + count
+            if len(bins) > self.maxBins:
+                self._collapse(bins)
+
+        self.count += count
+        self.sum += value * count
+
+        if (self.min is None) or (value < self.min):
+            self.min = value
+        if (self.max is None) or (value > self.max):
+            self.max = value
+
+    def merge(self, other):
+        """Adds the values counted by another sketch with the same
+        accuracy"""
+        if other.gamma != self.gamma:
+            raise ValueError("Can't merge sketches of different accuracy")
+
+        if not other.count:
+            return
+
+        for bins, others in ((self.positive, other.positive),
+                             (self.negative, other.negative)):
+            for key, count in others.items():
+                bins[key] = bins.get(key, 0) + count
+            if len(bins) > self.maxBins:
+                self._collapse(bins)
+
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+
+        if (self.min is None) or (other.min < self.min):
+            self.min = other.min
+        if (self.max is None) or (other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """Returns the value at quantile `q` (0 to 1), or None if the sketch
+        is empty"""
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-self._value(key), self.min)
+
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(self._value(key), self.max)
+
+        return self.max
+
+# Quantiles reported by the Quantiles aggregation
+QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+def Quantiles(sketch):
+    """Quantile aggregation
+
+    Events with this aggregation are not sent themselves. Their metrics are
+    gathered into a :class:`DDSketch` for each series in the batch, which
+    is sent as `.p50`, `.p90`, `.p99` and `.max` events instead. Returns a
+    list of (suffix, value) for a sketch.
+    """
+    return [(name, sketch.quantile(q)) for name, q in QUANTILES] + [
+        ('max', sketch.max)]
+
+# Aggregators which summarise a batch of samples through a sketch
+sketchAggregators = set([Quantiles])
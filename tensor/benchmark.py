@@ -0,0 +1,396 @@
+"""Pipeline benchmark
+
+Drives a :class:`tensor.service.TensorService` with synthetic sources into
+stub outputs, or into a RiemannTCP output connected to a local fake Riemann
+server, and reports throughput, the latency added by the pipeline, peak
+RSS and the peak memory traced while processing, per event. Nothing leaves
+the host::
+
+    python -m tensor.benchmark --sources 20 --series 500 --duration 10
+    python -m tensor.benchmark --output riemann
+    python -m tensor.benchmark --save baseline.json
+    python -m tensor.benchmark --compare baseline.json
+
+With `--compare` the exit status is 1 if any result is worse than the
+baseline by more than `--tolerance` (default 10%).
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols.basic import Int32StringReceiver
+
+from tensor.aggregators import Counter64
+from tensor.ihateprotobuf import proto_pb2
+from tensor.objects import EventBatch, Output, Source
+from tensor.protocol.riemann import RiemannProtobufMixin
+from tensor.service import TensorService
+
+
+# Results and whether a higher value is better
+RESULTS = (
+    ('events_per_second', True),
+    ('p99_latency_ms', False),
+    ('peak_rss_mb', False),
+    ('peak_bytes_per_event', False),
+)
+
+
+class SyntheticSource(Source):
+    """Emits a batch of `series` events every tick, a `counters` fraction
+    of which are Counter64 series
+
+    :param series: Number of series
+    :type series: int.
+    :param counters: Fraction of series which are counters (default 0.2)
+    :type counters: float.
+    """
+    def __init__(self, *a):
+        Source.__init__(self, *a)
+
+        self.series = int(self.config.get('series', 100))
+        counters = int(self.series * float(self.config.get('counters', 0.2)))
+
+        self.prefixes = ['metric.%s' % i for i in range(self.series)]
+        self.aggregations = [Counter64] * counters + [None] * (
+            self.series - counters)
+        self.n = 0
+
+    def get(self):
+        self.n += 1
+        return EventBatch([
+            self.createEvent('ok', 'Synthetic', self.n * (i + 1),
+                prefix=prefix, aggregation=aggregation)
+            for i, (prefix, aggregation) in enumerate(
+                zip(self.prefixes, self.aggregations))
+        ])
+
+
+class StubOutput(Output):
+    """Counts events, optionally encoding them as Riemann messages as the
+    TCP output would"""
+    def __init__(self, *a):
+        Output.__init__(self, *a)
+        self.encode = self.config.get('encode', True)
+        self.encoder = RiemannProtobufMixin()
+        self.events = 0
+
+    def eventsReceived(self, events):
+        if self.encode:
+            self.encoder.encodeMessage(events)
+        self.events += len(events)
+
+
+class FakeRiemannProtocol(Int32StringReceiver):
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def stringReceived(self, string):
+        self.factory.events += len(proto_pb2.Msg.FromString(string).events)
+        self.sendString(self.factory.ok)
+
+
+class FakeRiemannServer(protocol.ServerFactory):
+    """Acknowledges every message like a Riemann server, counting the
+    events received"""
+    protocol = FakeRiemannProtocol
+
+    def __init__(self):
+        self.events = 0
+        self.ok = proto_pb2.Msg(ok=True).SerializeToString()
+
+
+def percentile(samples, q):
+    """Returns the `q` quantile of a list of (value, weight) samples"""
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+    total = sum(w for v, w in samples)
+    seen = 0
+
+    for value, weight in samples:
+        seen += weight
+        if seen >= q * total:
+            return value
+
+    return samples[-1][0]
+
+
+def peakRSS():
+    """Returns the peak resident set size of this process in MB"""
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes rather than kilobytes
+        rss /= 1024.0
+
+    return rss / 1024.0
+
+
+def makeConfig(options, outputs):
+    config = {
+        'ttl': 60.0,
+        'interval': 1.0,
+        'outputs': outputs,
+        'sources': [
+            {
+                'service': 'bench%s' % i,
+                'source': 'tensor.benchmark.SyntheticSource',
+                'hostname': 'bench.local',
+                'series': options.series,
+                'counters': options.counters,
+            }
+            for i in range(options.sources)
+        ],
+    }
+
+    if options.triggers:
+        for source in config['sources']:
+            source['critical'] = {r'.*\.metric\.1\d*$': '> 1000'}
+            source['warning'] = {r'.*\.metric\.2\d*$': '> 1000'}
+
+    return config
+
+
+def flush(service):
+    """Flushes the output buffers now rather than on the next reactor
+    iteration"""
+    if service.flushCall is not None:
+        service.flushCall.cancel()
+        service.flushOutputs()
+
+
+def runRounds(service, rounds=None, duration=None):
+    """Feeds each source's events through the pipeline and the outputs,
+    returning (events, seconds, latency samples)"""
+    events = 0
+    latencies = []
+    n = 0
+    start = time.time()
+
+    while True:
+        for source in service.sources:
+            batch = source.get()
+            t = time.time()
+            service.sendEvent(source, batch)
+            flush(service)
+            latencies.append((time.time() - t, len(batch)))
+            events += len(batch)
+
+        n += 1
+        if rounds is not None:
+            if n >= rounds:
+                break
+        elif time.time() - start >= duration:
+            break
+
+    return events, time.time() - start, latencies
+
+
+def peakBytesPerEvent(service, rounds=5):
+    """Returns the peak memory traced while processing events, above what
+    was traced before, divided by the number of events"""
+    if tracemalloc is None:
+        return None
+
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        events, elapsed, latencies = runRounds(service, rounds=rounds)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return (peak - base) / float(events)
+
+
+def benchmark(options):
+    """Runs the pipeline synchronously into stub outputs"""
+    config = makeConfig(options, [{
+        'output': 'tensor.benchmark.StubOutput',
+        'encode': options.output == 'encode',
+    }])
+    service = TensorService(config)
+    service.outputs = {None: [service.createOutput(config['outputs'][0])]}
+
+    # Warm up aggregation state and caches
+    runRounds(service, rounds=2)
+
+    events, elapsed, latencies = runRounds(service,
+        duration=options.duration)
+
+    service.scheduler.stop()
+
+    return {
+        'events_per_second': events / elapsed,
+        'p99_latency_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': peakRSS(),
+        'peak_bytes_per_event': peakBytesPerEvent(service),
+    }
+
+
+@defer.inlineCallbacks
+def benchmarkRiemann(options):
+    """Runs sources on the reactor into a RiemannTCP output connected to a
+    local fake Riemann server"""
+    server = FakeRiemannServer()
+    listener = reactor.listenTCP(0, server, interface='127.0.0.1')
+
+    service = TensorService(makeConfig(options, [{
+        'output': 'tensor.outputs.riemann.RiemannTCP',
+        'server': '127.0.0.1',
+        'port': listener.getHost().port,
+        'interval': 0.1,
+    }]))
+
+    yield service.startService()
+    # Drive the sources as fast as the reactor allows, rather than on
+    # their timers
+    service.scheduler.stop()
+
+    latencies = []
+
+    def pump():
+        for source in service.sources:
+            if source.paused:
+                # Held back by a full output queue
+                continue
+            batch = source.get()
+            t = time.time()
+            service.sendEvent(source, batch)
+            latencies.append((time.time() - t, len(batch)))
+
+    yield task.deferLater(reactor, 1, lambda: None)
+
+    received = server.events
+    start = time.time()
+    pumping = task.LoopingCall(pump)
+    pumping.start(0)
+
+    yield task.deferLater(reactor, options.duration, lambda: None)
+    pumping.stop()
+    elapsed = time.time() - start
+    received = server.events - received
+
+    yield service.stopService()
+    yield listener.stopListening()
+
+    defer.returnValue({
+        'events_per_second': received / elapsed,
+        'p99_latency_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': peakRSS(),
+        'peak_bytes_per_event': None,
+    })
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compares results with a baseline, returning a list of
+    (name, baseline, result, change, regressed) tuples"""
+    rows = []
+
+    for name, higherBetter in RESULTS:
+        old, new = baseline.get(name), results.get(name)
+        if not old or (new is None):
+            continue
+
+        change = (new - old) / float(old)
+        if higherBetter:
+            regressed = change < -tolerance
+        else:
+            regressed = change > tolerance
+
+        rows.append((name, old, new, change, regressed))
+
+    return rows
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog='python -m tensor.benchmark',
+        description="Benchmarks the Tensor event pipeline")
+    parser.add_argument('--sources', type=int, default=10)
+    parser.add_argument('--series', type=int, default=100,
+        help="Series per source")
+    parser.add_argument('--counters', type=float, default=0.2,
+        help="Fraction of series which are counters")
+    parser.add_argument('--triggers', action='store_true',
+        help="Add state triggers to each source")
+    parser.add_argument('--output', default='encode',
+        choices=['stub', 'encode', 'riemann'],
+        help="stub counts events, encode also encodes them as Riemann "
+             "messages, riemann sends them to a local fake Riemann server")
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--save', help="Write results to a JSON file")
+    parser.add_argument('--compare', help="Compare with a saved JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def report(options, results):
+    for name, higherBetter in RESULTS:
+        value = results.get(name)
+        print("%-24s %s" % (name, 'n/a' if value is None else
+            '%.3f' % value))
+
+    status = 0
+
+    if options.compare:
+        with open(options.compare, 'rt') as f:
+            baseline = json.load(f)
+
+        print()
+        for name, old, new, change, regressed in compare(results,
+                baseline.get('results', baseline), options.tolerance):
+            print("%-24s %10.3f -> %10.3f %+7.1f%%%s" % (name, old, new,
+                change * 100, '  REGRESSION' if regressed else ''))
+            if regressed:
+                status = 1
+
+    if options.save:
+        with open(options.save, 'wt') as f:
+            json.dump({'options': vars(options), 'results': results}, f,
+                indent=2, sort_keys=True)
+
+    return status
+
+
+def main(argv=None):
+    options = parseArgs(sys.argv[1:] if argv is None else argv)
+
+    if options.output == 'riemann':
+        result = {}
+
+        def done(results):
+            result['status'] = report(options, results)
+
+        def failed(failure):
+            failure.printTraceback()
+            result['status'] = 2
+
+        d = benchmarkRiemann(options).addCallbacks(done, failed)
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+
+        return result.get('status', 2)
+
+    return report(options, benchmark(options))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
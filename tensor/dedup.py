@@ -0,0 +1,83 @@
+"""Change-only events
+
+Sources or outputs with `dedup: true` only pass on a Riemann event when its
+metric or state differ from the last one sent for that series. Log events
+are always passed on. So that the
+series doesn't expire downstream, an unchanged event is still sent once
+`dedup_heartbeat` (default 0.5) of its TTL has passed since the last one.
+"""
+
+import time
+
+from tensor.utils import StateStore
+
+
+class Dedup(object):
+    """Suppresses events which are unchanged since the last one sent for
+    their series
+
+    :param heartbeat: Fraction of an event's TTL after which it is sent
+                      even if unchanged
+    :type heartbeat: float.
+    :param maxsize: Maximum number of series to remember
+    :type maxsize: int.
+    """
+    def __init__(self, heartbeat=0.5, maxsize=0):
+        if not (0 < heartbeat <= 1):
+            raise ValueError("dedup_heartbeat must be between 0 and 1")
+
+        self.heartbeat = heartbeat
+        self.store = StateStore(maxsize=maxsize)
+
+        self.seen = 0
+        self.suppressed = 0
+
+    @classmethod
+    def fromConfig(cls, config, maxsize=0):
+        """Returns a Dedup for a source or output configuration, or None
+        if it doesn't have `dedup` set"""
+        if not config.get('dedup', False):
+            return None
+
+        return cls(float(config.get('dedup_heartbeat', 0.5)), maxsize)
+
+    def apply(self, events, now=None):
+        """Returns the events from a `tensor.objects.EventBatch` which
+        should be sent"""
+        now = now or time.time()
+        store = self.store
+
+        keep = []
+        sids = events.sid
+        metrics = events.metric
+        states = events.state
+        ttls = events.ttl
+
+        for i, event in enumerate(events):
+            ttl = ttls[i]
+            if (event._type != 'riemann') or not ttl:
+                # Logs carry no metric or state to compare, and events
+                # without a TTL have nothing to keep alive downstream
+                keep.append(i)
+                continue
+
+            last = store.get(sids[i], now)
+            if last is not None:
+                metric, state, sent = last
+                if (metric == metrics[i]) and (state == states[i]) and (
+                        now - sent < ttl * self.heartbeat):
+                    continue
+
+            store.set(sids[i], (metrics[i], states[i], now), now, ttl)
+            keep.append(i)
+
+        self.seen += len(sids)
+        self.suppressed += len(sids) - len(keep)
+
+        if len(keep) == len(sids):
+            return events
+
+        return events.select(keep)
+
+    def expire(self, now=None):
+        self.store.expire(now)
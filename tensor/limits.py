@@ -0,0 +1,216 @@
+"""Sampling and rate limits
+
+The `limits` option is a list of policies applied to events as they are
+routed, so that an overloaded agent drops a predictable share of its
+events instead of whatever happens to overflow an output queue::
+
+    limits:
+        - route: riemann1
+          rate: 1000
+          burst: 5000
+        - source: nginx
+          prefix: nginx.client.
+          sample: 0.1
+
+A policy matches events by any combination of `route`, `source` (service
+name of the source) and `prefix` (of the event service), and applies
+either or both of:
+
+* `sample`, a fraction of series to keep. Series are chosen by a hash of
+  their id, so a sampled series is either sent completely or not at all.
+* `rate`, in events per second, from a token bucket holding up to `burst`
+  events (default one second's worth).
+
+Events in a state listed in `exempt` (by default anything other than
+`ok`) always pass. An event is only dropped by the policies which apply
+to it, and takes a token from their buckets only if all of them let it
+through. Policies without a `route` are applied once to each event before
+it is routed, however many routes it goes to. Limits apply within each
+process, so with worker processes each worker has its own buckets.
+"""
+
+import time
+import zlib
+
+
+# Matches any route, since None is the name of the default route
+ANY = object()
+
+
+class TokenBucket(object):
+    """Allows `rate` events per second on average, in bursts of up to
+    `burst`
+
+    :param rate: Events per second
+    :type rate: float.
+    :param burst: Bucket size (default `rate`)
+    :type burst: float.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = None
+
+    def available(self, now):
+        """Returns True if a token is available, without taking it"""
+        if self.last is not None:
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        return self.tokens >= 1
+
+    def take(self, now):
+        """Returns True and takes a token if one is available"""
+        if self.available(now):
+            self.tokens -= 1
+            return True
+
+        return False
+
+
+def sampleHash(sid):
+    """Maps a series id to a number between 0 and 1"""
+    return (zlib.crc32(sid.encode('utf-8')) & 0xffffffff) / 4294967296.0
+
+
+class Limit(object):
+    """A single sampling and rate limit policy
+
+    :param config: Policy configuration
+    :type config: dict.
+    :param name: Name used in metrics (default `name` from the config)
+    :type name: str.
+    """
+    def __init__(self, config, name=None):
+        self.name = str(config.get('name', name))
+
+        self.route = config.get('route', ANY)
+        self.source = config.get('source')
+        self.prefix = config.get('prefix')
+
+        self.sample = float(config.get('sample', 1.0))
+        if not (0 <= self.sample <= 1):
+            raise ValueError("sample must be between 0 and 1")
+
+        if config.get('rate'):
+            self.bucket = TokenBucket(config['rate'], config.get('burst'))
+        else:
+            self.bucket = None
+
+        self.exempt = config.get('exempt')
+        if self.exempt is not None:
+            self.exempt = set(self.exempt)
+
+        self.sampled = 0
+        self.limited = 0
+
+    def matches(self, route, source):
+        """Returns True if this policy applies to events from `source` on
+        `route`, where route policies only match their own route and
+        policies without one only match ANY"""
+        if route is ANY:
+            if self.route is not ANY:
+                return False
+        elif (self.route is ANY) or (self.route != route):
+            return False
+
+        return (self.source is None) or (self.source == source)
+
+    def isExempt(self, state):
+        if self.exempt is None:
+            return state not in ('ok', None)
+        return state in self.exempt
+
+    def applies(self, service, state):
+        """Returns True if this policy applies to an event at all"""
+        if self.prefix and not service.startswith(self.prefix):
+            return False
+
+        return not self.isExempt(state)
+
+    def passes(self, sid, now):
+        """Returns True if an event would pass this policy, counting it if
+        not. No token is taken."""
+        if (self.sample < 1) and (sampleHash(sid) >= self.sample):
+            self.sampled += 1
+            return False
+
+        if self.bucket and not self.bucket.available(now):
+            self.limited += 1
+            return False
+
+        return True
+
+
+class Limiter(object):
+    """Applies a list of :class:`Limit` policies to events being routed
+
+    :param configs: List of policy configurations
+    :type configs: list.
+    """
+
+    # Limit on cached (route, source) pairs
+    cacheSize = 10000
+
+    def __init__(self, configs):
+        self.limits = [Limit(c, name=i) for i, c in enumerate(configs)]
+        self.cache = {}
+
+    def match(self, route, source):
+        """Returns the policies which apply to events from `source` on
+        `route`"""
+        key = (route, source)
+        limits = self.cache.get(key)
+
+        if limits is None:
+            limits = [l for l in self.limits if l.matches(route, source)]
+
+            if len(self.cache) >= self.cacheSize:
+                self.cache.clear()
+            self.cache[key] = limits
+
+        return limits
+
+    def filter(self, limits, events, now):
+        """Returns the events from a `tensor.objects.EventBatch` which pass
+        all of `limits`, taking a token from each of their buckets"""
+        keep = []
+
+        for i, (sid, ev) in enumerate(zip(events.sid, events)):
+            active = [l for l in limits if l.applies(ev.service, ev.state)]
+
+            # Every policy is checked, so each counts what it would drop
+            if all([l.passes(sid, now) for l in active]):
+                for l in active:
+                    if l.bucket:
+                        l.bucket.take(now)
+                keep.append(i)
+
+        if len(keep) == len(events):
+            return events
+
+        return events.select(keep)
+
+    def apply(self, routes, source, events, now=None):
+        """Applies the policies for `source` to a
+        `tensor.objects.EventBatch` being sent to `routes`, returning a
+        list of (route, events) for the routes with events left"""
+        now = now or time.time()
+
+        limits = self.match(ANY, source)
+        if limits:
+            events = self.filter(limits, events, now)
+
+        result = []
+        for route in routes:
+            limited = events
+            limits = self.match(route, source)
+            if limits and events:
+                limited = self.filter(limits, events, now)
+
+            if limited:
+                result.append((route, limited))
+
+        return result
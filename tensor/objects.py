@@ -1,18 +1,34 @@
 import hashlib
 import re
 import time
-import socket
+
+from array import array
 
 try:
     from exceptions import NotImplementedError
 except ImportError:
     pass
 
-from twisted.internet import task, defer
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern as a builtin
+    pass
+
+from twisted.internet import task, defer, reactor
 from twisted.python import log
 
-from tensor.utils import fork
-from tensor.protocol import ssh
+from tensor.utils import fork, inPoolThread, RingBuffer, getFQDN
+from tensor import profiler
+
+
+def _intern(s):
+    """Interns plain strings so that repeated service, host and tag names
+    share a single object between events"""
+    if type(s) is str:
+        return intern(s)
+    return s
+
 
 class Event(object):
     """Tensor Event object
@@ -31,6 +47,9 @@ class Event(object):
     :param attributes: A dictionary of key/value attributes for this event
     :param evtime: Event timestamp override
     """
+    __slots__ = ('state', 'service', 'description', 'metric', 'ttl', 'tags',
+                 'attributes', 'aggregation', '_type', 'time', 'hostname')
+
     def __init__(
             self,
             state,
@@ -45,7 +64,7 @@ class Event(object):
             attributes=None,
             type='riemann'):
         self.state = state
-        self.service = service
+        self.service = _intern(service)
         self.description = description
         self.metric = metric
         self.ttl = ttl
@@ -59,9 +78,9 @@ class Event(object):
         else:
             self.time = time.time()
         if hostname:
-            self.hostname = hostname
+            self.hostname = _intern(hostname)
         else:
-            self.hostname = socket.gethostbyaddr(socket.gethostname())[0]
+            self.hostname = _intern(getFQDN())
 
     def id(self):
         return self.hostname + '.' + self.service
@@ -91,12 +110,148 @@ class Event(object):
             self.hostname, self.aggregation
         )
 
+class EventBatch(object):
+    """A batch of events passed through the queue
+
+    Behaves like a list of :class:`Event` objects, so existing outputs can
+    iterate over it as before, and also provides time, metric, state, ttl
+    and series id (`sid`) columns which are built from the events on first
+    use. Stages which work on whole batches should read these columns and
+    modify events with :meth:`setMetric` and :meth:`setState` so that the
+    events and columns stay consistent.
+
+    :param events: List of `tensor.objects.Event`
+    """
+    __slots__ = ('events', '_time', '_metric', '_state', '_ttl', '_sid')
+
+    def __init__(self, events=None):
+        if events is None:
+            events = []
+        elif isinstance(events, EventBatch):
+            events = list(events.events)
+        elif not isinstance(events, list):
+            events = list(events)
+
+        self.events = events
+        self._reset()
+
+    def _reset(self):
+        self._time = None
+        self._metric = None
+        self._state = None
+        self._ttl = None
+        self._sid = None
+
+    @property
+    def time(self):
+        """Event timestamps as an array of doubles"""
+        if self._time is None:
+            self._time = array('d', [e.time for e in self.events])
+        return self._time
+
+    @property
+    def metric(self):
+        """Event metrics"""
+        if self._metric is None:
+            self._metric = [e.metric for e in self.events]
+        return self._metric
+
+    @property
+    def state(self):
+        """Event states"""
+        if self._state is None:
+            self._state = [e.state for e in self.events]
+        return self._state
+
+    @property
+    def ttl(self):
+        """Event TTLs"""
+        if self._ttl is None:
+            self._ttl = [e.ttl for e in self.events]
+        return self._ttl
+
+    @property
+    def sid(self):
+        """Series ids, as returned by :meth:`Event.id`"""
+        if self._sid is None:
+            self._sid = [e.id() for e in self.events]
+        return self._sid
+
+    def setMetric(self, i, metric):
+        """Set the metric of event `i`"""
+        self.events[i].metric = metric
+        if self._metric is not None:
+            self._metric[i] = metric
+
+    def setState(self, i, state):
+        """Set the state of event `i`"""
+        self.events[i].state = state
+        if self._state is not None:
+            self._state[i] = state
+
+    def select(self, indexes):
+        """Returns a new batch containing only the events at `indexes`,
+        carrying over any columns which have already been built"""
+        batch = EventBatch([self.events[i] for i in indexes])
+
+        for col in ('_metric', '_state', '_ttl', '_sid'):
+            values = getattr(self, col)
+            if values is not None:
+                setattr(batch, col, [values[i] for i in indexes])
+
+        if self._time is not None:
+            batch._time = array('d', [self._time[i] for i in indexes])
+
+        return batch
+
+    def append(self, event):
+        self.events.append(event)
+        self._reset()
+
+    def extend(self, events):
+        if isinstance(events, EventBatch):
+            events = events.events
+        self.events.extend(events)
+        self._reset()
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __getitem__(self, i):
+        return self.events[i]
+
+    def __eq__(self, other):
+        if isinstance(other, EventBatch):
+            other = other.events
+        return self.events == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<EventBatch %s>" % repr(self.events)
+
 class Output(object):
     """Output parent class
 
     Outputs can inherit this object which provides a construct
     for a working output
 
+    Events routed to an output are held in its `buffer` until the service
+    flushes them to :meth:`eventsReceived`. The buffer size and what to do
+    when it is full are set with the `buffer_size` (default 100000) and
+    `overflow` (`drop` new events, or `overwrite` the oldest ones) options.
+
+    Outputs with their own queue can use :meth:`checkPressure` to signal
+    when it is filling up, which pauses the sources routed to them. The
+    `highwater` (default 0.8) and `lowwater` (default 0.5) options set the
+    fraction of the queue size at which this starts and stops.
+
     :param config: Dictionary config for this queue (usually read from the
              yaml configuration)
     :param tensor: A TensorService object for interacting with the queue manager
@@ -105,19 +260,74 @@ class Output(object):
         self.config = config
         self.tensor = tensor
 
+        self.buffer = RingBuffer(
+            int(self.config.get('buffer_size', 100000)),
+            self.config.get('overflow', 'drop')
+        )
+
+        self.highwater = float(self.config.get('highwater', 0.8))
+        self.lowwater = float(self.config.get('lowwater', 0.5))
+        self.drained = None
+        self.fill = 0.0
+
     def createClient(self):
         """Deferred which sets up the output
         """
         pass
 
-    def eventsReceived(self):
-        """Receives a list of events and processes them
+    def eventsReceived(self, events):
+        """Receives a batch of events and processes them
+
+        This may return a Deferred, in which case the output is considered
+        saturated and sources routed to it are paused until it fires.
 
         Arguments:
-        events -- list of `tensor.objects.Event`
+        events -- `tensor.objects.EventBatch`, which can be iterated as a
+                  list of `tensor.objects.Event`
         """
         pass
 
+    def checkPressure(self, size, maxsize):
+        """Updates the pressure on this output from its queue `size`.
+
+        Returns a Deferred once the queue reaches the high water mark,
+        which fires when it has drained below the low water mark, or None
+        if the output is not saturated.
+        """
+        if maxsize < 1:
+            return None
+
+        self.fill = size / float(maxsize)
+
+        if self.drained is None:
+            if self.fill >= self.highwater:
+                self.drained = defer.Deferred()
+        elif self.fill <= self.lowwater:
+            d, self.drained = self.drained, None
+            d.callback(None)
+
+        return self.drained
+
+    def queueSize(self):
+        """Returns the number of events waiting to be sent"""
+        return len(self.buffer)
+
+    def oldestEvent(self):
+        """Returns the oldest event waiting to be sent, or None"""
+        return self.buffer.peek()
+
+    def pressure(self):
+        """Returns the pressure on this output, from 0.0 to 1.0"""
+        if self.drained is not None:
+            return 1.0
+        return min(self.fill, 1.0)
+
+    def stats(self):
+        """Returns a dictionary of metrics specific to this output, which
+        the internal source reports. All outputs report the total events
+        lost when their buffer overflowed."""
+        return {'buffer dropped': self.buffer.dropped}
+
     def stop(self):
         """Called when the service shuts down
         """
@@ -129,14 +339,28 @@ class Source(object):
     Sources can inherit this object which provides a number of
     utility methods.
 
+    Ticks are skipped while an output this source routes to is saturated,
+    unless the source is configured with `backpressure: none`.
+
+    Sources whose `get` blocks on file IO can run it in the service thread
+    pool with `executor: thread`, which is the default for those that set
+    the `executor` class attribute. SSH checks always run on the reactor.
+
+    A tick which takes longer than `tick_timeout` seconds is cancelled. With
+    `adaptive: true` a source whose ticks keep taking longer than its
+    interval doubles the interval, up to `max_interval`, and halves it again
+    once ticks take less than a quarter of it.
+
     :param config: Dictionary config for this queue (usually read from the
              yaml configuration)
     :param queueBack: A callback method to recieve a list of Event objects
+                      or an EventBatch
     :param tensor: A TensorService object for interacting with the queue manager
     """
 
     sync = False
     ssh = False
+    executor = 'reactor'
 
     def __init__(self, config, queueBack, tensor):
         self.config = config
@@ -151,7 +375,8 @@ class Source(object):
         self.ttl = float(config['ttl'])
 
         if 'tags' in config:
-            self.tags = [tag.strip() for tag in config['tags'].split(',')]
+            self.tags = [
+                _intern(tag.strip()) for tag in config['tags'].split(',')]
         else:
             self.tags = []
 
@@ -159,22 +384,57 @@ class Source(object):
         if isinstance(attributes, dict):
             self.attributes = attributes
 
+        # Without a configured hostname this host's name is looked up
+        # the first time it is needed, rather than for every source
         self.hostname = config.get('hostname')
-        if self.hostname is None:
-            self.hostname = socket.gethostbyaddr(socket.gethostname())[0]
 
         self.use_ssh = config.get('use_ssh', False)
 
         if self.use_ssh:
             self._init_ssh()
+            self.executor = 'reactor'
+        else:
+            self.executor = config.get('executor', self.executor)
 
         self.queueBack = self._queueBack(queueBack)
 
         self.running = False
+        # Deferred of a get() running in the thread pool
+        self.thread = None
+
+        # Set by the service while an output this source routes to is
+        # saturated
+        self.paused = False
+        self.skipped = 0
+
+        # Tick timing
+        self.tickTimeout = float(config.get('tick_timeout') or 0)
+        self.adaptive = bool(config.get('adaptive', False))
+        self.maxInterval = float(config.get('max_interval', self.inter * 8))
+        self.currentInterval = self.inter
+
+        self.ticks = 0
+        self.errors = 0
+        self.overruns = 0
+        self.timeouts = 0
+        self.lastDuration = None
+        self.avgDuration = None
+
+    @property
+    def hostname(self):
+        if self._hostname is None:
+            return getFQDN()
+        return self._hostname
+
+    @hostname.setter
+    def hostname(self, hostname):
+        self._hostname = _intern(hostname) if hostname else None
 
     def _init_ssh(self):
         """ Configure SSH client options
         """
+        # Conch is slow to import, so only load it for SSH sources
+        from tensor.protocol import ssh
 
         self.ssh_host = self.config.get('ssh_host', self.hostname)
 
@@ -236,11 +496,27 @@ class Source(object):
             self.tensor.hostConnectorCache[cHash] = self.ssh_client
 
     def _queueBack(self, caller):
-        return lambda events: caller(self, events)
+        def queueBack(events):
+            if inPoolThread():
+                # Sources may queue events from get() in a pool thread
+                reactor.callFromThread(caller, self, events)
+            else:
+                caller(self, events)
+
+        return queueBack
 
     def startTimer(self):
-        """Starts the timer for this source"""
-        self.td = self.t.start(self.inter)
+        """Starts the timer for this source, on the service scheduler if
+        there is one"""
+        scheduler = getattr(self.tensor, 'scheduler', None)
+
+        if scheduler is not None:
+            self.t = scheduler.add(self.tick, self.inter,
+                jitter=float(self.config.get('jitter', 0)),
+                catchup=self.config.get('catchup', 'skip'))
+            self.td = self.t.deferred
+        else:
+            self.td = self.t.start(self.inter)
 
         if self.use_ssh and self.ssh_connector:
             self.ssh_client.connect()
@@ -248,7 +524,17 @@ class Source(object):
     def stopTimer(self):
         """Stops the timer for this source"""
         self.td = None
-        self.t.stop()
+        if self.t.running:
+            self.t.stop()
+
+    def setInterval(self, interval):
+        """Changes the interval of the running timer"""
+        self.currentInterval = interval
+
+        if isinstance(self.t, task.LoopingCall):
+            self.t.interval = interval
+        else:
+            self.t.setInterval(interval)
 
     def fork(self, *a, **kw):
         if self.use_ssh:
@@ -256,13 +542,28 @@ class Source(object):
         else:
             return fork(*a, **kw)
 
+    def _timedGet(self):
+        return profiler.timed(self.tensor, 'source.%s.get' % self.service,
+            self.get)
+
     @defer.inlineCallbacks
     def _get(self):
         if self.use_ssh and not self.ssh:
             event = yield defer.maybeDeferred(self.sshGet)
 
+        elif (self.executor == 'thread') and getattr(
+                self.tensor, 'threadPool', None):
+            # A timeout can only stop waiting for the thread, so it's
+            # tracked until get() really returns
+            self.thread = self.tensor.threadPool.run(self._timedGet)
+            self.thread.addBoth(self._threadDone)
+
+            waiting = defer.Deferred()
+            self.thread.chainDeferred(waiting)
+            event = yield waiting
+
         else:
-            event = yield defer.maybeDeferred(self.get)
+            event = yield defer.maybeDeferred(self._timedGet)
 
         if self.config.get('debug', False):
             log.msg("[%s] Tick: %s" % (self.config['service'], event))
@@ -276,21 +577,75 @@ class Source(object):
         
         Returns a deferred"""
 
-        if self.sync:
+        if self.sync or (self.executor == 'thread'):
+            # Threaded ticks must not overlap either, as they share state
             if self.running:
                 defer.returnValue(None)
 
+        if self.paused:
+            self.skipped += 1
+            defer.returnValue(None)
+
         self.running = True
+        started = time.time()
 
         try:
-            event = yield self._get()
+            d = self._get()
+            if self.tickTimeout:
+                d.addTimeout(self.tickTimeout, reactor)
+
+            event = yield d
             if event:
                 self.queueBack(event)
 
+        except defer.TimeoutError:
+            self.timeouts += 1
+            log.msg("[%s] Tick cancelled after %ss" % (
+                self.service, self.tickTimeout))
+
         except Exception as e:
+            self.errors += 1
             log.msg("[%s] Unhandled error: %s" % (self.service, e))
 
+        if self.thread is None:
+            self.running = False
+        # Otherwise a cancelled get() is still running in its thread, and
+        # the next tick waits for it
+
+        self._tickDone(time.time() - started)
+
+    def _threadDone(self, result):
+        self.thread = None
         self.running = False
+        return result
+
+    def _tickDone(self, duration):
+        """Records the duration of a tick and adapts the interval"""
+        self.ticks += 1
+        self.lastDuration = duration
+
+        if self.avgDuration is None:
+            self.avgDuration = duration
+        else:
+            self.avgDuration = 0.7 * self.avgDuration + 0.3 * duration
+
+        if duration > self.currentInterval:
+            self.overruns += 1
+
+        if not self.adaptive:
+            return
+
+        interval = self.currentInterval
+
+        if self.avgDuration > interval:
+            interval = min(interval * 2, self.maxInterval)
+        elif (self.avgDuration < interval / 4) and (interval > self.inter):
+            interval = max(interval / 2, self.inter)
+
+        if interval != self.currentInterval:
+            log.msg("[%s] Tick takes %.2fs, changing interval to %ss" % (
+                self.service, self.avgDuration, interval))
+            self.setInterval(interval)
 
     def createEvent(self, state, description, metric, prefix=None,
             hostname=None, aggregation=None, evtime=None):
@@ -14,6 +14,7 @@ except:
 from tensor.protocol import elasticsearch
 
 from tensor.objects import Output
+from tensor.utils import EventQueue
 
 class ElasticSearch(Output):
     """ElasticSearch HTTP API output
@@ -35,15 +36,22 @@ class ElasticSearch(Output):
     :param index: Index name format to store documents in Elastic
                   (default: tensor-%Y.%m.%d)
     :type index: str
+    :param highwater: Fraction of `maxsize` at which sources routed to this
+                      output are paused (default 0.8)
+    :type highwater: float
+    :param lowwater: Fraction of `maxsize` at which paused sources resume
+                     (default 0.5)
+    :type lowwater: float
     """
     def __init__(self, *a):
         Output.__init__(self, *a)
-        self.events = []
         self.t = task.LoopingCall(self.tick)
 
         self.inter = float(self.config.get('interval', 1.0))  # tick interval
         self.maxsize = int(self.config.get('maxsize', 250000))
 
+        self.events = EventQueue(self.maxsize)
+
         self.user = self.config.get('user')
         self.password = self.config.get('password')
 
@@ -94,13 +102,7 @@ class ElasticSearch(Output):
         """Clock tick called every self.inter
         """
         if self.events:
-            if self.queueDepth and (len(self.events) > self.queueDepth):
-                # Remove maximum of self.queueDepth items from queue
-                events = self.events[:self.queueDepth]
-                self.events = self.events[self.queueDepth:]
-            else:
-                events = self.events
-                self.events = []
+            events = self.events.drain(self.queueDepth)
 
             try:
                 result = yield self.sendEvents(events)
@@ -112,15 +114,31 @@ class ElasticSearch(Output):
                 log.msg('Could not connect to elasticsearch ' + str(e))
                 self.events.extend(events)
 
+        self.checkPressure(len(self.events), self.maxsize)
+
     def eventsReceived(self, events):
-        """Receives a list of events and queues them
+        """Receives a batch of events and queues them
 
         Arguments:
-        events -- list of `tensor.objects.Event`
+        events -- `tensor.objects.EventBatch`
         """
-        # Make sure queue isn't oversized
-        if (self.maxsize < 1) or (len(self.events) < self.maxsize):
-            self.events.extend(events)
+        self.events.extend(events)
+
+        return self.checkPressure(len(self.events), self.maxsize)
+
+    def queueSize(self):
+        return Output.queueSize(self) + len(self.events)
+
+    def oldestEvent(self):
+        if self.events:
+            return self.events.peek()
+        return Output.oldestEvent(self)
+
+    def stats(self):
+        """Returns the total events dropped from a full queue"""
+        stats = Output.stats(self)
+        stats['dropped'] = self.events.dropped
+        return stats
 
 # Backward compatibility stub
 ElasticSearchLog = ElasticSearch
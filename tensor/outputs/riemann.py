@@ -1,4 +1,3 @@
-import time
 import random
 
 from twisted.internet import reactor, defer, task
@@ -11,8 +10,10 @@ except:
     SSL=None
 
 from tensor.protocol import riemann
+from tensor import profiler
 
 from tensor.objects import Output
+from tensor.utils import EventQueue
 
 if SSL:
     class ClientTLSContext(ssl.ClientContextFactory):
@@ -43,10 +44,20 @@ class RiemannTCP(Output):
     :type maxrate: int.
     :param maxsize: Maximum queue size (0 is no limit, default is 250000)
     :type maxsize: int.
+    :param expire: Expire queued events once their TTL has passed while
+                   disconnected (default false)
+    :type expire: bool.
     :param interval: De-queue interval in seconds (default: 1.0)
     :type interval: float.
-    :param pressure: Maximum backpressure (-1 is no limit)
+    :param pressure: Maximum messages awaiting acknowledgement before
+                     sending more (-1 is no limit)
     :type pressure: int.
+    :param window_bytes: Maximum bytes awaiting acknowledgement before
+                         sending more (0 is no limit)
+    :type window_bytes: int.
+    :param batch: Maximum events per message, so that a large queue is
+                  pipelined as several messages (0 is no limit)
+    :type batch: int.
     :param tls: Use TLS (default false)
     :type tls: bool.
     :param cert: Host certificate path
@@ -55,18 +66,32 @@ class RiemannTCP(Output):
     :type key: str.
     :param allow_nan: Send events with None metric value (default true)
     :type allow_nan: bool
+    :param highwater: Fraction of `maxsize` at which sources routed to this
+                      output are paused (default 0.8)
+    :type highwater: float.
+    :param lowwater: Fraction of `maxsize` at which paused sources resume
+                     (default 0.5)
+    :type lowwater: float.
     """
     def __init__(self, *a):
         Output.__init__(self, *a)
-        self.events = []
         self.t = task.LoopingCall(self.tick)
+        self.factory = None
 
         self.inter = float(self.config.get('interval', 1.0))  # tick interval
-        self.pressure = int(self.config.get('pressure', -1))
+        self.maxPressure = int(self.config.get('pressure', -1))
+        self.windowBytes = int(self.config.get('window_bytes', 0))
+        self.batch = int(self.config.get('batch', 0))
         self.maxsize = int(self.config.get('maxsize', 250000))
         self.expire = self.config.get('expire', False)
         self.allow_nan = self.config.get('allow_nan', True)
 
+        self.events = EventQueue(self.maxsize, expiring=bool(self.expire))
+
+        # Acknowledgements counted at the last stats() call
+        self.acks = 0
+        self.rttTotal = 0.0
+
         maxrate = int(self.config.get('maxrate', 0))
 
         if maxrate > 0:
@@ -133,41 +158,90 @@ class RiemannTCP(Output):
         """Clock tick called every self.inter
         """
         if self.factory.proto:
-            # Check backpressure
-            if (self.pressure < 0) or (self.factory.proto.pressure <= self.pressure):
-                self.emptyQueue()
+            self.emptyQueue()
         elif self.expire:
-            # Check queue age and expire stale events
-            for i, e in enumerate(self.events):
-                if (time.time() - e.time) > e.ttl:
-                    self.events.pop(i)
+            self.events.expire()
+
+        self.checkPressure(len(self.events), self.maxsize)
+
+    def windowOpen(self):
+        """Returns True if there is room for another message awaiting
+        acknowledgement"""
+        proto = self.factory.proto
+
+        if (self.maxPressure >= 0) and (proto.pressure > self.maxPressure):
+            return False
+
+        if self.windowBytes and (proto.inflightBytes >= self.windowBytes):
+            return False
+
+        return True
 
     def emptyQueue(self):
-        """Remove all or self.queueDepth events from the queue
+        """Remove all or self.queueDepth events from the queue, sending
+        them in messages of up to self.batch events while the window is
+        open
         """
-        if self.events:
-            if self.queueDepth and (len(self.events) > self.queueDepth):
-                # Remove maximum of self.queueDepth items from queue
-                events = self.events[:self.queueDepth]
-                self.events = self.events[self.queueDepth:]
-            else:
-                events = self.events
-                self.events = []
+        budget = self.queueDepth
 
-            if self.allow_nan:
-                self.factory.proto.sendEvents(events)
-            else:
-                self.factory.proto.sendEvents([e for e in events if e.metric is not None])
+        while self.events and self.windowOpen():
+            size = self.batch or None
+            if budget is not None:
+                if budget < 1:
+                    break
+                size = min(size or budget, budget)
+
+            events = self.events.drain(size)
+            if budget is not None:
+                budget -= len(events)
+
+            if not self.allow_nan:
+                events = [e for e in events if e.metric is not None]
+
+            profiler.timed(self.tensor, 'output.%s.encode' % (
+                self.config.get('name') or 'default'),
+                self.factory.proto.sendEvents, events)
 
     def eventsReceived(self, events):
-        """Receives a list of events and transmits them to Riemann
+        """Receives a batch of events and transmits them to Riemann
 
         Arguments:
-        events -- list of `tensor.objects.Event`
+        events -- `tensor.objects.EventBatch`
         """
-        # Make sure queue isn't oversized
-        if (self.maxsize < 1) or (len(self.events) < self.maxsize):
-            self.events.extend(events)
+        self.events.extend(events)
+
+        return self.checkPressure(len(self.events), self.maxsize)
+
+    def queueSize(self):
+        return Output.queueSize(self) + len(self.events)
+
+    def oldestEvent(self):
+        if self.events:
+            return self.events.peek()
+        return Output.oldestEvent(self)
+
+    def stats(self):
+        """Returns the total events dropped from a full queue and expired,
+        the mean round trip time of messages acknowledged since the last
+        call, the messages awaiting acknowledgement, and the total messages
+        sent again after reconnecting"""
+        stats = Output.stats(self)
+        stats['dropped'] = self.events.dropped
+        stats['expired'] = self.events.expired
+
+        if self.factory is None:
+            return stats
+
+        factory = self.factory
+        acks = factory.acks - self.acks
+        rtt = factory.rttTotal - self.rttTotal
+        self.acks, self.rttTotal = factory.acks, factory.rttTotal
+
+        stats['rtt'] = (rtt / acks) if acks else 0.0
+        stats['inflight'] = factory.proto.pressure if factory.proto else 0
+        stats['retransmits'] = factory.retransmits
+
+        return stats
 
 class RiemannUDP(Output):
     """Riemann UDP output (spray-and-pray mode)
@@ -198,10 +272,10 @@ class RiemannUDP(Output):
         return d
 
     def eventsReceived(self, events):
-        """Receives a list of events and transmits them to Riemann
+        """Receives a batch of events and transmits them to Riemann
 
         Arguments:
-        events -- list of `tensor.objects.Event`
+        events -- `tensor.objects.EventBatch`
         """
         if self.protocol:
             self.protocol.sendEvents(events)
@@ -0,0 +1,192 @@
+"""On-demand profiling
+
+A running Tensor can be profiled without restarting it by sending it
+SIGUSR2, which starts the profiler, and SIGUSR2 again to stop it and write
+the results out. The profiler either runs `cProfile`, or samples the stack
+of the main thread from a SIGPROF timer, which costs much less.
+
+In both modes the time spent in each source's `get`, in aggregation and
+triggers, and in each output is also recorded by section, and samples are
+attributed to the section they were taken in.
+"""
+
+import itertools
+import os
+import signal
+import tempfile
+import threading
+import time
+
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    cProfile = None
+
+from twisted.python import log
+
+
+# Mode used unless the `profiler` option says otherwise
+DEFAULT_MODE = 'sample'
+
+# Numbers dumps, keeping their names apart within a second
+_dumps = itertools.count(1)
+
+
+def timed(tensor, name, fn, *a, **kw):
+    """Calls `fn`, timing it under section `name` if `tensor` (a
+    TensorService, or None) is being profiled"""
+    profiler = getattr(tensor, 'profiler', None)
+
+    if profiler and profiler.running:
+        return profiler.timed(name, fn, *a, **kw)
+
+    return fn(*a, **kw)
+
+
+class Profiler(object):
+    """Collects a profile of the service between :meth:`start` and
+    :meth:`stop`
+
+    :param mode: `sample` or `cprofile` (default sample)
+    :type mode: str.
+    :param path: Directory to write dumps to (default /var/lib/tensor)
+    :type path: str.
+    :param interval: Seconds of CPU time between samples (default 0.005)
+    :type interval: float.
+    """
+    def __init__(self, mode=DEFAULT_MODE, path='/var/lib/tensor',
+            interval=0.005):
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError("Unknown profiler mode %r" % mode)
+
+        if (mode == 'cprofile') and (cProfile is None):
+            mode = 'sample'
+
+        self.mode = mode
+        self.path = path
+        self.interval = interval
+
+        self.running = False
+        self.started = None
+        self.profile = None
+
+        self.lock = threading.Lock()
+        self.sections = {}
+        self.samples = {}
+        self.current = None
+
+    def start(self):
+        if self.running:
+            return
+
+        self.sections = {}
+        self.samples = {}
+        self.started = time.time()
+        self.running = True
+
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval,
+                self.interval)
+
+        log.msg("Profiler started (%s)" % self.mode)
+
+    def stop(self):
+        """Stops profiling and returns the list of files written"""
+        if not self.running:
+            return []
+
+        self.running = False
+
+        if self.mode == 'cprofile':
+            self.profile.disable()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+        files = self.dump()
+        self.profile = None
+
+        log.msg("Profiler stopped, wrote %s" % ', '.join(files))
+
+        return files
+
+    def timed(self, name, fn, *a, **kw):
+        """Calls `fn`, recording the time it takes under section `name`"""
+        main = threading.current_thread().name == 'MainThread'
+
+        if main:
+            outer, self.current = self.current, name
+
+        t = time.time()
+        try:
+            return fn(*a, **kw)
+        finally:
+            elapsed = time.time() - t
+
+            if main:
+                self.current = outer
+
+            with self.lock:
+                section = self.sections.setdefault(name, [0, 0.0])
+                section[0] += 1
+                section[1] += elapsed
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (
+                os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+
+        if self.current:
+            stack.append(self.current)
+
+        key = ';'.join(reversed(stack))
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    def _directory(self):
+        if os.access(self.path, os.W_OK):
+            return self.path
+        return tempfile.gettempdir()
+
+    def dump(self):
+        """Writes the profile out and returns the list of files written"""
+        base = os.path.join(self._directory(),
+            'tensor-profile-%s-%s' % (time.strftime(
+                '%Y%m%d-%H%M%S', time.localtime(self.started)),
+                next(_dumps)))
+
+        files = []
+
+        if self.mode == 'cprofile':
+            self.profile.dump_stats(base + '.prof')
+            files.append(base + '.prof')
+
+            with open(base + '.txt', 'wt') as out:
+                stats = pstats.Stats(self.profile, stream=out)
+                stats.sort_stats('cumulative').print_stats(50)
+            files.append(base + '.txt')
+        else:
+            # Collapsed stacks, as used by flamegraph.pl
+            with open(base + '.folded', 'wt') as out:
+                for stack, count in sorted(self.samples.items()):
+                    out.write('%s %s\n' % (stack, count))
+            files.append(base + '.folded')
+
+        with open(base + '.sections', 'wt') as out:
+            duration = time.time() - self.started
+            out.write('# %.2fs profiled\n' % duration)
+            out.write('# section calls total_seconds\n')
+
+            for name, (calls, total) in sorted(self.sections.items(),
+                    key=lambda s: -s[1][1]):
+                out.write('%s %s %.6f\n' % (name, calls, total))
+        files.append(base + '.sections')
+
+        return files
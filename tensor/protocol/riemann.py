@@ -1,3 +1,8 @@
+import struct
+import time
+
+from collections import deque
+
 from tensor.ihateprotobuf import proto_pb2
 from tensor.interfaces import ITensorProtocol
 
@@ -8,7 +13,183 @@ from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import protocol
 from twisted.python import log
 
+# Largest float32, beyond which protobuf sends infinity
+FLOAT_MAX = float.fromhex('0x1.fffffep+127')
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+_float = struct.Struct('<Bf')
+_double = struct.Struct('<BdBf')
+
+
+def _float32(value):
+    """Clamps a float to the range of float32 as protobuf does"""
+    if value > FLOAT_MAX:
+        return float('inf')
+    if value < -FLOAT_MAX:
+        return float('-inf')
+    return value
+
+
+def _varint(value):
+    """Encodes an unsigned integer as a protobuf varint"""
+    if value < 0x80:
+        return bytes(bytearray((value,)))
+
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _int64(value):
+    if not (INT64_MIN <= value <= INT64_MAX):
+        raise ValueError("Value out of range: %s" % value)
+    return value
+
+
+def _string(tag, value):
+    """Encodes a length delimited string field"""
+    if not isinstance(value, bytes):
+        try:
+            value = value.encode('utf-8')
+        except AttributeError:
+            raise TypeError("%r is not a string" % (value,))
+
+    return bytes(bytearray((tag,))) + _varint(len(value)) + value
+
+
+class Template(object):
+    """Encoded fields of an event which are usually the same for every
+    event in a series"""
+    __slots__ = ('description', 'tags', 'ttl', 'attributes', 'data')
+
+    def __init__(self, event):
+        self.description = event.description
+        self.tags = list(event.tags)
+        self.ttl = event.ttl
+        self.attributes = dict(event.attributes) if event.attributes else (
+            event.attributes)
+
+        # service = 3, host = 4, description = 5, tags = 7, ttl = 8,
+        # attributes = 9
+        data = _string(0x1a, event.service) + _string(0x22, event.hostname)
+
+        if event.description is not None:
+            data += _string(0x2a, event.description)
+
+        for tag in event.tags:
+            data += _string(0x3a, tag)
+
+        if event.ttl is not None:
+            data += _float.pack(0x45, _float32(float(event.ttl)))
+
+        if event.attributes is not None:
+            for key, value in event.attributes.items():
+                attribute = _string(0x0a, key) + _string(0x12, value)
+                data += b'\x4a' + _varint(len(attribute)) + attribute
+
+        self.data = data
+
+    def matches(self, event):
+        return (self.description == event.description) and (
+            self.tags == event.tags) and (self.ttl == event.ttl) and (
+            self.attributes == event.attributes)
+
+
+class RiemannEncoder(object):
+    """Encodes events as a Riemann protobuf `Msg` by writing the wire format
+    directly, giving the same bytes as `proto_pb2`
+
+    The service, host, description, tags, TTL and attributes of each series
+    are encoded once and reused while they stay the same, so only the time,
+    state and metric are encoded for each event.
+    """
+
+    # Limit on cached series
+    cacheSize = 100000
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.templates = {}
+        self.states = {}
+
+        self.lastTime = None
+        self.timeField = b''
+
+    def encodeState(self, state):
+        field = self.states.get(state)
+
+        if field is None:
+            field = b'' if state is None else _string(0x12, state)
+
+            if len(self.states) >= 1000:
+                self.states.clear()
+            self.states[state] = field
+
+        return field
+
+    def encodeMessage(self, events):
+        """Returns a serialized `Msg` of the Riemann events in `events`"""
+        buf = self.buffer
+        del buf[:]
+
+        templates = self.templates
+
+        for ev in events:
+            if ev._type != 'riemann':
+                continue
+
+            # time = 1, which events from a batch mostly share
+            t = int(ev.time)
+            if t != self.lastTime:
+                self.timeField = b'\x08' + _varint(
+                    _int64(t) & 0xffffffffffffffff)
+                self.lastTime = t
+
+            state = self.encodeState(ev.state)
+
+            key = (ev.hostname, ev.service)
+            template = templates.get(key)
+            if (template is None) or not template.matches(ev):
+                if len(templates) >= self.cacheSize:
+                    templates.clear()
+                template = templates[key] = Template(ev)
+
+            # metric_sint64 = 13, metric_d = 14, metric_f = 15
+            metric = ev.metric
+            if metric is None:
+                metricField = b''
+            elif isinstance(metric, int):
+                _int64(metric)
+                metricField = b'\x68' + _varint(
+                    (metric << 1) ^ (metric >> 63)) + _float.pack(
+                    0x7d, _float32(float(metric)))
+            else:
+                metric = float(metric)
+                if -FLOAT_MAX <= metric <= FLOAT_MAX:
+                    metricField = _double.pack(0x71, metric, 0x7d, metric)
+                else:
+                    metricField = _double.pack(0x71, metric, 0x7d,
+                        _float32(metric))
+
+            # events = 6
+            buf.append(0x32)
+            buf += _varint(len(self.timeField) + len(state) +
+                len(template.data) + len(metricField))
+            buf += self.timeField
+            buf += state
+            buf += template.data
+            buf += metricField
+
+        return bytes(buf)
+
+
 class RiemannProtobufMixin(object):
+    # RiemannEncoder, created on first use
+    encoder = None
+
     def encodeEvent(self, event):
         """Adapts an Event object to a Riemann protobuf event Event"""
         pbevent = proto_pb2.Event(
@@ -38,12 +219,10 @@ class RiemannProtobufMixin(object):
 
     def encodeMessage(self, events):
         """Encode a list of Tensor events with protobuf"""
+        if self.encoder is None:
+            self.encoder = RiemannEncoder()
 
-        message = proto_pb2.Msg(
-            events=[self.encodeEvent(e) for e in events if e._type=='riemann']
-        )
-
-        return message.SerializeToString()
+        return self.encoder.encodeMessage(events)
 
     def decodeMessage(self, data):
         """Decode a protobuf message into a list of Tensor events"""
@@ -60,16 +239,61 @@ class RiemannProtobufMixin(object):
 @implementer(ITensorProtocol)
 class RiemannProtocol(Int32StringReceiver, RiemannProtobufMixin):
     """Riemann protobuf protocol
+
+    Messages are pipelined, and each one is kept in `inflight` until
+    Riemann acknowledges it, which it does in the order they were sent.
+
+    :param clientFactory: Factory which is told of acknowledgements, and
+                          which holds messages to retransmit once connected
+    :type clientFactory: RiemannClientFactory.
     """
 
-    def __init__(self):
-        self.pressure = 0
+    def __init__(self, clientFactory=None):
+        self.clientFactory = clientFactory
+
+        # (message, time sent) awaiting acknowledgement
+        self.inflight = deque()
+        self.inflightBytes = 0
+
+    @property
+    def pressure(self):
+        """Number of messages awaiting acknowledgement"""
+        return len(self.inflight)
+
+    def connectionMade(self):
+        if self.clientFactory is not None:
+            for message in self.clientFactory.takeUnacked():
+                self.sendMessage(message)
+
+    def sendMessage(self, message):
+        self.inflight.append((message, time.time()))
+        self.inflightBytes += len(message)
+        self.sendString(message)
+
+    def sendEvents(self, events):
+        """Send a Tensor Event to Riemann"""
+        self.sendMessage(self.encodeMessage(events))
 
     def stringReceived(self, string):
-        self.pressure -= 1
+        if not self.inflight:
+            return
+
+        message, sent = self.inflight.popleft()
+        self.inflightBytes -= len(message)
+
+        response = self.decodeMessage(string)
+        if not response.ok:
+            log.msg('Riemann error: %s' % response.error)
+
+        if self.clientFactory is not None:
+            self.clientFactory.acked(time.time() - sent)
 
 class RiemannClientFactory(protocol.ReconnectingClientFactory):
     """A reconnecting client factory which creates RiemannProtocol instances
+
+    Messages which were not acknowledged when a connection is lost are
+    sent again once it reconnects, so Riemann may receive some events
+    twice.
     """
     maxDelay = 30
     initialDelay = 5
@@ -86,12 +310,36 @@ class RiemannClientFactory(protocol.ReconnectingClientFactory):
                 self.hosts = [hosts]
 
         self.host_index = 0
+        self.proto = None
+
+        # Messages awaiting retransmission
+        self.unacked = []
+
+        self.acks = 0
+        self.rttTotal = 0.0
+        self.retransmits = 0
 
     def buildProtocol(self, addr):
         self.resetDelay()
-        self.proto = RiemannProtocol()
+        self.proto = RiemannProtocol(self)
         return self.proto
 
+    def acked(self, rtt):
+        """Records the round trip time of an acknowledged message"""
+        self.acks += 1
+        self.rttTotal += rtt
+
+    def takeUnacked(self):
+        """Returns the messages to send again on a new connection"""
+        unacked, self.unacked = self.unacked, []
+        self.retransmits += len(unacked)
+        return unacked
+
+    def _saveUnacked(self):
+        if self.proto is not None:
+            self.unacked.extend(message for message, sent
+                                in self.proto.inflight)
+
     def _do_failover(self, connector):
         if self.failover:
             if self.host_index >= (len(self.hosts)-1):
@@ -103,6 +351,7 @@ class RiemannClientFactory(protocol.ReconnectingClientFactory):
 
     def clientConnectionLost(self, connector, reason):
         log.msg('Lost connection.  Reason:' + str(reason))
+        self._saveUnacked()
         self.proto = None
 
         self._do_failover(connector)
@@ -0,0 +1,164 @@
+"""Time window rollups
+
+A source with `rollup` set to a number of seconds has each of its series
+summarised over windows of that length, aligned to wall clock time. At the
+end of each window one event per summary function is sent for each series,
+named `<service>.<function>`, with the worst state seen in the window.
+
+By default the raw events are replaced by the summaries. With
+`rollup_route` the raw events are routed as usual and the summaries are
+sent to that route instead. Events without a numeric metric, such as state
+only alerts, and events which aren't Riemann events are never rolled up,
+and are always routed as usual.
+
+Quantiles can be requested as `pNN` functions, for example `p50` or
+`p999`, which are estimated from a :class:`tensor.aggregators.DDSketch`
+of each series rather than by keeping every sample.
+"""
+
+import numbers
+import re
+import time
+
+from tensor.aggregators import DDSketch
+from tensor.objects import Event, EventBatch
+
+
+FUNCTIONS = ('min', 'max', 'avg', 'count', 'sum', 'last')
+
+# Percentiles as two or more digits after the decimal point, so p05 is
+# 0.05 and p999 is 0.999. p5 and p100 are rejected rather than read as
+# 0.5 and 0.1.
+_quantile = re.compile(r'^p(\d{2}|\d{2,}[1-9])$')
+
+# Worst state wins, with anything unrecognised ranked between ok and
+# critical
+STATE_RANK = {'ok': 0, 'warning': 2, 'critical': 3}
+
+
+class Series(object):
+    """Summary of one series over the current window"""
+    __slots__ = ('min', 'max', 'sum', 'count', 'last', 'state', 'event',
+                 'sketch')
+
+    def __init__(self, metric, event, sketch=None):
+        self.min = self.max = self.sum = self.last = metric
+        self.count = 1
+        self.state = event.state
+        self.event = event
+
+        self.sketch = sketch
+        if sketch is not None:
+            sketch.add(metric)
+
+    def add(self, metric, event):
+        if metric < self.min:
+            self.min = metric
+        if metric > self.max:
+            self.max = metric
+        self.sum += metric
+        self.count += 1
+        self.last = metric
+
+        if self.sketch is not None:
+            self.sketch.add(metric)
+
+        if STATE_RANK.get(event.state, 1) > STATE_RANK.get(self.state, 1):
+            self.state = event.state
+        self.event = event
+
+    def value(self, function, quantiles):
+        if function in quantiles:
+            return self.sketch.quantile(quantiles[function])
+        if function == 'avg':
+            return self.sum / float(self.count)
+        return getattr(self, function)
+
+
+class Rollup(object):
+    """Accumulates a source's events over a window
+
+    :param window: Window length in seconds
+    :type window: float.
+    :param functions: Summaries to emit, from min, max, avg, count, sum,
+                      last and pNN quantiles (default all but quantiles)
+    :type functions: list.
+    :param route: Route for the summaries, in which case raw events are
+                  routed as usual (default None)
+    :type route: str.
+    """
+    def __init__(self, window, functions=None, route=None):
+        self.window = float(window)
+        if self.window <= 0:
+            raise ValueError("rollup must be greater than 0")
+
+        self.functions = list(functions or FUNCTIONS)
+
+        # Quantile function names to their fraction, p999 being 0.999
+        self.quantiles = {}
+
+        for fn in self.functions:
+            match = _quantile.match(fn)
+            if match:
+                self.quantiles[fn] = float('0.' + match.group(1))
+            elif fn not in FUNCTIONS:
+                raise ValueError("Unknown rollup function %r" % fn)
+
+        self.route = route
+        self.series = {}
+
+        # Timer flushing each window, set by the service
+        self.call = None
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Returns a Rollup for a source configuration, or None if it
+        doesn't have `rollup` set"""
+        if not config.get('rollup'):
+            return None
+
+        return cls(config['rollup'], config.get('rollup_functions'),
+                   config.get('rollup_route'))
+
+    def add(self, events):
+        """Adds a `tensor.objects.EventBatch` to the current window, and
+        returns an EventBatch of the events which can't be rolled up"""
+        series = self.series
+        skipped = []
+
+        for sid, metric, event in zip(events.sid, events.metric, events):
+            if (event._type != 'riemann') or not isinstance(
+                    metric, numbers.Real):
+                skipped.append(event)
+                continue
+
+            s = series.get(sid)
+            if s is None:
+                series[sid] = Series(metric, event,
+                    DDSketch() if self.quantiles else None)
+            else:
+                s.add(metric, event)
+
+        return EventBatch(skipped)
+
+    def flush(self, now=None):
+        """Ends the current window and returns an EventBatch of summaries"""
+        now = now or time.time()
+        series, self.series = self.series, {}
+
+        summaries = []
+        for s in series.values():
+            ev = s.event
+            # Keep summaries alive until the next window arrives
+            ttl = max(ev.ttl or 0, self.window * 2)
+
+            for fn in self.functions:
+                summaries.append(Event(s.state, '%s.%s' % (ev.service, fn),
+                    ev.description, s.value(fn, self.quantiles), ttl, tags=ev.tags,
+                    hostname=ev.hostname, evtime=now,
+                    attributes=ev.attributes, type=ev._type))
+
+        return EventBatch(summaries)
+
+    def __len__(self):
+        return len(self.series)
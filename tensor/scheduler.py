@@ -0,0 +1,276 @@
+"""Source scheduler
+
+All source timers run from a single :class:`Scheduler` owned by the
+service rather than a LoopingCall per source. Ticks are kept on a grid
+aligned to wall clock time, and each source gets its own phase within its
+interval so that sources with the same interval are spread over it instead
+of all firing together.
+"""
+
+import heapq
+import math
+import random
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+# Successive multiples of the golden ratio stay close to evenly spaced over
+# the unit interval however many there are
+PHI = (math.sqrt(5) - 1) / 2
+
+
+class TimerHeap(object):
+    """Calls `due(item, now)` for each item pushed with the time it is due,
+    from a single reactor timer
+
+    Items are kept in a heap ordered by when they are due. Pushing an item
+    again or discarding it leaves its older entries in the heap, which are
+    skipped when they come up rather than searched for.
+
+    :param due: Called with each item and the current time once it is due
+    :param clock: Provider of `IReactorTime` (default the reactor)
+    """
+    def __init__(self, due, clock=None):
+        self.due = due
+        self.clock = clock or reactor
+
+        self.heap = []
+        self.delayed = None
+        self.sequence = 0
+
+        # Generation of the current entry for each item
+        self.generations = {}
+
+    def __len__(self):
+        return len(self.generations)
+
+    def push(self, item, when):
+        """Schedules `item` at `when`, replacing any earlier entry"""
+        generation = self.generations.get(item, 0) + 1
+        self.generations[item] = generation
+
+        self.sequence += 1
+        heapq.heappush(self.heap, (when, self.sequence, generation, item))
+
+        self._reschedule()
+
+    def discard(self, item):
+        """Forgets any entry for `item`"""
+        self.generations.pop(item, None)
+
+        if not self.generations:
+            self.clear()
+
+    def clear(self):
+        self.heap = []
+        self.generations = {}
+
+        if self.delayed and self.delayed.active():
+            self.delayed.cancel()
+        self.delayed = None
+
+    def _reschedule(self):
+        if not self.heap:
+            return
+
+        when = self.heap[0][0]
+        delay = max(0, when - self.clock.seconds())
+
+        if self.delayed and self.delayed.active():
+            if self.delayed.getTime() > when:
+                self.delayed.reset(delay)
+        else:
+            self.delayed = self.clock.callLater(delay, self._run)
+
+    def _run(self):
+        self.delayed = None
+        now = self.clock.seconds()
+
+        while self.heap and (self.heap[0][0] <= now):
+            when, seq, generation, item = heapq.heappop(self.heap)
+
+            if self.generations.get(item) != generation:
+                # Stale entry for a discarded or rescheduled item
+                continue
+
+            self.due(item, now)
+
+        self._reschedule()
+
+
+class ScheduledCall(object):
+    """A repeating call owned by a :class:`Scheduler`
+
+    Provides the parts of `twisted.internet.task.LoopingCall` which sources
+    use, `running`, `deferred`, `interval` and `stop()`.
+
+    :param scheduler: Owning scheduler
+    :param f: Function to call, which may return a Deferred
+    :param interval: Seconds between calls
+    :type interval: float.
+    :param phase: Offset of calls within the interval, in seconds
+    :type phase: float.
+    :param jitter: Random delay of up to this many seconds added to each call
+    :type jitter: float.
+    :param catchup: `skip` to make one call after falling behind, or
+                    `burst` to make up missed calls back to back
+    :type catchup: str.
+    """
+    def __init__(self, scheduler, f, interval, phase, jitter=0.0,
+            catchup='skip'):
+        self.scheduler = scheduler
+        self.f = f
+        self.interval = interval
+        self.phase = phase
+        self.jitter = jitter
+        self.catchup = catchup
+
+        self.running = False
+        self.deferred = None
+
+        # Set while a call has not yet returned or its Deferred not fired
+        self.calling = False
+
+        # Grid time of the next call
+        self.next = None
+
+        self.calls = 0
+        self.missed = 0
+        self.behind = 0
+
+    def slotAfter(self, t):
+        """Returns the first grid time for this call after `t`"""
+        n = math.floor((t - self.phase) / self.interval) + 1
+        return n * self.interval + self.phase
+
+    def setInterval(self, interval):
+        """Changes the interval, keeping the same relative phase"""
+        self.phase = (self.phase / self.interval) * interval
+        self.interval = float(interval)
+
+        if self.running:
+            self.next = self.slotAfter(self.scheduler.clock.seconds())
+            self.scheduler._push(self)
+
+    def stop(self):
+        self.scheduler.remove(self)
+
+
+class Scheduler(object):
+    """Runs any number of repeating calls from a single reactor timer
+
+    Calls are kept in a heap ordered by when they are next due. Like
+    LoopingCall, a call is not made again until the previous one has
+    finished, and slots missed while it runs are skipped.
+
+    :param clock: Provider of `IReactorTime` (default the reactor)
+    """
+
+    # Most missed calls a `burst` call will make up
+    maxCatchup = 10
+
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self.timers = TimerHeap(self._due, self.clock)
+        self.calls = set()
+
+        self.added = 0
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, f, interval, phase=None, jitter=0.0, catchup='skip'):
+        """Schedules `f` to be called every `interval` seconds and returns
+        a :class:`ScheduledCall`
+
+        Unless a `phase` is given, each call added gets the next phase in
+        a golden ratio sequence.
+        """
+        interval = float(interval)
+        if interval <= 0:
+            raise ValueError("Interval must be greater than 0")
+
+        if catchup not in ('skip', 'burst'):
+            raise ValueError("Unknown catchup policy %r" % catchup)
+
+        if phase is None:
+            self.added += 1
+            phase = ((self.added * PHI) % 1.0) * interval
+
+        call = ScheduledCall(self, f, interval, phase % interval,
+            float(jitter), catchup)
+
+        call.running = True
+        call.deferred = defer.Deferred()
+        call.next = call.slotAfter(self.clock.seconds())
+
+        self.calls.add(call)
+        self._push(call)
+
+        return call
+
+    def remove(self, call):
+        """Stops `call`, firing its Deferred"""
+        if not call.running:
+            return
+
+        call.running = False
+        self.calls.discard(call)
+        self.timers.discard(call)
+
+        d, call.deferred = call.deferred, None
+        d.callback(call)
+
+    def stop(self):
+        """Stops all calls"""
+        for call in list(self.calls):
+            self.remove(call)
+
+        self.timers.clear()
+
+    def _push(self, call):
+        when = call.next
+        if call.jitter:
+            when += random.uniform(0, call.jitter)
+
+        self.timers.push(call, when)
+
+    def _due(self, call, now):
+        # Grid slots which passed before we got to this one
+        late = int((now - call.next) // call.interval)
+
+        if call.calling:
+            call.missed += late + 1
+        else:
+            call.missed += late
+            if late and (call.catchup == 'burst'):
+                call.behind = min(call.behind + late, self.maxCatchup)
+
+            self._invoke(call)
+
+        if call.running:
+            call.next = call.slotAfter(now)
+            self._push(call)
+
+    def _invoke(self, call):
+        if not call.running:
+            return
+
+        call.calling = True
+        call.calls += 1
+
+        d = defer.maybeDeferred(call.f)
+        d.addErrback(self._error, call)
+        d.addBoth(self._done, call)
+
+    def _error(self, failure, call):
+        log.msg("Scheduled call %r failed: %s" % (
+            call.f, failure.getErrorMessage()))
+
+    def _done(self, result, call):
+        call.calling = False
+
+        if call.behind and call.running:
+            call.behind -= 1
+            self.clock.callLater(0, self._invoke, call)
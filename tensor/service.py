@@ -2,8 +2,11 @@ import time
 import sys
 import os
 import importlib
-import re
 import copy
+import json
+import signal
+
+from array import array
 
 import yaml
 
@@ -12,6 +15,15 @@ from twisted.internet import task, reactor, defer
 from twisted.python import log
 
 from tensor.protocol import riemann
+from tensor import aggregators, profiler, triggers, utils, workers
+from tensor.objects import Event, EventBatch
+from tensor.scheduler import Scheduler
+from tensor.profiler import Profiler
+from tensor.watchdog import Watchdog
+from tensor.dedup import Dedup
+from tensor.rollup import Rollup
+from tensor.limits import Limiter
+from tensor.transforms import Transforms
 
 
 class TensorService(service.Service):
@@ -19,31 +31,98 @@ class TensorService(service.Service):
     
     Runs timers, configures sources and and manages the queue
     """
-    def __init__(self, config):
+    def __init__(self, config, configFile=None, overrides=None):
         self.running = 0
         self.sources = []
         self.lastEvents = {}
         self.outputs = {}
 
-        self.evCache = {}
-        self.critical = {}
-        self.warn = {}
+        self.triggers = {}
+
+        # Change-only filters for sources and outputs with `dedup` set
+        self.sourceDedup = {}
+        self.outputDedup = {}
+
+        # Window summaries for sources with `rollup` set
+        self.rollups = {}
 
         self.hostConnectorCache = {}
 
         self.eventCounter = 0
+        self.eventsOut = 0
 
         self.factory = None
         self.protocol = None
-        self.watchdog = None
+        self.expiry = None
+        self.flushCall = None
+        self.sketchCall = None
+
+        # Runs all source timers
+        self.scheduler = Scheduler()
+
+        # Restarts sources which stop sending events
+        self.watchdog = Watchdog(self)
+
+        # Started and stopped by SIGUSR2
+        self.profiler = None
+        self.previousSignals = {}
+
+        # Outputs which have signalled they are saturated
+        self.saturated = set()
+
+        # Set when running inside a worker process
+        self.workerProtocol = None
+        self.workerProcesses = []
+
+        # Configuration each source and output was created from, to tell
+        # what has changed when the configuration is reloaded
+        self.sourceKeys = {}
+        self.outputKeys = {}
+
+        # Configuration each transform and limit stage was built from, so
+        # they keep their state across reloads which don't change them
+        self.transformsKey = None
+        self.limitsKey = None
 
         self.config = config
+        self.configFile = configFile
 
-        both = lambda i1, i2, t: isinstance(i1, t) and isinstance(i2, t)
+        # Options given on the command line, which take precedence over
+        # the configuration file every time it is read
+        self.overrides = overrides or {}
 
         if os.path.exists('/var/lib/tensor'):
             sys.path.append('/var/lib/tensor')
 
+        self.loadIncludes(self.config)
+        self.config.update(self.overrides)
+        self.readConfig()
+
+        # Thread pool for sources with `executor: thread`
+        self.threadPool = utils.ThreadExecutor(
+            int(self.config.get('threadpool_size', 4)))
+
+        # Source worker processes
+        self.workerSources = [[] for i in range(self.workers)]
+
+        # Aggregation state, bounded by number of series and expired once
+        # a series has not been seen for `aggregation_expire` TTLs
+        self.evCache = utils.StateStore(maxsize=self.aggregationMaxsize)
+
+        # Sketches of series with the Quantiles aggregation, with the last
+        # event and source of each, sent every `quantile_interval`
+        self.sketches = utils.StateStore(maxsize=self.aggregationMaxsize)
+
+        if self.debug:
+            print("config:", repr(config))
+
+        self.setupSources(self.config)
+
+    def loadIncludes(self, config):
+        """Merges any .yml files in the `include_path` directory into
+        `config`"""
+        both = lambda i1, i2, t: isinstance(i1, t) and isinstance(i2, t)
+
         if 'include_path' in config:
             ipath = config['include_path']
             if os.path.exists(ipath):
@@ -53,30 +132,30 @@ class TensorService(service.Service):
                 ]
 
                 for f in files:
-                    conf = yaml.load(open(f, 'rt'))
+                    conf = yaml.safe_load(open(f, 'rt'))
                     for k,v in conf.items():
-                        if k in self.config:
-                            if both(v, self.config[k], dict):
+                        if k in config:
+                            if both(v, config[k], dict):
                                 # Merge dicts
                                 for k2, v2 in v.items():
-                                    self.config[k][j2] = v2
+                                    config[k][k2] = v2
 
-                            elif both(v, self.config[k], list):
+                            elif both(v, config[k], list):
                                 # Extend lists
-                                self.config[k].extend(v)
+                                config[k].extend(v)
                             else:
                                 # Overwrite
-                                self.config[k] = v
+                                config[k] = v
                         else:
-                            self.config[k] = v
+                            config[k] = v
                     log.msg('Loadded additional configuration from %s' % f)
             else:
                 log.msg('Config Error: include_path %s does not exist' % ipath)
 
-        # Read some config stuff
+    def readConfig(self):
+        """Reads global options from the configuration"""
         self.debug = float(self.config.get('debug', False))
         self.ttl = float(self.config.get('ttl', 60.0))
-        self.stagger = float(self.config.get('stagger', 0.2))
 
         # Backward compatibility
         self.server = self.config.get('server', 'localhost')
@@ -84,14 +163,45 @@ class TensorService(service.Service):
         self.proto = self.config.get('proto', 'tcp')
         self.inter = self.config.get('interval', 60.0)
 
-        if self.debug:
-            print("config:", repr(config))
+        self.workers = int(self.config.get('workers', 0))
 
-        self.setupSources(self.config)
+        self.aggregationExpire = float(
+            self.config.get('aggregation_expire', 2.0))
+        self.aggregationMaxsize = int(
+            self.config.get('aggregation_maxsize', 250000))
+        self.quantileInterval = float(
+            self.config.get('quantile_interval', 60.0))
 
-    def setupOutputs(self, config):
-        """Setup output processors"""
+        # Drop, keep, rename and label rules applied before aggregation
+        key = self.configKey(self.config.get('transforms'))
+        if key != self.transformsKey:
+            if self.config.get('transforms'):
+                self.transforms = Transforms(self.config['transforms'])
+            else:
+                self.transforms = None
+            self.transformsKey = key
+
+        # Sampling and rate limits applied when routing events. Rebuilding
+        # the limiter would refill its token buckets and counters
+        key = self.configKey(self.config.get('limits'))
+        if key != self.limitsKey:
+            if self.config.get('limits'):
+                self.limiter = Limiter(self.config['limits'])
+            else:
+                self.limiter = None
+            self.limitsKey = key
 
+        self.watchdogBackoff = float(self.config.get('watchdog_backoff', 10))
+        self.watchdogMaxBackoff = float(
+            self.config.get('watchdog_max_backoff', 600))
+
+    def configKey(self, config):
+        """Returns a key which is equal for equal configuration
+        dictionaries"""
+        return json.dumps(config, sort_keys=True, default=repr)
+
+    def outputConfigs(self, config):
+        """Returns the list of output configurations"""
         if self.proto == 'tcp':
             defaultOutput = {
                 'output': 'tensor.outputs.riemann.RiemannTCP',
@@ -111,12 +221,29 @@ class TensorService(service.Service):
             if not ('debug' in output):
                 output['debug'] = self.debug
 
-            cl = output['output'].split('.')[-1]                # class
-            path = '.'.join(output['output'].split('.')[:-1])   # import path
+        return outputs
+
+    def createOutput(self, output):
+        cl = output['output'].split('.')[-1]                # class
+        path = '.'.join(output['output'].split('.')[:-1])   # import path
+
+        # Import the module and construct the output object
+        outputObj = getattr(
+            importlib.import_module(path), cl)(output, self)
+
+        self.outputKeys[outputObj] = self.configKey(output)
+
+        dedup = Dedup.fromConfig(output, self.aggregationMaxsize)
+        if dedup:
+            self.outputDedup[outputObj] = dedup
 
-            # Import the module and construct the output object
-            outputObj = getattr(
-                importlib.import_module(path), cl)(output, self)
+        return outputObj
+
+    def setupOutputs(self, config):
+        """Setup output processors"""
+
+        for output in self.outputConfigs(config):
+            outputObj = self.createOutput(output)
 
             name = output.get('name', None)
 
@@ -129,6 +256,19 @@ class TensorService(service.Service):
             # connect the output
             reactor.callLater(0, outputObj.createClient)
 
+    def sourceDefaults(self, source):
+        """Fills in global defaults for a source configuration"""
+        if not ('debug' in source):
+            source['debug'] = self.debug
+
+        if not ('ttl' in source.keys()):
+            source['ttl'] = self.ttl
+
+        if not ('interval' in source.keys()):
+            source['interval'] = self.inter
+
+        return source
+
     def createSource(self, source):
         # 
         if source.get('path'):
@@ -143,188 +283,724 @@ class TensorService(service.Service):
         # Import the module and get the object source we care about
         sourceObj = getattr(importlib.import_module(path), cl)
 
-        if not ('debug' in source):
-            source['debug'] = self.debug
-
-        if not ('ttl' in source.keys()):
-            source['ttl'] = self.ttl
+        self.sourceDefaults(source)
+        key = self.configKey(source)
 
-        if not ('interval' in source.keys()):
-            source['interval'] = self.inter
+        sobj = sourceObj(source, self.sendEvent, self)
+        self.sourceKeys[sobj] = key
 
-        return sourceObj(source, self.sendEvent, self)
+        return sobj
 
     def setupTriggers(self, source, sobj):
-        if source.get('critical'):
-            self.critical[sobj] = [
-                (re.compile(k), v) for k, v in source['critical'].items()
-            ]
-
-        if source.get('warning'):
-            self.warn[sobj] = [
-                (re.compile(k), v) for k, v in source['warning'].items()
-            ]
+        if source.get('critical') or source.get('warning'):
+            self.triggers[sobj] = triggers.Triggers(
+                warning=source.get('warning'),
+                critical=source.get('critical')
+            )
+
+    def setupStages(self, source, sobj):
+        """Sets up the per-source stages events pass through between
+        aggregation and routing"""
+        self.setupTriggers(source, sobj)
+
+        dedup = Dedup.fromConfig(source, self.aggregationMaxsize)
+        if dedup:
+            self.sourceDedup[sobj] = dedup
+
+        rollup = Rollup.fromConfig(source)
+        if rollup is not None:
+            self.rollups[sobj] = rollup
+            # Windows end on multiples of the window length
+            rollup.call = self.scheduler.add(
+                lambda: self.flushRollup(sobj), rollup.window, phase=0)
 
     def setupSources(self, config):
         """Sets up source objects from the given config"""
         sources = config.get('sources', [])
 
         for source in sources:
+            if self.workers:
+                worker = workers.assignWorker(source, self.workers)
+                if worker is not None:
+                    self.workerSources[worker].append(source)
+                    continue
+
             src = self.createSource(source)
-            self.setupTriggers(source, src)
+            self.setupStages(source, src)
 
             self.sources.append(src)
 
-    def _aggregateQueue(self, events):
-        # Handle aggregation for each event
-        queue = []
-        for ev in events:
-            if ev.aggregation:
-                id = ev.id()
-                thisM = ev.metric
-
-                if id in self.evCache:
-                    lastM, lastTime = self.evCache[id]
-                    tDelta = ev.time - lastTime
-                    m = ev.aggregation(
-                        lastM, ev.metric, tDelta)
-                    if m:
-                        ev.metric = m
-                        queue.append(ev)
-
-                self.evCache[id] = (thisM, ev.time)
+    def _aggregateQueue(self, events, interval=0, source=None):
+        """Handle aggregation for each event in the batch, returning a batch
+        of the events which should be sent on
+
+        :param interval: Longest time until the source sends the series
+                         again, which state is kept for at least as long
+                         as its TTL
+        :type interval: float.
+        :param source: Source the events came from, which quantiles of
+                       sketched series are sent on behalf of
+        """
+        if not isinstance(events, EventBatch):
+            events = EventBatch(events)
+
+        now = time.time()
+        keep = [True] * len(events)
+
+        # Collect previous and current values for each aggregator so that
+        # they can be evaluated together
+        groups = {}
+
+        for i, ev in enumerate(events):
+            if ev.aggregation in aggregators.sketchAggregators:
+                keep[i] = False
+                id = events.sid[i]
+
+                entry = self.sketches.get(id, now)
+                if entry is None:
+                    entry = [aggregators.DDSketch(), ev, source]
+                else:
+                    entry[1:] = [ev, source]
+
+                if events.metric[i] is not None:
+                    entry[0].add(events.metric[i])
+
+                self.sketches.set(id, entry, now,
+                    max(ev.ttl or 0, interval, self.quantileInterval
+                        ) * self.aggregationExpire)
+
+            elif ev.aggregation:
+                keep[i] = False
+                id = events.sid[i]
+                thisM = events.metric[i]
+                thisTime = events.time[i]
+
+                last = self.evCache.get(id, now)
+                if last is not None:
+                    lastM, lastTime = last
+
+                    if ev.aggregation not in groups:
+                        groups[ev.aggregation] = ([], [], [], array('d'))
+
+                    idx, lastMs, thisMs, deltas = groups[ev.aggregation]
+                    idx.append(i)
+                    lastMs.append(lastM)
+                    thisMs.append(thisM)
+                    deltas.append(thisTime - lastTime)
+
+                self.evCache.set(id, (thisM, thisTime), now,
+                    max(ev.ttl or 0, interval) * self.aggregationExpire)
+
+        for aggregation, (idx, lastMs, thisMs, deltas) in groups.items():
+            batchAggregation = aggregators.batchAggregators.get(aggregation)
+
+            if batchAggregation:
+                metrics = batchAggregation(lastMs, thisMs, deltas)
             else:
-                queue.append(ev)
+                metrics = [aggregation(a, b, d)
+                           for a, b, d in zip(lastMs, thisMs, deltas)]
+
+            for i, m in zip(idx, metrics):
+                if m:
+                    events.setMetric(i, m)
+                    keep[i] = True
+
+        if all(keep):
+            return events
+
+        return events.select([i for i, k in enumerate(keep) if k])
+
+    def flushSketches(self):
+        """Sends the quantiles of the samples each sketched series has
+        received since the last flush"""
+        batches = {}
+
+        for id, entry in self.sketches.items():
+            sketch, ev, source = entry
+            if not sketch.count:
+                continue
+
+            entry[0] = aggregators.DDSketch()
+
+            batch = batches.setdefault(source, [])
+            for suffix, metric in ev.aggregation(sketch):
+                batch.append(Event(ev.state, '%s.%s' % (ev.service, suffix),
+                    ev.description, metric, ev.ttl, tags=ev.tags,
+                    hostname=ev.hostname, attributes=ev.attributes))
+
+        for source, batch in batches.items():
+            self.processEvents(source, EventBatch(batch))
+
+    def sourceInterval(self, source):
+        """Returns the longest `source` may take to tick again, which
+        adaptive sources can stretch up to their `max_interval`"""
+        if source.adaptive:
+            interval = max(source.currentInterval, source.maxInterval)
+        else:
+            interval = source.currentInterval
 
-        return queue
+        return max(interval, source.lastDuration or 0)
 
     def setStates(self, source, queue):
-        for ev in queue:
-            if ev.state == 'ok':
-                for k, v in self.warn.get(source, []):
-                    if k.match(ev.service):
-                        s = eval("service %s" % v, {'service': ev.metric})
-                        if s:
-                            ev.state = 'warning'
-
-                for k, v in self.critical.get(source, []):
-                    if k.match(ev.service):
-                        s = eval("service %s" % v, {'service': ev.metric})
-                        if s:
-                            ev.state = 'critical'
+        """Applies the state triggers for `source` to a batch of events"""
+        if not isinstance(queue, EventBatch):
+            queue = EventBatch(queue)
 
-    def routeEvent(self, source, events):
+        if source in self.triggers:
+            self.triggers[source].apply(queue)
+
+    def sourceRoutes(self, source):
+        """Returns the list of output names `source` routes to"""
         routes = source.config.get('route', None)
-    
+
         if not isinstance(routes, list):
             routes = [routes]
 
+        return routes
+
+    def routeEvent(self, source, events):
+        name = source.config['service']
+        routes = self.sourceRoutes(source)
+
+        if self.limiter is None:
+            self.dispatchEvents(routes, events, name)
+            return
+
+        for route, limited in profiler.timed(self, 'service.limits',
+                self.limiter.apply, routes, name, events):
+            self.dispatchEvents([route], limited, name)
+
+    def dispatchEvents(self, routes, events, name):
+        """Buffers a batch of events on the outputs for each of `routes`
+
+        :param routes: Output names
+        :type routes: list.
+        :param events: Events to send
+        :type events: tensor.objects.EventBatch.
+        :param name: Origin of the events, for logging
+        :type name: str.
+        """
         for route in routes:
             if self.debug:
                 log.msg("Sending events %s to %s" % (events, route))
  
             if not route in self.outputs:
                 # Non existant route
-                log.msg('Could not route %s -> %s.' % (
-                    source.config['service'], route))
+                log.msg('Could not route %s -> %s.' % (name, route))
             else:
                 for output in self.outputs[route]:
-                   reactor.callLater(0, output.eventsReceived, events)
+                    if output in self.outputDedup:
+                        output.buffer.extend(
+                            self.outputDedup[output].apply(events).events)
+                    else:
+                        output.buffer.extend(events.events)
+
+                self.scheduleFlush()
+
+    def workerEvents(self, route, events):
+        """Receives a batch of events for `route` from a worker process.
+        Aggregation and triggers have already been applied by the worker.
+        """
+        self.eventCounter += len(events)
+        self.dispatchEvents([route], events, 'worker')
+
+    def scheduleFlush(self):
+        """Schedules a flush of all output buffers on the next reactor
+        iteration, unless one is already pending"""
+        if self.flushCall is None:
+            self.flushCall = reactor.callLater(0, self.flushOutputs)
+
+    def flushOutputs(self):
+        """Passes any buffered events to their outputs"""
+        self.flushCall = None
+
+        for name, outputs in self.outputs.items():
+            for output in outputs:
+                if output.buffer.size:
+                    events = EventBatch(output.buffer.drain())
+                    self.eventsOut += len(events)
+                    try:
+                        d = profiler.timed(self, 'output.%s.%s' % (
+                            name or 'default', output.__class__.__name__),
+                            output.eventsReceived, events)
+                    except Exception as e:
+                        log.msg("Output %s failed to receive events: %s" % (
+                            output.__class__.__name__, e))
+                        continue
+
+                    if isinstance(d, defer.Deferred) and not d.called:
+                        self.outputSaturated(output, d)
+
+    def outputSaturated(self, output, d):
+        """Pauses sources routed to `output` until the Deferred `d` fires"""
+        if output in self.saturated:
+            return
+
+        log.msg("Output %s is saturated, pausing sources" % (
+            output.__class__.__name__))
+
+        self.saturated.add(output)
+        self.updatePressure()
+
+        def drained(result):
+            self.saturated.discard(output)
+            self.updatePressure()
+            log.msg("Output %s has drained, resuming sources" % (
+                output.__class__.__name__))
+
+        d.addBoth(drained)
+
+    def saturatedRoutes(self):
+        """Returns the set of routes with a saturated output"""
+        return set(
+            name for name, outputs in self.outputs.items()
+            if any(output in self.saturated for output in outputs)
+        )
+
+    def updatePressure(self):
+        """Pauses or resumes sources according to which routes are
+        saturated"""
+        routes = self.saturatedRoutes()
+
+        for worker in self.workerProcesses:
+            worker.sendPressure(routes)
+
+        for source in self.sources:
+            if source.config.get('backpressure', 'skip') == 'none':
+                continue
+
+            source.paused = bool(routes.intersection(
+                self.sourceRoutes(source)))
+
+    def routePressure(self):
+        """Returns a dictionary of route name to the highest pressure (0.0
+        to 1.0) of its outputs"""
+        def pressure(output):
+            if output in self.saturated:
+                return 1.0
+            return output.pressure()
+
+        return dict(
+            (name, max([pressure(output) for output in outputs] or [0.0]))
+            for name, outputs in self.outputs.items()
+        )
 
     def sendEvent(self, source, events):
-        """Callback that all event sources call when they have a new event
-        or list of events
+        """Callback that all event sources call when they have a new event,
+        list of events or `tensor.objects.EventBatch`
         """
 
-        if isinstance(events, list):
-            self.eventCounter += len(events)
+        if isinstance(events, (list, EventBatch)):
+            events = EventBatch(events)
         else:
-            self.eventCounter += 1
-            events = [events]
-    
-        queue = self._aggregateQueue(events)
+            events = EventBatch([events])
+
+        self.eventCounter += len(events)
+
+        if self.transforms is not None:
+            events = EventBatch(profiler.timed(self, 'service.transforms',
+                self.transforms.apply, events))
+
+        queue = profiler.timed(self, 'service._aggregateQueue',
+            self._aggregateQueue, events, self.sourceInterval(source), source)
 
         if queue:
-            if (source in self.critical) or (source in self.warn):
-                self.setStates(source, queue)
+            self.processEvents(source, queue)
 
+        self.lastEvents[source] = time.time()
+
+    def processEvents(self, source, queue):
+        """Passes aggregated events from `source` through its triggers,
+        rollup and dedup stages and routes them"""
+        if queue:
+            if source in self.triggers:
+                profiler.timed(self, 'service.setStates',
+                    self.setStates, source, queue)
+
+            rollup = self.rollups.get(source)
+            if rollup is not None:
+                skipped = profiler.timed(self, 'service.rollup', rollup.add,
+                    queue)
+                if rollup.route is None:
+                    # Only events which can't be summarised go on
+                    queue = skipped
+
+        if queue and (source in self.sourceDedup):
+            queue = profiler.timed(self, 'service.dedup',
+                self.sourceDedup[source].apply, queue)
+
+        if queue:
             self.routeEvent(source, queue)
 
-        queue = []
+    def flushRollup(self, source):
+        """Sends the summaries for the window just ended for `source`"""
+        rollup = self.rollups.get(source)
+        if rollup is None:
+            return
 
-        self.lastEvents[source] = time.time()
+        events = rollup.flush()
+        if events:
+            if rollup.route is None:
+                routes = self.sourceRoutes(source)
+            else:
+                routes = [rollup.route]
+
+            self.dispatchEvents(routes, events, source.config['service'])
 
     def _startSource(self, source):
         source.startTimer()
 
+    def startSource(self, source):
+        """Starts the timer for `source`, after its start_delay if set"""
+        if self.debug:
+            log.msg("Starting source " + source.config['service'])
+
+        if 'start_delay' in source.config:
+            delay = float(source.config['start_delay'])
+            reactor.callLater(delay, self._startSource, source)
+        else:
+            delay = 0
+            self._startSource(source)
+
+        self.watchdog.add(source, delay)
+
+    def stopSource(self, source):
+        """Stops `source` and forgets its state"""
+        try:
+            source.stopTimer()
+        except Exception as e:
+            log.msg("Could not stop timer for %r: %s" % (source, e))
+
+        self.watchdog.remove(source)
+
+        if source in self.rollups:
+            # Send what there is of the current window
+            self.flushRollup(source)
+            self.rollups.pop(source).call.stop()
+
+        self.lastEvents.pop(source, None)
+        self.triggers.pop(source, None)
+        self.sourceDedup.pop(source, None)
+        self.sourceKeys.pop(source, None)
+
+        for id, entry in self.sketches.items():
+            if entry[2] is source:
+                self.sketches.delete(id)
+
+    def restartSource(self, source):
+        """Replaces `source` with a new one created from its configuration
+        and returns it"""
+        config = copy.deepcopy(source.config)
+
+        new = self.createSource(config)
+        self.setupStages(config, new)
+
+        self.stopSource(source)
+        self.sources[self.sources.index(source)] = new
+
+        self._startSource(new)
+
+        return new
+
+    def startWorker(self, index, sources):
+        worker = workers.WorkerProcess(self, index, sources)
+        worker.start()
+        self.workerProcesses.append(worker)
+
     @defer.inlineCallbacks
     def startService(self):
+        # Resolve our own name off the reactor while outputs connect,
+        # rather than on the first event which needs it
+        utils.resolveFQDN().addErrback(log.err)
+
         yield self.setupOutputs(self.config)
 
         if self.debug:
             log.msg("Starting service")
 
-        stagger = 0
-        # Start sources internal timers
+        # Start sources internal timers. The scheduler spreads them over
+        # their intervals, unless a source asks for a start_delay
         for source in self.sources:
-            if self.debug:
-                log.msg("Starting source " + source.config['service'])
-            # Stagger source timers, or use per-source start_delay
-            start_delay = float(source.config.get('start_delay', stagger))
-            reactor.callLater(start_delay, self._startSource, source)
-            stagger += self.stagger
+            self.startSource(source)
+
+        for i, sources in enumerate(self.workerSources):
+            if sources:
+                self.startWorker(i, sources)
 
-        reactor.callLater(stagger, self.startWatchdog)
+        self.expiry = task.LoopingCall(self.expireState)
+        self.expiry.start(10, now=False)
+
+        self.sketchCall = self.scheduler.add(self.flushSketches,
+            self.quantileInterval, phase=0)
+
+        self.setupSignals()
         self.running = 1
  
-    def startWatchdog(self):
-        # Start source watchdog
-        self.watchdog = task.LoopingCall(self.sourceWatchdog)
-        self.watchdog.start(10)
+    def expireState(self):
+        """Drops aggregation and dedup state for series which have not
+        been seen within their TTL"""
+        now = time.time()
+
+        self.evCache.expire(now)
+        self.sketches.expire(now)
+
+        for dedup in list(self.sourceDedup.values()) + list(
+                self.outputDedup.values()):
+            dedup.expire(now)
+
+    def setupSignals(self):
+        """Installs signal handlers, SIGHUP to reload the configuration and
+        SIGUSR2 to toggle the profiler"""
+        handlers = {
+            'SIGHUP': self.reloadConfig,
+            'SIGUSR2': self.toggleProfiler,
+        }
+
+        for name, handler in handlers.items():
+            if not hasattr(signal, name):
+                continue
+
+            signum = getattr(signal, name)
+
+            try:
+                self.previousSignals[signum] = signal.signal(signum,
+                    lambda s, f, h=handler: reactor.callFromThread(
+                        self._handleSignal, h))
+            except ValueError:
+                # Not in the main thread
+                pass
+
+    def _handleSignal(self, handler):
+        d = defer.maybeDeferred(handler)
+        d.addErrback(log.err)
+        return d
+
+    def resetSignals(self):
+        for signum, handler in self.previousSignals.items():
+            signal.signal(signum, handler)
+
+        self.previousSignals = {}
+
+    def toggleProfiler(self):
+        """Starts the profiler, or stops it and writes out the results.
+        Returns the list of files written when stopping."""
+        if self.profiler is None:
+            self.profiler = Profiler(
+                mode=self.config.get('profiler', profiler.DEFAULT_MODE),
+                path=self.config.get('profile_path', '/var/lib/tensor'),
+                interval=float(self.config.get('profile_interval', 0.005))
+            )
+
+        if self.profiler.running:
+            return self.profiler.stop()
+
+        self.profiler.start()
+        return []
+
+    @defer.inlineCallbacks
+    def reloadConfig(self, config=None):
+        """Re-reads the configuration file, or uses `config`, and applies
+        any changes to sources and outputs. Sources and outputs whose
+        configuration is unchanged keep running, along with their queues
+        and aggregation state."""
+        if config is None:
+            if not self.configFile:
+                log.msg("Can't reload configuration without a config file")
+                return
+
+            try:
+                config = yaml.safe_load(open(self.configFile, 'rt'))
+            except Exception as e:
+                log.msg("Could not reload %s: %s" % (self.configFile, e))
+                return
+
+        log.msg("Reloading configuration")
+
+        routes = set(self.outputs)
+        options = self.configKey(workers.workerOptions(self.config))
+
+        self.loadIncludes(config)
+        config.update(self.overrides)
+        self.config = config
+        self.readConfig()
 
-    def sourceWatchdog(self):
-        """Watchdog timer function. 
+        self.evCache.resize(self.aggregationMaxsize)
+        self.sketches.resize(self.aggregationMaxsize)
 
-        Recreates sources which have not generated events in 10*interval if
-        they have watchdog set to true in their configuration
-        """
-        for i, source in enumerate(self.sources):
-            if not source.config.get('watchdog', False):
-                continue 
-            sn = repr(source)
-            last = self.lastEvents.get(source, None)
-            if last:
-                try:
-                    if last < (time.time()-(source.inter*10)):
-                        log.msg("Trying to restart stale source %s: %ss" % (
-                            sn, int(time.time() - last)
-                        ))
-
-                        s = self.sources.pop(i)
-                        try:
-                            s.t.stop()
-                        except Exception as e:
-                            log.msg("Could not stop timer for %s: %s" % (
-                                sn, e))
-
-                        config = copy.deepcopy(s.config)
-
-                        del self.lastEvents[source]
-                        del s, source
-
-                        source = self.createSource(config)
-
-                        reactor.callLater(0, self._startSource, source)
-                except Exception as e:
-                    log.msg("Could not reset source %s: %s" % (
-                        sn, e))
+        if self.sketchCall and (
+                self.sketchCall.interval != self.quantileInterval):
+            self.scheduler.remove(self.sketchCall)
+            self.sketchCall = self.scheduler.add(self.flushSketches,
+                self.quantileInterval, phase=0)
+
+        yield self.reloadOutputs(config)
+
+        # Workers are told the output names and global options when they
+        # start
+        restartWorkers = (routes != set(self.outputs)) or (
+            options != self.configKey(workers.workerOptions(config)))
+
+        self.reloadSources(config, restartWorkers=restartWorkers)
+
+        self.updatePressure()
+
+    @defer.inlineCallbacks
+    def reloadOutputs(self, config):
+        """Replaces outputs whose configuration has changed"""
+        current = {}
+        for outputs in self.outputs.values():
+            for output in outputs:
+                current.setdefault(self.outputKeys.get(output), []
+                    ).append(output)
+
+        newOutputs = {}
+        added = 0
+
+        for oconf in self.outputConfigs(config):
+            key = self.configKey(oconf)
+
+            if current.get(key):
+                output = current[key].pop(0)
+            else:
+                output = self.createOutput(oconf)
+                reactor.callLater(0, output.createClient)
+                added += 1
+
+            newOutputs.setdefault(oconf.get('name', None), []).append(output)
+
+        removed = [o for outputs in current.values() for o in outputs]
+
+        if removed and self.flushCall and self.flushCall.active():
+            # Deliver what is buffered for outputs about to be removed
+            self.flushCall.cancel()
+            self.flushOutputs()
+
+        self.outputs = newOutputs
+
+        for output in removed:
+            self.saturated.discard(output)
+            self.outputKeys.pop(output, None)
+            self.outputDedup.pop(output, None)
+            yield defer.maybeDeferred(output.stop)
+
+        log.msg("Outputs: %s added, %s removed" % (added, len(removed)))
+
+    def reloadSources(self, config, restartWorkers=False):
+        """Starts, stops and restarts sources according to what has changed
+        in their configuration"""
+        current = {}
+        for source in self.sources:
+            current.setdefault(self.sourceKeys.get(source), []).append(source)
+
+        sources = []
+        added = []
+        workerSources = [[] for i in range(self.workers)]
+
+        for sconf in config.get('sources', []):
+            if self.workers:
+                worker = workers.assignWorker(sconf, self.workers)
+                if worker is not None:
+                    workerSources[worker].append(sconf)
+                    continue
+
+            key = self.configKey(self.sourceDefaults(sconf))
+
+            if current.get(key):
+                sources.append(current[key].pop(0))
+            else:
+                added.append(sconf)
+
+        removed = [s for ss in current.values() for s in ss]
+
+        # Create every new source before touching the running ones, so a
+        # bad source only loses itself
+        created = []
+        for sconf in added:
+            source = None
+            try:
+                source = self.createSource(sconf)
+                self.setupStages(sconf, source)
+            except Exception:
+                log.err(None, "Could not create source %s" % sconf.get(
+                    'service', sconf.get('source')))
+                if source is not None:
+                    self.stopSource(source)
+                continue
+
+            created.append(source)
+
+        for source in removed:
+            self.stopSource(source)
+
+        for source in created:
+            sources.append(source)
+
+            if self.running:
+                self.startSource(source)
+
+        self.sources = sources
+
+        log.msg("Sources: %s added, %s removed" % (len(created), len(removed)))
+
+        self.reloadWorkers(workerSources, restartWorkers)
+
+    def reloadWorkers(self, workerSources, restart=False):
+        """Restarts worker processes whose sources have changed"""
+        keys = lambda sources: [self.configKey(s) for s in sources]
+
+        for i in range(max(len(self.workerSources), len(workerSources))):
+            old = self.workerSources[i] if i < len(self.workerSources) else []
+            new = workerSources[i] if i < len(workerSources) else []
+
+            if (keys(old) == keys(new)) and not restart:
+                continue
+
+            for worker in [w for w in self.workerProcesses if w.index == i]:
+                worker.stop()
+                self.workerProcesses.remove(worker)
+
+            if new and self.running:
+                self.startWorker(i, new)
+
+        self.workerSources = workerSources
 
     @defer.inlineCallbacks
     def stopService(self):
         self.running = 0
 
-        if self.watchdog:
-            self.watchdog.stop()
+        self.watchdog.stop()
+
+        if self.expiry and self.expiry.running:
+            self.expiry.stop()
+
+        for source in list(self.rollups):
+            self.flushRollup(source)
+
+        self.flushSketches()
+
+        # Sources may run timers of their own besides their scheduled call
+        for source in self.sources:
+            try:
+                source.stopTimer()
+            except Exception as e:
+                log.msg("Could not stop timer for %r: %s" % (source, e))
+
+        self.scheduler.stop()
+
+        if self.profiler and self.profiler.running:
+            self.profiler.stop()
+
+        self.resetSignals()
+
+        for worker in self.workerProcesses:
+            worker.stop()
+
+        self.threadPool.stop()
+
+        if self.flushCall and self.flushCall.active():
+            # Hand anything still buffered to the outputs before they stop
+            self.flushCall.cancel()
+            self.flushOutputs()
 
         for n, outputs in self.outputs.items():
             for output in outputs:
@@ -1,46 +1,348 @@
+import gc
+import os
 import time
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 from zope.interface import implementer
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 from tensor.interfaces import ITensorSource
 from tensor.objects import Source
 
 
+def getRSS():
+    """Returns the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm', 'rt') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    if resource:
+        # Peak rather than current usage, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return None
+
+
+def getGCCollections():
+    """Returns the number of collections of each garbage collector
+    generation"""
+    if hasattr(gc, 'get_stats'):
+        return [s['collections'] for s in gc.get_stats()]
+
+    return None
+
+
 @implementer(ITensorSource)
 class Tensor(Source):
     """Reports Tensor information about numbers of checks
-    and queue sizes.
+    and queue sizes, and on its own event pipeline for sizing agents and
+    catching saturation before events are lost.
+
+    **Configuration arguments:**
+
+    :param lag_interval: How often to measure reactor loop lag in seconds
+                         (default 0.5)
+    :type lag_interval: float.
 
     **Metrics:**
 
     :(service name).event qrate: Events added to the queue per second
     :(service name).dequeue rate: Events removed from the queue per second
     :(service name).event qsize: Number of events held in the queue
+    :(service name).event rate: Events received from sources per second
+    :(service name).events out: Events passed to outputs per second
     :(service name).sources: Number of sources running
+    :(service name).evcache size: Number of series held for aggregation
+    :(service name).evcache evictions: Series evicted from a full
+                                       aggregation cache per second
+    :(service name).evcache expired: Stale series expired from the
+                                     aggregation cache per second
+    :(service name).pressure.(route): Pressure on the outputs of each route,
+                                      where 1.0 means they are saturated
+    :(service name).output.(route).queue: Events waiting in each output
+    :(service name).output.(route).age: Age in seconds of the oldest event
+                                        waiting in each output
+    :(service name).output.(route).pressure: Pressure on each output, where
+                                             1.0 means it is saturated
+    :(service name).output.(route).dedup: Fraction of events suppressed as
+                                          unchanged by an output with
+                                          `dedup` set
+    :(service name).output.(route).buffer dropped: Events lost when the
+                                                   output's buffer
+                                                   overflowed
+    :(service name).output.(route).(stat): Metrics specific to the output,
+                                           such as `dropped` and
+                                           `expired` queued events, or
+                                           `rtt`, `inflight` and
+                                           `retransmits` for Riemann TCP
+    :(service name).paused: Number of sources paused by backpressure
+    :(service name).skipped: Source ticks skipped per second due to
+                             backpressure
+    :(service name).threads queued: Calls waiting for or running in the
+                                    source thread pool
+    :(service name).threads wait: Average time calls waited for a thread
+    :(service name).threads run: Average time calls ran for in a thread
+    :(service name).source.(source).duration: Duration of the last tick
+    :(service name).source.(source).interval: Current tick interval, which
+                                              adaptive sources may back off
+    :(service name).source.(source).overruns: Ticks which took longer than
+                                              the interval
+    :(service name).source.(source).timeouts: Ticks cancelled by
+                                              `tick_timeout`
+    :(service name).source.(source).errors: Total failed ticks
+    :(service name).source.(source).dedup: Fraction of events suppressed
+                                           as unchanged by a source with
+                                           `dedup` set
+    :(service name).source.(source).restarts: Times the watchdog has
+                                              restarted the source, with a
+                                              critical state while it is
+                                              stale
+    :(service name).transforms.dropped: Events dropped by transforms
+    :(service name).limit.(name).sampled: Events dropped by sampling
+    :(service name).limit.(name).limited: Events dropped by a rate limit
+    :(service name).reactor lag: Longest delay to a timed reactor call since
+                                 the last tick
+    :(service name).rss: Resident memory in bytes
+    :(service name).gc.(generation): Garbage collections per second of each
+                                     generation
     """
 
     def __init__(self, *a):
         Source.__init__(self, *a)
 
+        self.lagInterval = float(self.config.get('lag_interval', 0.5))
+        self.lagCall = None
+        self.lagExpected = None
+        self.maxLag = 0.0
+
         self.events = self.tensor.eventCounter
+        self.eventsOut = self.tensor.eventsOut
+        self.evictions = self.tensor.evCache.evictions
+        self.expirations = self.tensor.evCache.expirations
+        self.skippedTicks = self._skipped()
+        self.threadCalls = self.tensor.threadPool.calls
+        self.threadWait = self.tensor.threadPool.waitTime
+        self.threadRun = self.tensor.threadPool.runTime
+        self.collections = getGCCollections()
         self.rtime = time.time()
 
-    def get(self):
+        # Dedup counters at the last tick
+        self.dedupCounts = {}
+
+    def startTimer(self):
+        Source.startTimer(self)
+        self._scheduleLag()
+
+    def stopTimer(self):
+        Source.stopTimer(self)
+
+        if self.lagCall and self.lagCall.active():
+            self.lagCall.cancel()
+        self.lagCall = None
+
+    def _scheduleLag(self):
+        self.lagExpected = time.time() + self.lagInterval
+        self.lagCall = reactor.callLater(self.lagInterval, self._measureLag)
+
+    def _measureLag(self):
+        self.maxLag = max(self.maxLag, time.time() - self.lagExpected)
+        self._scheduleLag()
+
+    def _skipped(self):
+        return sum(source.skipped for source in self.tensor.sources)
+
+    def _outputs(self):
+        for route, outputs in self.tensor.outputs.items():
+            name = route or 'default'
+            for i, output in enumerate(outputs):
+                if len(outputs) > 1:
+                    yield '%s.%s' % (name, i), output
+                else:
+                    yield name, output
+
+    def _dedupRatio(self, dedup):
+        seen, suppressed = self.dedupCounts.get(dedup, (0, 0))
+        self.dedupCounts[dedup] = (dedup.seen, dedup.suppressed)
+
+        if dedup.seen > seen:
+            return (dedup.suppressed - suppressed) / float(dedup.seen - seen)
+        return 0.0
+
+    def _outputEvents(self, now):
         events = []
+        tensor = self.tensor
+
+        for route, pressure in tensor.routePressure().items():
+            events.append(self.createEvent('ok',
+                'Output pressure for route %s' % route, pressure,
+                prefix="pressure.%s" % (route or 'default')))
+
+        for name, output in self._outputs():
+            prefix = "output.%s" % name
+            oldest = output.oldestEvent()
+
+            events.extend([
+                self.createEvent('ok', 'Output queue', output.queueSize(),
+                    prefix=prefix + ".queue"),
+                self.createEvent('ok', 'Oldest queued event',
+                    (now - oldest.time) if oldest else 0.0,
+                    prefix=prefix + ".age"),
+                self.createEvent('ok', 'Output pressure', output.pressure(),
+                    prefix=prefix + ".pressure"),
+            ])
+
+            for stat, value in sorted(output.stats().items()):
+                events.append(self.createEvent('ok', 'Output %s' % stat,
+                    value, prefix="%s.%s" % (prefix, stat)))
+
+            if output in tensor.outputDedup:
+                events.append(self.createEvent('ok', 'Events suppressed',
+                    self._dedupRatio(tensor.outputDedup[output]),
+                    prefix=prefix + ".dedup"))
+
+        return events
+
+    def _sourceEvents(self):
+        events = []
+        tensor = self.tensor
+
+        for source in tensor.sources:
+            prefix = "source.%s" % source.service
+            events.extend([
+                self.createEvent('ok', 'Tick duration',
+                    source.lastDuration or 0.0, prefix=prefix + ".duration"),
+                self.createEvent('ok', 'Tick interval',
+                    source.currentInterval, prefix=prefix + ".interval"),
+                self.createEvent('ok', 'Tick overruns', source.overruns,
+                    prefix=prefix + ".overruns"),
+                self.createEvent('ok', 'Tick timeouts', source.timeouts,
+                    prefix=prefix + ".timeouts"),
+                self.createEvent('ok', 'Tick errors', source.errors,
+                    prefix=prefix + ".errors"),
+            ])
+
+            if source in tensor.sourceDedup:
+                events.append(self.createEvent('ok', 'Events suppressed',
+                    self._dedupRatio(tensor.sourceDedup[source]),
+                    prefix=prefix + ".dedup"))
+
+            health = tensor.watchdog.health.get(source)
+            if health:
+                events.append(self.createEvent(
+                    'ok' if health.state == 'ok' else 'critical',
+                    'Watchdog %s' % health.state, health.restarts,
+                    prefix=prefix + ".restarts"))
+
+        if tensor.transforms:
+            events.append(self.createEvent('ok', 'Events dropped by transforms',
+                tensor.transforms.dropped, prefix="transforms.dropped"))
+
+        if tensor.limiter:
+            for limit in tensor.limiter.limits:
+                prefix = "limit.%s" % limit.name
+                events.extend([
+                    self.createEvent('ok', 'Events sampled out',
+                        limit.sampled, prefix=prefix + ".sampled"),
+                    self.createEvent('ok', 'Events rate limited',
+                        limit.limited, prefix=prefix + ".limited"),
+                ])
+
+        return events
+
+    def _processEvents(self, t_delta):
+        events = []
+
+        lag, self.maxLag = self.maxLag, 0.0
+        events.append(self.createEvent('ok', 'Reactor lag', lag,
+            prefix="reactor lag"))
+
+        rss = getRSS()
+        if rss is not None:
+            events.append(self.createEvent('ok', 'Resident memory', rss,
+                prefix="rss"))
+
+        collections = getGCCollections()
+        if collections is not None:
+            for gen, (last, count) in enumerate(
+                    zip(self.collections, collections)):
+                events.append(self.createEvent('ok',
+                    'Garbage collections of generation %s' % gen,
+                    (count - last)/t_delta, prefix="gc.%s" % gen))
+
+            self.collections = collections
+
+        return events
+
+    def get(self):
+        now = time.time()
 
         sources = len(self.tensor.sources)
 
-        t_delta = time.time() - self.rtime
+        t_delta = now - self.rtime
 
         erate = (self.tensor.eventCounter - self.events)/t_delta
+        orate = (self.tensor.eventsOut - self.eventsOut)/t_delta
 
         self.events = self.tensor.eventCounter
+        self.eventsOut = self.tensor.eventsOut
 
-        self.rtime = time.time()
-        
-        return [
+        evCache = self.tensor.evCache
+
+        evictions = (evCache.evictions - self.evictions)/t_delta
+        expirations = (evCache.expirations - self.expirations)/t_delta
+
+        self.evictions = evCache.evictions
+        self.expirations = evCache.expirations
+
+        skipped = self._skipped()
+        srate = (skipped - self.skippedTicks)/t_delta
+        self.skippedTicks = skipped
+
+        paused = len([s for s in self.tensor.sources if s.paused])
+
+        pool = self.tensor.threadPool
+        calls = pool.calls - self.threadCalls
+        if calls:
+            wait = (pool.waitTime - self.threadWait)/calls
+            run = (pool.runTime - self.threadRun)/calls
+        else:
+            wait = run = 0.0
+
+        self.threadCalls = pool.calls
+        self.threadWait = pool.waitTime
+        self.threadRun = pool.runTime
+
+        events = (self._outputEvents(now) + self._sourceEvents() +
+                  self._processEvents(t_delta))
+
+        self.rtime = now
+
+        return events + [
             self.createEvent('ok', 'Event rate', erate, prefix="event rate"),
+            self.createEvent('ok', 'Events out', orate, prefix="events out"),
             self.createEvent('ok', 'Sources', sources, prefix="sources"),
+            self.createEvent('ok', 'Aggregation cache size', len(evCache),
+                prefix="evcache size"),
+            self.createEvent('ok', 'Aggregation cache evictions',
+                evictions, prefix="evcache evictions"),
+            self.createEvent('ok', 'Aggregation cache expired',
+                expirations, prefix="evcache expired"),
+            self.createEvent('ok', 'Paused sources', paused,
+                prefix="paused"),
+            self.createEvent('ok', 'Skipped ticks', srate,
+                prefix="skipped"),
+            self.createEvent('ok', 'Thread pool calls queued', pool.pending,
+                prefix="threads queued"),
+            self.createEvent('ok', 'Thread pool wait time', wait,
+                prefix="threads wait"),
+            self.createEvent('ok', 'Thread pool run time', run,
+                prefix="threads run"),
         ]
@@ -19,6 +19,9 @@ class LoadAverage(Source):
     :(service name): Load average
     """
 
+    # Reads /proc directly, so keep it off the reactor
+    executor = 'thread'
+
     def _parse_loadaverage(self, data):
         la1 = data.split()[0]
 
@@ -56,6 +59,8 @@ class DiskIO(Source):
     :(service name).(device name).write_latency: Disk write latency
     """
 
+    executor = 'thread'
+
     def __init__(self, *a, **kw):
         Source.__init__(self, *a, **kw)
 
@@ -173,6 +178,8 @@ class CPU(Source):
     :(service name).(type): Percentage CPU utilisation by type
     """
 
+    executor = 'thread'
+
     cols = ['user', 'nice', 'system', 'idle', 'iowait', 'irq',
         'softirq', 'steal', 'guest', 'guest_nice']
 
@@ -259,6 +266,8 @@ class Memory(Source):
     :(service name): Percentage memory utilisation
     """
 
+    executor = 'thread'
+
     def _parse_stats(self, mem):
         dat = {}
         for l in mem:
@@ -352,6 +361,8 @@ class Network(Source):
     :(service name).(device).rx_errors: Errors
     """
 
+    executor = 'thread'
+
     def _parse_stats(self, stats):
         ifaces = self.config.get('interfaces')
         ev = []
@@ -17,7 +17,7 @@ from tensor.interfaces import ITensorSource
 from tensor.objects import Source
 
 from tensor.utils import HTTPRequest, fork
-from tensor.aggregators import Counter64
+from tensor.aggregators import Counter64, DDSketch, Quantiles
 from tensor.logs import parsers, follower
 
 @implementer(ITensorSource)
@@ -112,11 +112,17 @@ class NginxLogMetrics(Source):
     :(service name).user-agent.(agent).(requests|rbytes): Metrics by user agent
     :(service name).client.(ip).(requests|rbytes): Metrics by client IP
     :(service name).request.(request path).(requests|rbytes): Metrics by request path
+    :(service name).request_time.(p50|p90|p99|max): Request time quantiles,
+                                                    if the log format has
+                                                    %D or %T
     """
 
     # Don't allow overlapping runs
     sync = True
 
+    # Log backlogs can take a while to read
+    executor = 'thread'
+
     def __init__(self, *a):
         Source.__init__(self, *a)
 
@@ -131,6 +137,7 @@ class NginxLogMetrics(Source):
         self.bucket_res = int(self.config.get('resolution', 10))
 
         self.bucket = 0
+        self.requestTimes = DDSketch()
 
     def _aggregate_fields(self, row, b, field, fil=None):
         f = row.get(field, None)
@@ -167,9 +174,16 @@ class NginxLogMetrics(Source):
                             prefix='%s.%s.requests' % (field, key), evtime=ts)
                     ])
 
+            if self.requestTimes.count:
+                for suffix, metric in Quantiles(self.requestTimes):
+                    events.append(self.createEvent('ok',
+                        'Nginx request time %s' % suffix, metric,
+                        prefix='request_time.%s' % suffix, evtime=ts))
+
             self.st = {}
             self.rbytes = 0
             self.requests = 0
+            self.requestTimes = DDSketch()
 
             self.queueBack(events)
 
@@ -192,6 +206,10 @@ class NginxLogMetrics(Source):
         else:
             self.bucket = bucket
 
+        rt = line.get('request-time')
+        if rt is not None:
+            self.requestTimes.add(rt)
+
         self._aggregate_fields(line, b, 'status')
         self._aggregate_fields(line, b, 'client')
         self._aggregate_fields(line, b, 'user-agent',
@@ -205,6 +223,7 @@ class NginxLogMetrics(Source):
         self.rbytes = 0
         self.requests = 0
         self.st = {}
+        self.requestTimes = DDSketch()
 
         self.log.get_fn(self.got_line, max_lines=self.max_lines)
 
@@ -231,6 +250,9 @@ class NginxLog(Source):
     # Don't allow overlapping runs
     sync = True
 
+    # Log backlogs can take a while to read
+    executor = 'thread'
+
     def __init__(self, *a):
         Source.__init__(self, *a)
 
@@ -0,0 +1,36 @@
+from twisted.trial import unittest
+
+from tensor import benchmark
+
+
+class Tests(unittest.TestCase):
+    def test_benchmark(self):
+        options = benchmark.parseArgs(['--sources', '2', '--series', '20',
+            '--duration', '0.1', '--triggers'])
+
+        results = benchmark.benchmark(options)
+
+        self.assertTrue(results['events_per_second'] > 0)
+        self.assertTrue(results['p99_latency_ms'] > 0)
+        if results['peak_bytes_per_event'] is not None:
+            self.assertTrue(results['peak_bytes_per_event'] > 0)
+
+    def test_compare(self):
+        baseline = {'events_per_second': 1000.0, 'p99_latency_ms': 1.0,
+            'peak_rss_mb': 50.0}
+        results = {'events_per_second': 800.0, 'p99_latency_ms': 1.05,
+            'peak_rss_mb': 40.0, 'peak_bytes_per_event': 10.0}
+
+        rows = dict((r[0], r[3:]) for r in benchmark.compare(results,
+            baseline, tolerance=0.1))
+
+        self.assertEqual(rows['events_per_second'], (-0.2, True))
+        self.assertFalse(rows['p99_latency_ms'][1])
+        self.assertFalse(rows['peak_rss_mb'][1])
+        self.assertNotIn('peak_bytes_per_event', rows)
+
+    def test_percentile(self):
+        samples = [(1, 98), (5, 1), (10, 1)]
+        self.assertEqual(benchmark.percentile(samples, 0.5), 1)
+        self.assertEqual(benchmark.percentile(samples, 0.99), 5)
+        self.assertEqual(benchmark.percentile(samples, 1.0), 10)
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.trial import unittest
+
+from tensor.objects import Event, Source
+from tensor.profiler import Profiler
+from tensor.service import TensorService
+
+
+def busy(seconds):
+    t = time.time()
+    while time.time() - t < seconds:
+        pass
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_sampler(self):
+        profiler = Profiler('sample', self.path, interval=0.001)
+
+        profiler.start()
+        profiler.timed('source.busy.get', busy, 0.1)
+        files = profiler.stop()
+
+        self.assertEqual([os.path.splitext(f)[1] for f in files],
+                         ['.folded', '.sections'])
+
+        folded = open(files[0]).read()
+        self.assertIn('source.busy.get;', folded)
+        self.assertIn('test_profiler.py:busy', folded)
+
+        sections = open(files[1]).read()
+        self.assertIn('source.busy.get 1 ', sections)
+
+    def test_dump_names(self):
+        service = TensorService({'profile_path': self.path})
+        service.toggleProfiler()
+        self.assertEqual(service.profiler.mode, 'sample')
+        service.toggleProfiler()
+
+        profiler = Profiler(path=self.path, interval=0.001)
+        self.assertEqual(profiler.mode, 'sample')
+
+        # Toggled twice within a second
+        profiler.start()
+        first = profiler.stop()
+        profiler.start()
+        second = profiler.stop()
+
+        self.assertEqual(len(set(first + second)), 4)
+        self.assertEqual(len(os.listdir(self.path)), 6)
+
+    def test_service_toggle(self):
+        service = TensorService({'profiler': 'cprofile',
+                                 'profile_path': self.path})
+
+        self.assertEqual(service.toggleProfiler(), [])
+        self.assertTrue(service.profiler.running)
+
+        source = Source({'service': 'test', 'interval': 1.0, 'ttl': 60.0,
+                         'hostname': 'localhost'}, service.sendEvent, service)
+
+        service.sendEvent(source, Event('ok', 'test', 'test', 1.0, 60.0,
+            hostname='localhost'))
+
+        files = service.toggleProfiler()
+        self.assertFalse(service.profiler.running)
+
+        self.assertEqual([os.path.splitext(f)[1] for f in files],
+                         ['.prof', '.txt', '.sections'])
+
+        sections = open(files[2]).read()
+        self.assertIn('service._aggregateQueue 1 ', sections)
@@ -0,0 +1,152 @@
+from twisted.trial import unittest
+
+from twisted.internet import defer, task
+
+from tensor.objects import Source
+from tensor.scheduler import Scheduler, TimerHeap
+
+
+class FakeSource(Source):
+    def get(self):
+        return self.createEvent('ok', 'Test', 1)
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.scheduler = Scheduler(self.clock)
+
+    def test_timer_heap(self):
+        due = []
+        timers = TimerHeap(lambda item, now: due.append((item, now)),
+            self.clock)
+
+        timers.push('a', 1005)
+        timers.push('b', 1002)
+        timers.push('c', 1003)
+
+        # Only the latest entry for an item counts
+        timers.push('b', 1004)
+        timers.discard('c')
+
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(4)
+        self.assertEqual(due, [('b', 1004)])
+
+        self.clock.advance(1)
+        self.assertEqual(due, [('b', 1004), ('a', 1005)])
+
+        timers.discard('a')
+        timers.discard('b')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_phases(self):
+        calls = [self.scheduler.add(lambda: None, 10) for i in range(8)]
+
+        phases = sorted(c.phase for c in calls)
+
+        # Spread over the interval with no two close together
+        self.assertEqual(len(set(phases)), 8)
+        gaps = [b - a for a, b in zip(phases, phases[1:])]
+        self.assertTrue(min(gaps) > 0.5)
+
+        for c in calls:
+            # Aligned to wall clock time
+            self.assertAlmostEqual(c.next % 10, c.phase)
+            self.assertTrue(1000 < c.next <= 1010)
+
+        self.assertEqual(len(self.scheduler.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(10)
+        self.assertEqual([c.calls for c in calls], [1] * 8)
+
+        self.clock.advance(10)
+        self.assertEqual([c.calls for c in calls], [2] * 8)
+
+    def test_no_overlap(self):
+        d = defer.Deferred()
+        call = self.scheduler.add(lambda: d, 5, phase=0)
+
+        self.clock.advance(5)
+        self.assertEqual(call.calls, 1)
+
+        # Still waiting on the first call
+        self.clock.advance(5)
+        self.assertEqual(call.calls, 1)
+        self.assertEqual(call.missed, 1)
+
+        d.callback(None)
+        self.clock.advance(5)
+        self.assertEqual(call.calls, 2)
+
+    def test_catchup(self):
+        skip = self.scheduler.add(lambda: None, 5, phase=0)
+        burst = self.scheduler.add(lambda: None, 5, phase=0,
+            catchup='burst')
+
+        self.clock.advance(5)
+
+        # Reactor held up past the next two slots
+        self.clock.rightNow += 15
+        self.clock.advance(0)
+        self.clock.advance(0)
+
+        self.assertEqual(skip.calls, 2)
+        self.assertEqual(skip.missed, 2)
+        self.assertEqual(burst.calls, 4)
+
+        # Back on the grid
+        self.assertEqual(skip.next, 1025)
+
+    def test_stop(self):
+        call = self.scheduler.add(lambda: None, 5)
+        d = call.deferred
+
+        call.stop()
+
+        self.assertTrue(d.called)
+        self.assertFalse(call.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.clock.advance(10)
+        self.assertEqual(call.calls, 0)
+
+    def test_errors(self):
+        def fail():
+            raise ValueError()
+
+        call = self.scheduler.add(fail, 5, phase=0)
+
+        self.clock.advance(5)
+        self.clock.advance(5)
+
+        self.assertEqual(call.calls, 2)
+        self.assertTrue(call.running)
+
+    def test_source_timer(self):
+        events = []
+
+        class FakeTensor(object):
+            scheduler = self.scheduler
+
+        source = FakeSource({
+            'service': 'test',
+            'interval': 2.0,
+            'ttl': 60,
+            'hostname': 'localhost',
+            'jitter': 0.5,
+        }, lambda s, e: events.append(e), FakeTensor())
+
+        source.startTimer()
+        self.assertIs(source.td, source.t.deferred)
+
+        self.clock.advance(2.5)
+        self.assertEqual(len(events), 1)
+
+        source.stopTimer()
+        self.assertEqual(len(self.scheduler), 0)
+
+        self.clock.advance(10)
+        self.assertEqual(len(events), 1)
@@ -1,15 +1,32 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
 from twisted.trial import unittest
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet.protocol import ServerFactory
 from twisted.protocols.basic import Int32StringReceiver
 
 from tensor.ihateprotobuf import proto_pb2
-from tensor.objects import Event, Source, Output
+from tensor.objects import Event, EventBatch, Source, Output
 from tensor.protocol.riemann import RiemannClientFactory
+from tensor.outputs.riemann import RiemannTCP
+from tensor import service as service_module
 from tensor.service import TensorService
-from tensor.aggregators import Counter32, Counter64, Counter
+from tensor import aggregators
+from tensor.aggregators import Counter32, Counter64, Counter, DDSketch, Quantiles
+from tensor.triggers import Triggers, compileExpression
+from tensor import workers
+from tensor.sources import Tensor
+from tensor.watchdog import Watchdog
+from tensor.limits import Limiter, sampleHash
+from tensor.transforms import Transforms
+from tensor.rollup import Rollup
 
 
 def wait(secs):
@@ -80,6 +97,14 @@ class FakeRiemannServerFactory(ServerFactory):
 class FakeSource(Source):
     pass
 
+class SlowSource(Source):
+    delay = 0.2
+
+    def get(self):
+        d = defer.Deferred()
+        reactor.callLater(self.delay, d.callback, None)
+        return d
+
 class FakeOutput(Output):
     def __init__(self, *a):
         Output.__init__(self, *a)
@@ -155,6 +180,9 @@ class TestService(unittest.TestCase):
         [event] = msg.events
         self.assertEqual(event.description, 'Sky has not fallen')
 
+        # Let the ack arrive, so nothing is sent again
+        yield wait(0.1)
+
         # Disconnect and hope we reconnect
         [output] = service.outputs[None]
         yield output.connector.disconnect()
@@ -169,6 +197,63 @@ class TestService(unittest.TestCase):
         [event] = msg.events
         self.assertEqual(event.description, 'Sky has not fallen')
 
+    @defer.inlineCallbacks
+    def test_service_retransmits_unacked(self):
+        self.patch(RiemannClientFactory, 'initialDelay', 0.1)
+        factory = yield self.start_riemann_server()
+        service = self.make_service({"port": factory.get_host().port})
+        yield service.startService()
+
+        [output] = service.outputs[None]
+        source = self.make_source(service)
+        service.sendEvent(source, Event('ok', 'sky', 'Sky has not fallen',
+            1.0, 60.0, hostname='localhost'))
+        yield factory.wait_for_messages(1)
+
+        # Lose the connection before the ack arrives
+        self.assertEqual(output.factory.proto.pressure, 1)
+        yield output.connector.disconnect()
+
+        [msg1, msg2] = yield factory.wait_for_messages(2)
+        self.assertEqual(msg1, msg2)
+
+        yield wait(0.1)
+        stats = output.stats()
+        self.assertEqual(stats['inflight'], 0)
+        self.assertEqual(stats['retransmits'], 1)
+        self.assertTrue(stats['rtt'] > 0)
+
+    def test_riemann_window(self):
+        output = RiemannTCP({'window_bytes': 200, 'batch': 2}, None)
+        output.factory = RiemannClientFactory('localhost')
+        proto = output.factory.buildProtocol(None)
+        sent = []
+        proto.sendString = sent.append
+
+        output.eventsReceived([
+            Event('ok', 'sky.%s' % i, 'Sky has not fallen', 1.0, 60.0,
+                  hostname='localhost')
+            for i in range(10)
+        ])
+
+        # Two messages of two events fill the byte window
+        output.emptyQueue()
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(len(output.events), 6)
+
+        proto.stringReceived(proto_pb2.Msg(ok=True).SerializeToString())
+        self.assertEqual(proto.inflightBytes, len(sent[1]))
+        output.emptyQueue()
+        self.assertEqual(len(sent), 3)
+
+        # At most three messages awaiting acknowledgement
+        output.windowBytes = 0
+        output.maxPressure = 2
+        output.emptyQueue()
+        self.assertEqual(len(sent), 4)
+        self.assertEqual(proto.pressure, 3)
+        self.assertEqual(len(output.events), 2)
+
     def _aggregator_test(self, m1, m2, aggregator, delta):
         service = self.make_service({})
 
@@ -208,6 +293,154 @@ class TestService(unittest.TestCase):
         metric = self._aggregator_test(18446744073709551610, 5, Counter64, 4)
         self.assertEqual(metric, 2.5)
 
+    def test_aggregate_counter_backoff(self):
+        service = self.make_service({})
+        source = Source({'service': 'test', 'interval': 1.0, 'ttl': 1.0,
+                         'adaptive': True, 'hostname': 'localhost'},
+                        service.sendEvent, service)
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output]}
+
+        clock = task.Clock()
+        clock.advance(1000)
+        self.patch(service_module.time, 'time', clock.seconds)
+
+        # Backed off from ticking every second to every 8
+        source.setInterval = lambda interval: setattr(
+            source, 'currentInterval', interval)
+        for i in range(3):
+            source._tickDone(5.0)
+        self.assertEqual(source.currentInterval, 8.0)
+
+        for metric in (100, 900):
+            service.sendEvent(source, source.createEvent('ok', 'Counter',
+                metric, evtime=clock.seconds(), aggregation=Counter64))
+            clock.advance(8)
+
+        [event] = output.buffer.drain()
+        self.assertEqual(event.metric, 100.0)
+
+    def _batch_aggregator_test(self):
+        last = [1, 4294967290, 18446744073709551610, 10, 2.5, 100]
+        current = [2, 5, 5, 4, 5.0, 100]
+        deltas = [4, 4, 4, 4, 1, 0]
+
+        for aggregator, batch in [(Counter32, aggregators.Counter32Batch),
+                                  (Counter64, aggregators.Counter64Batch),
+                                  (Counter, aggregators.CounterBatch)]:
+            # Mixed types and value ranges take the slow path, so repeat
+            # each case on its own as well
+            cases = [(last, current, deltas)] + [
+                ([a] * 100, [b] * 100, [d] * 100)
+                for a, b, d in zip(last, current, deltas)
+            ]
+
+            for a, b, d in cases:
+                expected = [
+                    aggregator(x, y, t) if t > 0 else None
+                    for x, y, t in zip(a, b, d)
+                ]
+                self.assertEqual(batch(a, b, d), expected)
+
+    def test_aggregate_batch(self):
+        self._batch_aggregator_test()
+
+    def test_aggregate_batch_without_numpy(self):
+        self.patch(aggregators, 'numpy', None)
+        self._batch_aggregator_test()
+
+    def test_aggregate_queue_batch(self):
+        service = self.make_service({})
+
+        def events(m, t):
+            evs = [
+                Event('ok', 'num.%s' % i, 'Number', m, 60.0,
+                      hostname='localhost', aggregation=Counter64, evtime=t)
+                for i in range(100)
+            ]
+            evs.append(Event('ok', 'gauge', 'Gauge', 1, 60.0,
+                             hostname='localhost', evtime=t))
+            return evs
+
+        self.assertEqual(len(service._aggregateQueue(events(10, 1))), 1)
+
+        queue = service._aggregateQueue(events(30, 5))
+        self.assertEqual(len(queue), 101)
+        self.assertEqual(set(queue.metric[:100]), set([5.0]))
+        self.assertEqual(queue[-1].metric, 1)
+
+    def test_quantile_sketch(self):
+        a = DDSketch(accuracy=0.01)
+        b = DDSketch(accuracy=0.01)
+
+        for i in range(1, 1001):
+            (a if i % 2 else b).add(i)
+        a.merge(b)
+
+        self.assertEqual(a.count, 1000)
+        self.assertEqual(a.max, 1000)
+        for q, expected in [(0.5, 500), (0.9, 900), (0.99, 990)]:
+            self.assertTrue(abs(a.quantile(q) - expected) <= expected * 0.01)
+
+        # Memory stays bounded
+        small = DDSketch(maxBins=10)
+        for i in range(1, 10000):
+            small.add(i)
+        self.assertTrue(len(small.positive) <= 10)
+        self.assertEqual(small.quantile(1.0), 9999)
+
+    def test_aggregate_quantiles(self):
+        service = self.make_service({})
+        source = self.make_source(service)
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output]}
+
+        # One sample per tick, as from an HTTP or Ping source
+        for m in range(1, 101):
+            service.sendEvent(source, [
+                Event('ok', 'latency', 'Latency', m, 60.0,
+                      hostname='localhost', aggregation=Quantiles),
+                Event('ok', 'gauge', 'Gauge', 1, 60.0,
+                      hostname='localhost'),
+            ])
+
+        self.assertEqual(set(e.service for e in output.buffer.drain()),
+            set(['gauge']))
+
+        service.flushSketches()
+        metrics = dict((e.service, e.metric) for e in output.buffer.drain())
+
+        self.assertEqual(sorted(metrics), ['latency.max',
+            'latency.p50', 'latency.p90', 'latency.p99'])
+        self.assertEqual(metrics['latency.max'], 100)
+        self.assertTrue(abs(metrics['latency.p90'] - 90) < 1)
+
+        # Each flush covers the samples since the last one
+        service.flushSketches()
+        self.assertEqual(len(output.buffer), 0)
+
+        service.sendEvent(source, Event('ok', 'latency', 'Latency', 5,
+            60.0, hostname='localhost', aggregation=Quantiles))
+        service.flushSketches()
+        metrics = dict((e.service, e.metric) for e in output.buffer.drain())
+        self.assertEqual(metrics['latency.max'], 5)
+
+        service.stopSource(source)
+        self.assertEqual(len(service.sketches), 0)
+
+    def test_aggregate_cache_bounded(self):
+        service = self.make_service({'aggregation_maxsize': 10})
+
+        for i in range(20):
+            ev = Event('ok', 'num.%s' % i, 'Number', i, 60.0,
+                hostname='localhost', aggregation=Counter)
+            service._aggregateQueue([ev])
+
+        self.assertEqual(len(service.evCache), 10)
+        self.assertEqual(service.evCache.evictions, 10)
+        self.assertTrue('localhost.num.19' in service.evCache)
+        self.assertFalse('localhost.num.0' in service.evCache)
+
     def test_state_match(self):
         service = self.make_service({
             'interval': 1.0, 'ttl': 60.0, 
@@ -232,6 +465,33 @@ class TestService(unittest.TestCase):
         self.assertEqual(ev2.state, 'critical')
         self.assertEqual(ev3.state, 'warning')
 
+    def test_trigger_expressions(self):
+        self.assertTrue(compileExpression('> 500')(501))
+        self.assertFalse(compileExpression('> 500')(500))
+        self.assertTrue(compileExpression('<= 0.5')(0.5))
+        self.assertTrue(compileExpression('!= 1')(2))
+
+        # Compound expressions fall back to evaluation
+        between = compileExpression('> 1 and service < 10')
+        self.assertTrue(between(5))
+        self.assertFalse(between(11))
+
+    def test_trigger_match_cache(self):
+        triggers = Triggers(
+            warning={'network.\\w+.tx_bytes': '> 100'},
+            critical={'network.\\w+.tx_bytes': '> 500'}
+        )
+
+        warning, critical = triggers.match('network.foo.tx_bytes')
+        self.assertEqual(len(warning), 1)
+        self.assertEqual(len(critical), 1)
+        self.assertEqual(triggers.match('network.foo.rx_bytes'), ((), ()))
+        self.assertEqual(len(triggers.cache), 2)
+
+        # Cached services are not matched again
+        triggers.warning = []
+        self.assertEqual(len(triggers.match('network.foo.tx_bytes')[0]), 1)
+
     @defer.inlineCallbacks
     def test_source_routing(self):
         service = self.make_service({
@@ -260,6 +520,8 @@ class TestService(unittest.TestCase):
         yield wait(0.2)
 
         self.assertEqual(len(output1.events), 1)
+        self.assertIsInstance(output1.events, EventBatch)
+        self.assertEqual(output1.events.metric, [1])
         self.assertEqual(output2.events, None)
        
         output1.events = None
@@ -271,3 +533,773 @@ class TestService(unittest.TestCase):
 
         self.assertEqual(len(output1.events), 1)
         self.assertEqual(len(output2.events), 1)
+
+    @defer.inlineCallbacks
+    def test_output_buffer_flush(self):
+        service = self.make_service({})
+        source = self.make_source(service)
+
+        output = FakeOutput({'buffer_size': 3}, service)
+        calls = []
+        output.eventsReceived = calls.append
+        service.outputs = {None: [output]}
+
+        for i in range(4):
+            service.sendEvent(source, Event('ok', 'load', 'load', i, 1,
+                hostname='localhost'))
+
+        # All events are buffered until a single flush
+        self.assertEqual(calls, [])
+        self.assertEqual(len(output.buffer), 3)
+
+        yield wait(0.1)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0].metric, [0, 1, 2])
+        self.assertEqual(output.buffer.dropped, 1)
+        self.assertEqual(output.stats()['buffer dropped'], 1)
+
+    def test_dedup(self):
+        service = self.make_service({})
+        source = self.make_source(service)
+        service.setupStages({'dedup': True, 'dedup_heartbeat': 0.5}, source)
+
+        output = FakeOutput({}, service)
+        dedupOutput = service.createOutput({
+            'output': 'tensor.tests.test_service.FakeOutput', 'dedup': True})
+        service.outputs = {None: [output], 'dedup': [dedupOutput]}
+
+        dedup = service.sourceDedup[source]
+
+        def send(metric, state, now):
+            events = EventBatch([Event(state, 'load', 'load', metric, 10,
+                hostname='localhost')])
+            return dedup.apply(events, now).metric
+
+        self.assertEqual(send(1, 'ok', 100), [1])
+        self.assertEqual(send(1, 'ok', 101), [])
+        self.assertEqual(send(2, 'ok', 102), [2])
+        self.assertEqual(send(2, 'critical', 103), [2])
+
+        # Heartbeat after half the TTL
+        self.assertEqual(send(2, 'critical', 107), [])
+        self.assertEqual(send(2, 'critical', 108), [2])
+
+        self.assertEqual(dedup.seen, 6)
+        self.assertEqual(dedup.suppressed, 2)
+
+        # Log lines all have the same metric and state
+        logs = EventBatch([source.createLog('log', 'line %s' % i)
+                           for i in range(5)])
+        self.assertEqual(len(dedup.apply(logs, 110)), 5)
+
+        for i in range(3):
+            service.sendEvent(source, Event('ok', 'disk', 'disk', 5, 60,
+                hostname='localhost'))
+        self.assertEqual(len(output.buffer), 1)
+
+        service.dispatchEvents(['dedup'], EventBatch([
+            Event('ok', 'disk', 'disk', 5, 60, hostname='localhost'),
+            Event('ok', 'disk', 'disk', 5, 60, hostname='localhost'),
+        ]), 'test')
+        self.assertEqual(len(dedupOutput.buffer), 1)
+
+    def test_rollup(self):
+        service = self.make_service({})
+        source = self.make_source(service)
+
+        output = FakeOutput({}, service)
+        summaries = FakeOutput({}, service)
+        service.outputs = {None: [output], 'summaries': [summaries]}
+
+        service.setupStages({'rollup': 60}, source)
+        self.assertEqual(service.rollups[source].call.phase, 0)
+
+        for metric, state in [(3, 'ok'), (1, 'critical'), (2, 'ok')]:
+            service.sendEvent(source, Event(state, 'load', 'load', metric,
+                10, hostname='localhost'))
+
+        # Raw events are held back
+        self.assertEqual(len(output.buffer), 0)
+
+        service.flushRollup(source)
+
+        events = dict((e.service, e) for e in output.buffer.drain())
+        self.assertEqual(
+            dict((k, e.metric) for k, e in events.items()),
+            {'load.min': 1, 'load.max': 3, 'load.avg': 2.0,
+             'load.count': 3, 'load.sum': 6, 'load.last': 2})
+        self.assertEqual(events['load.max'].state, 'critical')
+        self.assertEqual(events['load.max'].ttl, 120)
+
+        # Alerts without a metric aren't held back
+        service.sendEvent(source, Event('critical', 'disk', 'Disk failed',
+            None, 10, hostname='localhost'))
+        [alert] = output.buffer.drain()
+        self.assertEqual(alert.state, 'critical')
+        self.assertEqual(len(service.rollups[source]), 0)
+
+        # With a rollup route raw events pass through as well
+        service.stopSource(source)
+        self.assertEqual(service.rollups, {})
+
+        service.setupStages({'rollup': 60, 'rollup_route': 'summaries',
+            'rollup_functions': ['max']}, source)
+        service.sendEvent(source, Event('ok', 'load', 'load', 1, 10,
+            hostname='localhost'))
+        service.flushRollup(source)
+
+        self.assertEqual(len(output.buffer), 1)
+        self.assertEqual([e.service for e in summaries.buffer.drain()],
+            ['load.max'])
+
+        # Quantiles from a sketch
+        service.stopSource(source)
+        service.setupStages({'rollup': 60, 'rollup_functions': ['p50', 'p99']},
+            source)
+        for i in range(1, 201):
+            service.sendEvent(source, Event('ok', 'load', 'load', i, 10,
+                hostname='localhost'))
+        service.flushRollup(source)
+
+        events = dict((e.service, e.metric) for e in output.buffer.drain())
+        self.assertTrue(abs(events['load.p50'] - 100) <= 1)
+        self.assertTrue(abs(events['load.p99'] - 198) <= 2)
+
+    def test_rollup_quantile_names(self):
+        rollup = Rollup(60, ['p05', 'p50', 'p99', 'p999'])
+        self.assertEqual(rollup.quantiles,
+            {'p05': 0.05, 'p50': 0.5, 'p99': 0.99, 'p999': 0.999})
+
+        for name in ('p5', 'p100', 'p500', 'p', 'p1x'):
+            self.assertRaises(ValueError, Rollup, 60, [name])
+
+    def test_limits(self):
+        limiter = Limiter([
+            {'route': None, 'rate': 2, 'burst': 3},
+            {'source': 'nginx', 'prefix': 'nginx.client.', 'sample': 0.5,
+             'name': 'clients'},
+        ])
+
+        def batch(service, n, state='ok'):
+            return EventBatch([Event(state, '%s.%s' % (service, i), '', 1,
+                60, hostname='localhost') for i in range(n)])
+
+        def apply(route, source, events, now=None):
+            result = dict(limiter.apply([route], source, events, now))
+            return result.get(route, [])
+
+        # Burst, then refilled at the rate
+        self.assertEqual(len(apply(None, 'cpu', batch('cpu', 5), 10)), 3)
+        self.assertEqual(len(apply(None, 'cpu', batch('cpu', 5), 11)), 2)
+        self.assertEqual(limiter.limits[0].limited, 5)
+
+        # Non-ok states are exempt
+        self.assertEqual(len(apply(None, 'cpu',
+            batch('cpu', 5, 'critical'), 11)), 5)
+
+        # Other routes aren't rate limited
+        self.assertEqual(len(apply('other', 'cpu', batch('cpu', 50))), 50)
+
+        # Sampling keeps whole series, only for matching services
+        events = batch('nginx.client', 1000)
+        kept = apply('other', 'nginx', events)
+        self.assertTrue(400 < len(kept) < 600)
+        self.assertEqual(
+            [e.service for e in apply('other', 'nginx', events)],
+            [e.service for e in kept])
+        for e in kept:
+            self.assertTrue(sampleHash(e.id()) < 0.5)
+
+        self.assertEqual(len(apply('other', 'nginx',
+            batch('nginx.server', 10))), 10)
+        self.assertEqual(limiter.limits[1].name, 'clients')
+
+        service = self.make_service({'limits': [{'rate': 1}]})
+        source = self.make_source(service)
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output]}
+
+        service.sendEvent(source, batch('load', 3))
+        self.assertEqual(len(output.buffer), 1)
+
+    def test_limits_charging(self):
+        def batch(n):
+            return EventBatch([Event('ok', 'cpu.%s' % i, '', 1, 60,
+                hostname='localhost') for i in range(n)])
+
+        # A limit without a route is charged once per event, not per route
+        limiter = Limiter([{'rate': 1, 'burst': 3}])
+        result = limiter.apply(['a', 'b'], 'cpu', batch(5), 10)
+        self.assertEqual([(r, len(e)) for r, e in result], [('a', 3), ('b', 3)])
+        self.assertEqual(limiter.limits[0].limited, 2)
+
+        # Events another policy drops don't take tokens
+        limiter = Limiter([
+            {'route': 'a', 'rate': 1, 'burst': 1000},
+            {'route': 'a', 'sample': 0.5},
+        ])
+        [(route, kept)] = limiter.apply(['a'], 'cpu', batch(100), 10)
+        self.assertEqual(limiter.limits[0].bucket.tokens, 1000 - len(kept))
+        self.assertEqual(limiter.limits[1].sampled, 100 - len(kept))
+
+    def test_transforms(self):
+        transforms = Transforms([
+            {'match': 'nginx.client.**', 'drop': True},
+            {'match': '*.user-agent.**', 'drop': True},
+            {'match': 'cpu.**', 'rename': 'system.cpu'},
+            {'match': 'net.eth?.*', 'tags': ['nic']},
+            {'match': '**', 'attributes': {'dc': 'jhb'}},
+        ])
+
+        def event(service):
+            return Event('ok', service, '', 1, 60, hostname='localhost')
+
+        self.assertTrue(transforms.match('nginx.client.10.0.0.1.requests').drop)
+        self.assertTrue(transforms.match('web.user-agent.curl').drop)
+        self.assertFalse(transforms.match('user-agent.curl').drop)
+        self.assertEqual(transforms.match('cpu.user').service, 'system.cpu.user')
+        self.assertEqual(transforms.match('cpu').service, 'system.cpu')
+        self.assertEqual(transforms.match('net.eth0.rx').tags, ['nic'])
+        self.assertEqual(transforms.match('net.lo.rx').tags, [])
+
+        tags = ['shared']
+        events = [event('cpu.user'), event('nginx.client.1.2.3.4.requests'),
+                  event('net.eth1.tx')]
+        events[2].tags = tags
+
+        result = transforms.apply(events)
+        self.assertEqual([e.service for e in result],
+            ['system.cpu.user', 'net.eth1.tx'])
+        self.assertEqual(result[1].tags, ['shared', 'nic'])
+        self.assertEqual(tags, ['shared'])
+        self.assertEqual(result[0].attributes, {'dc': 'jhb'})
+        self.assertEqual(transforms.dropped, 1)
+
+        # With keep rules, anything else is dropped
+        keep = Transforms([{'match': 'web.*', 'keep': True}])
+        self.assertEqual([e.service for e in keep.apply(
+            [event('web.latency'), event('db.latency')])], ['web.latency'])
+
+        service = self.make_service({'transforms': [
+            {'match': 'load.**', 'drop': True}]})
+        source = self.make_source(service)
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output]}
+
+        service.sendEvent(source, [event('load.1'), event('mem')])
+        self.assertEqual([e.service for e in output.buffer.drain()], ['mem'])
+        self.assertIn(source, service.lastEvents)
+
+    def test_output_pressure(self):
+        output = FakeOutput({'highwater': 0.8, 'lowwater': 0.5}, None)
+
+        self.assertEqual(output.checkPressure(7, 10), None)
+        self.assertEqual(output.pressure(), 0.7)
+
+        d = output.checkPressure(8, 10)
+        self.assertIsInstance(d, defer.Deferred)
+        self.assertEqual(output.pressure(), 1.0)
+
+        # Stays saturated until below the low water mark
+        self.assertIs(output.checkPressure(6, 10), d)
+        self.assertFalse(d.called)
+        self.assertEqual(output.checkPressure(5, 10), None)
+        self.assertTrue(d.called)
+
+    @defer.inlineCallbacks
+    def test_backpressure_pauses_sources(self):
+        service = self.make_service({})
+
+        source1 = self.make_source(service)
+        source1.config['route'] = 'out1'
+        source2 = self.make_source(service)
+        source2.config['route'] = 'out2'
+        source3 = self.make_source(service)
+        source3.config['route'] = 'out1'
+        source3.config['backpressure'] = 'none'
+
+        drained = defer.Deferred()
+        output1 = FakeOutput({}, service)
+        output1.eventsReceived = lambda events: drained
+        output2 = FakeOutput({}, service)
+
+        service.outputs = {'out1': [output1], 'out2': [output2]}
+
+        service.sendEvent(source1, Event('ok', 'test', 'test', 1, 1,
+            hostname='localhost'))
+        yield wait(0.1)
+
+        self.assertTrue(source1.paused)
+        self.assertFalse(source2.paused)
+        self.assertFalse(source3.paused)
+        self.assertEqual(service.routePressure(),
+                         {'out1': 1.0, 'out2': 0.0})
+
+        yield source1.tick()
+        self.assertEqual(source1.skipped, 1)
+
+        drained.callback(None)
+        self.assertFalse(source1.paused)
+        self.assertEqual(service.saturated, set())
+
+    def test_worker_assignment(self):
+        sources = [
+            {'service': 'load', 'source': 'tensor.sources.linux.basic.LoadAverage'},
+            {'service': 'cpu', 'source': 'tensor.sources.linux.basic.CPU',
+             'worker': 3},
+            {'service': 'memory', 'source': 'tensor.sources.linux.basic.Memory',
+             'worker': False},
+        ]
+
+        self.assertEqual(workers.assignWorker(sources[0], 2),
+            workers.assignWorker(dict(sources[0]), 2))
+        self.assertEqual(workers.assignWorker(sources[1], 2), 1)
+        self.assertEqual(workers.assignWorker(sources[2], 2), None)
+
+        service = self.make_service({'workers': 2, 'sources': sources})
+
+        self.assertEqual([s.config['service'] for s in service.sources],
+                         ['memory'])
+        self.assertEqual(sum(len(w) for w in service.workerSources), 2)
+        self.assertIn(sources[1], service.workerSources[1])
+
+    def test_worker_event_encoding(self):
+        events = [
+            Event('ok', 'test', 'desc', 1.5, 60.0, tags=['a'],
+                  hostname='host', evtime=1234.0, attributes={'k': 'v'}),
+            Event('critical', 'test2', 'desc', None, 10.0, hostname='host',
+                  type='log'),
+        ]
+
+        message = json.loads(workers.encodeEvents('out1', events).decode())
+        self.assertEqual(message['route'], 'out1')
+
+        batch = workers.decodeEvents(message)
+        self.assertIsInstance(batch, EventBatch)
+
+        for a, b in zip(events, batch):
+            self.assertEqual(a.id(), b.id())
+            for k in ('state', 'metric', 'ttl', 'tags', 'time',
+                      'attributes', '_type'):
+                self.assertEqual(getattr(a, k), getattr(b, k))
+
+    @defer.inlineCallbacks
+    def test_worker_process(self):
+        service = self.make_service({
+            'workers': 1,
+            'sources': [{
+                'service': 'load',
+                'source': 'tensor.sources.linux.basic.LoadAverage',
+                'interval': 1.0,
+            }]
+        })
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output]}
+
+        worker = workers.WorkerProcess(service, 0,
+            service.workerSources[0])
+        service.workerProcesses.append(worker)
+        self.addCleanup(worker.stop)
+        worker.start()
+
+        for i in range(50):
+            yield wait(0.1)
+            if output.events:
+                break
+
+        self.assertTrue(output.events)
+        self.assertEqual(output.events[0].service, 'load')
+        self.assertTrue(service.eventCounter > 0)
+
+    @defer.inlineCallbacks
+    def test_reload_worker_options(self):
+        config = lambda ttl: {
+            'workers': 1,
+            'ttl': ttl,
+            'sources': [{
+                'service': 'load',
+                'source': 'tensor.sources.linux.basic.LoadAverage',
+                'interval': 1.0,
+            }],
+            'outputs': [{'output': 'tensor.tests.test_service.FakeOutput'}],
+        }
+
+        service = self.make_service(config(60.0))
+        # Sets up the outputs, which are only created when started
+        yield service.reloadConfig(config(60.0))
+
+        class FakeWorker(object):
+            index = 0
+            stopped = False
+
+            def stop(self):
+                self.stopped = True
+
+            def sendPressure(self, routes):
+                pass
+
+        worker = FakeWorker()
+        service.workerProcesses.append(worker)
+
+        yield service.reloadConfig(config(60.0))
+        self.assertFalse(worker.stopped)
+
+        # Global options only reach workers when they start
+        yield service.reloadConfig(config(30.0))
+        self.assertTrue(worker.stopped)
+
+    @defer.inlineCallbacks
+    def test_tick_timeout(self):
+        service = self.make_service({})
+        source = SlowSource({
+            'service': 'slow',
+            'interval': 1.0,
+            'ttl': 60.0,
+            'hostname': 'localhost',
+            'tick_timeout': 0.05,
+        }, service.sendEvent, service)
+
+        yield source.tick()
+
+        self.assertEqual(source.timeouts, 1)
+        self.assertFalse(source.running)
+        self.assertTrue(source.lastDuration < 0.2)
+
+    @defer.inlineCallbacks
+    def test_tick_timeout_thread(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        class HungSource(Source):
+            executor = 'thread'
+
+            def get(self):
+                release.wait(5)
+
+        service = self.make_service({})
+        source = HungSource({
+            'service': 'hung',
+            'interval': 1.0,
+            'ttl': 60.0,
+            'hostname': 'localhost',
+            'tick_timeout': 0.05,
+        }, service.sendEvent, service)
+
+        yield source.tick()
+        self.assertEqual(source.timeouts, 1)
+
+        # The thread is still running, so the next tick doesn't start another
+        self.assertTrue(source.running)
+        yield source.tick()
+        self.assertEqual(service.threadPool.pending, 1)
+
+        # Stopping doesn't wait for it
+        t = time.time()
+        service.threadPool.stop()
+        self.assertTrue(time.time() - t < 1)
+
+        thread = source.thread
+        release.set()
+        yield thread
+        self.assertFalse(source.running)
+        self.assertEqual(service.threadPool.pending, 0)
+
+    @defer.inlineCallbacks
+    def test_adaptive_interval(self):
+        service = self.make_service({})
+        source = SlowSource({
+            'service': 'slow',
+            'interval': 0.1,
+            'ttl': 60.0,
+            'hostname': 'localhost',
+            'adaptive': True,
+            'max_interval': 0.3,
+        }, service.sendEvent, service)
+
+        yield source.tick()
+        self.assertEqual(source.overruns, 1)
+        self.assertEqual(source.currentInterval, 0.2)
+        self.assertEqual(source.t.interval, 0.2)
+
+        yield source.tick()
+        self.assertEqual(source.currentInterval, 0.3)
+
+        # Recovers once ticks are quick again
+        source.delay = 0
+        for i in range(6):
+            yield source.tick()
+
+        self.assertEqual(source.currentInterval, 0.1)
+
+    @defer.inlineCallbacks
+    def test_tensor_source(self):
+        service = self.make_service({})
+
+        output = FakeOutput({}, service)
+        service.outputs = {None: [output], 'out2': [FakeOutput({}, service)]}
+
+        source = self.make_source(service)
+        source.errors = 2
+
+        tensorSource = Tensor({
+            'service': 'tensor',
+            'interval': 1.0,
+            'ttl': 60.0,
+            'hostname': 'localhost',
+            'lag_interval': 0.05,
+        }, service.sendEvent, service)
+
+        # Only the lag timer, so no ticks flush the output
+        tensorSource._scheduleLag()
+        self.addCleanup(tensorSource.stopTimer)
+
+        event = Event('ok', 'test', 'test', 1, 1, hostname='localhost')
+        event.time -= 5
+        output.buffer.extend([event])
+
+        yield wait(0.2)
+
+        metrics = dict((e.service, e.metric) for e in tensorSource.get())
+
+        self.assertEqual(metrics['tensor.output.default.queue'], 1)
+        self.assertTrue(metrics['tensor.output.default.age'] >= 5)
+        self.assertEqual(metrics['tensor.output.out2.queue'], 0)
+        self.assertEqual(metrics['tensor.output.out2.pressure'], 0)
+        self.assertEqual(metrics['tensor.output.out2.buffer dropped'], 0)
+        self.assertEqual(metrics['tensor.source.test.errors'], 2)
+        self.assertTrue(metrics['tensor.reactor lag'] >= 0)
+        self.assertTrue(metrics['tensor.rss'] > 0)
+        self.assertIn('tensor.event rate', metrics)
+        self.assertIn('tensor.events out', metrics)
+        self.assertIn('tensor.source.test.duration', metrics)
+        self.assertNotIn('tensor.source.test.latency', metrics)
+        self.assertIn('tensor.gc.0', metrics)
+
+    @defer.inlineCallbacks
+    def test_stop_source_timers(self):
+        service = TensorService({
+            'sources': [{'service': 'tensor', 'source': 'tensor.sources.Tensor',
+                         'interval': 1.0, 'hostname': 'localhost'}],
+            'outputs': [{'output': 'tensor.tests.test_service.FakeOutput'}],
+        })
+
+        yield service.startService()
+        [source] = service.sources
+        self.assertTrue(source.lagCall.active())
+
+        yield service.stopService()
+        self.assertIs(source.lagCall, None)
+        self.assertFalse(source.t.running)
+
+    def test_watchdog(self):
+        service = self.make_service({
+            'sources': [{
+                'service': 'stale',
+                'source': 'tensor.tests.test_service.FakeSource',
+                'interval': 1.0,
+                'hostname': 'localhost',
+                'watchdog': True,
+            }],
+            'watchdog_backoff': 5,
+        })
+
+        clock = task.Clock()
+        service.watchdog = Watchdog(service, clock)
+
+        source = service.sources[0]
+        service.watchdog.add(source)
+
+        clock.advance(5)
+        service.lastEvents[source] = clock.seconds()
+
+        # Pushed back to 10 seconds after the last events
+        clock.advance(5)
+        self.assertEqual(service.watchdog.state(source), 'ok')
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        # First restart is immediate
+        clock.advance(5)
+        restarted = service.sources[0]
+        self.assertIsNot(restarted, source)
+        self.assertEqual(service.watchdog.state(restarted), 'restarting')
+        self.assertEqual(service.watchdog.state(source), None)
+
+        # Still nothing, so the next restart backs off
+        clock.advance(10)
+        self.assertIs(service.sources[0], restarted)
+        self.assertEqual(service.watchdog.state(restarted), 'stale')
+
+        clock.advance(5)
+        source = service.sources[0]
+        self.assertIsNot(source, restarted)
+
+        health = service.watchdog.health[source]
+        self.assertEqual(health.restarts, 2)
+        self.assertEqual(health.failures, 2)
+        self.assertEqual(service.watchdog.backoff(health.failures), 10)
+
+        clock.advance(5)
+        service.lastEvents[source] = clock.seconds()
+        clock.advance(5)
+        self.assertEqual(health.state, 'ok')
+        self.assertEqual(health.failures, 0)
+
+    @defer.inlineCallbacks
+    def test_reload_config(self):
+        def config(load2, outputB):
+            return {
+                'sources': [
+                    {'service': 'load1', 'interval': 60.0,
+                     'hostname': 'localhost',
+                     'source': 'tensor.sources.linux.basic.LoadAverage'},
+                    {'service': 'load2', 'interval': load2,
+                     'hostname': 'localhost',
+                     'source': 'tensor.sources.linux.basic.LoadAverage'},
+                ],
+                'outputs': [
+                    {'output': 'tensor.tests.test_service.FakeOutput',
+                     'name': 'a'},
+                    {'output': 'tensor.tests.test_service.FakeOutput',
+                     'name': 'b', 'maxsize': outputB},
+                ]
+            }
+
+        service = self.make_service(config(60.0, 10))
+        yield service.startService()
+
+        load1, load2 = service.sources
+        [outputA] = service.outputs['a']
+        [outputB] = service.outputs['b']
+
+        service.evCache.set('localhost.counter', (1, 1), 0, 0)
+        outputB.buffer.extend([Event('ok', 'test', 'test', 1, 1,
+                                     hostname='localhost')])
+        service.scheduleFlush()
+
+        newConfig = config(30.0, 20)
+        newConfig['sources'].append(
+            {'service': 'load3', 'interval': 60.0, 'hostname': 'localhost',
+             'source': 'tensor.sources.linux.basic.LoadAverage'})
+
+        yield service.reloadConfig(newConfig)
+
+        self.assertEqual([s.service for s in service.sources],
+                         ['load1', 'load2', 'load3'])
+        self.assertIs(service.sources[0], load1)
+        self.assertIsNot(service.sources[1], load2)
+        self.assertEqual(service.sources[1].inter, 30.0)
+        self.assertFalse(load2.t.running)
+        self.assertTrue(service.sources[2].t.running)
+
+        self.assertEqual(service.outputs['a'], [outputA])
+        self.assertIsNot(service.outputs['b'][0], outputB)
+        # Buffered events were delivered before the output was replaced
+        self.assertEqual(len(outputB.events), 1)
+
+        self.assertEqual(service.evCache.get('localhost.counter', 0), (1, 1))
+
+    @defer.inlineCallbacks
+    def test_reload_bad_source(self):
+        load = lambda name: {'service': name, 'interval': 60.0,
+            'hostname': 'localhost',
+            'source': 'tensor.sources.linux.basic.LoadAverage'}
+        outputs = [{'output': 'tensor.tests.test_service.FakeOutput'}]
+
+        service = self.make_service({
+            'sources': [load('a'), load('b')], 'outputs': outputs})
+        yield service.startService()
+
+        a, b = service.sources
+
+        yield service.reloadConfig({
+            'sources': [load('a'), load('c'), {
+                'service': 'bad', 'interval': 60.0,
+                'source': 'tensor.sources.nonexistent.Source'}],
+            'outputs': outputs,
+        })
+
+        self.assertEqual(len(self.flushLoggedErrors(ImportError)), 1)
+
+        # The bad source is skipped without holding up the rest
+        self.assertEqual([s.service for s in service.sources], ['a', 'c'])
+        self.assertIs(service.sources[0], a)
+        self.assertFalse(b.t.running)
+        self.assertTrue(service.sources[1].t.running)
+
+    def test_signal_errors_logged(self):
+        service = self.make_service({})
+
+        def fail():
+            raise RuntimeError("reload failed")
+
+        d = service._handleSignal(fail)
+
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        return d
+
+    @defer.inlineCallbacks
+    def test_reload_keeps_state(self):
+        config = lambda: {
+            'workers': 0,
+            'aggregation_maxsize': 10,
+            'limits': [{'rate': 1}],
+            'transforms': [{'match': 'load.**', 'drop': True}],
+            'sources': [],
+            'outputs': [
+                {'output': 'tensor.tests.test_service.FakeOutput'}],
+        }
+
+        service = TensorService(config(), overrides={'workers': 2})
+        self.addCleanup(self.stop_service, service)
+        self.assertEqual(service.workers, 2)
+
+        limiter = service.limiter
+        transforms = service.transforms
+
+        for i in range(5):
+            service.evCache.set('localhost.counter%s' % i, (i, i), 0, 0)
+
+        newConfig = config()
+        newConfig['aggregation_maxsize'] = 2
+        yield service.reloadConfig(newConfig)
+
+        # Command line options outlive the configuration file
+        self.assertEqual(service.workers, 2)
+        self.assertIs(service.limiter, limiter)
+        self.assertIs(service.transforms, transforms)
+
+        # The least recently updated series are evicted straight away
+        self.assertEqual(len(service.evCache), 2)
+        self.assertEqual(service.evCache.evictions, 3)
+        self.assertEqual(
+            service.evCache.get('localhost.counter4', 0), (4, 4))
+
+        newConfig = config()
+        newConfig['limits'] = [{'rate': 2}]
+        yield service.reloadConfig(newConfig)
+
+        self.assertIsNot(service.limiter, limiter)
+        self.assertIs(service.transforms, transforms)
+
+    def test_include_path(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        with open(os.path.join(path, 'extra.yml'), 'wt') as f:
+            f.write("ttl: 30.0\n"
+                    "attributes: {b: 2}\n"
+                    "sources:\n"
+                    "    - service: load\n"
+                    "      source: tensor.sources.linux.basic.LoadAverage\n"
+                    "      hostname: localhost\n")
+
+        service = self.make_service({
+            'include_path': path,
+            'attributes': {'a': 1},
+            'sources': [],
+        })
+
+        self.assertEqual(service.ttl, 30.0)
+        self.assertEqual(service.config['attributes'], {'a': 1, 'b': 2})
+        self.assertEqual([s.service for s in service.sources], ['load'])
@@ -1,14 +1,23 @@
 import json
+import os
+import shutil
 import socket
+import tempfile
 
 from twisted.trial import unittest
-from twisted.internet import defer, endpoints, reactor
+from twisted.internet import defer, endpoints, reactor, task
 from twisted.web import server, static
 
 from tensor.sources.linux import basic, process
 from tensor.sources import riak, nginx, network
+from tensor import utils
 
 class TestLinuxSources(unittest.TestCase):
+    def tempdir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return path
+
     def skip_if_no_hostname(self):
         try:
             socket.gethostbyaddr(socket.gethostname())
@@ -312,6 +321,49 @@ Reading: 0 Writing: 1 Waiting: 2\n"""
             if i.service=='nginx.request./foo.bytes':
                 self.assertEquals(i.metric, 410)
 
+    @defer.inlineCallbacks
+    def test_nginx_log_thread(self):
+        events = []
+        threads = []
+
+        def qb(src, ev):
+            threads.append(utils.inPoolThread())
+            events.append(ev)
+
+        class FakeTensor(object):
+            threadPool = utils.ThreadExecutor(1)
+
+        self.addCleanup(FakeTensor.threadPool.stop)
+
+        path = self.tempdir()
+        logfile = os.path.join(path, 'thread.log')
+
+        f = open(logfile, 'wt')
+        f.write('192.168.0.1 - - [16/Jan/2015:16:31:29 +0200] "GET /foo HTTP/1.1" 200 210 "-" "My Browser"\n')
+        f.close()
+
+        src = nginx.NginxLog({
+            'interval': 1.0,
+            'service': 'nginx',
+            'ttl': 60,
+            'hostname': 'localhost',
+            'file': logfile
+        }, qb, FakeTensor())
+
+        self.assertEquals(src.executor, 'thread')
+
+        src.log.tmp = logfile + '.lf'
+        src.log.lastSize = 0
+
+        yield src.tick()
+        yield task.deferLater(reactor, 0.1, lambda: None)
+
+        self.assertEquals(len(events), 1)
+        self.assertEquals(events[0].description['request'], 'GET /foo HTTP/1.1')
+        # Events are handed back on the reactor thread
+        self.assertEquals(threads, [False])
+        self.assertEquals(FakeTensor.threadPool.calls, 1)
+
 class TestRiakSources(unittest.TestCase):
     def _qb(self, result):
         pass
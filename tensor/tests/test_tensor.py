@@ -5,7 +5,7 @@ from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
 
 from tensor.protocol import riemann
 
-from tensor.objects import Event
+from tensor.objects import Event, EventBatch
 
 from tensor.utils import fork
 
@@ -37,6 +37,91 @@ class Tests(unittest.TestCase):
         self.assertEqual(attrs[0].key, "chicken")
         self.assertEqual(attrs[0].value, "little")
 
+    def test_riemann_encoder(self):
+        proto = riemann.RiemannProtocol()
+
+        def reference(events):
+            return riemann.proto_pb2.Msg(events=[proto.encodeEvent(e)
+                for e in events if e._type == 'riemann']).SerializeToString()
+
+        events = [
+            Event('ok', 'sky', 'Sky has not fallen', 1.0, 60.0),
+            Event('critical', 'sky', 'Sky has fallen', -2.5, 60.0),
+            Event('ok', 'sky', None, 3, 60, tags=['a', 'b'],
+                  hostname='chicken.little', evtime=1234567890.7),
+            Event('ok', 'sky', None, -3, 60, tags=['a', 'b'],
+                  hostname='chicken.little', evtime=1234567891),
+            Event(None, u'sk\xfd', u'h\xe9', None, None, evtime=-5),
+            Event('warning', 'sky.acorns', '', 2 ** 62, 0.1,
+                  attributes={'chicken': 'little', 'fox': u'l\xf6xy'}),
+            Event('ok', 'sky.acorns', '', 1e300, 0.1,
+                  attributes={'chicken': 'big'}),
+            Event('ok', 'sky.acorns', '', float('nan'), 1e39),
+            Event('ok', 'sky', 'Not for Riemann', 1.0, 60.0, type='log'),
+        ]
+
+        self.assertEqual(proto.encodeMessage([]), reference([]))
+
+        for event in events:
+            self.assertEqual(proto.encodeMessage([event]), reference([event]))
+
+        # Again, from the cached templates
+        self.assertEqual(proto.encodeMessage(events), reference(events))
+        self.assertEqual(proto.encodeMessage(events), reference(events))
+
+        self.assertRaises(ValueError, proto.encodeMessage,
+            [Event('ok', 'sky', None, 2 ** 63, 60.0)])
+
+    def test_event_slots(self):
+        service = ''.join(['sky', '.', 'fallen'])
+        event1 = Event('ok', service, 'Sky has not fallen', 1.0, 60.0,
+                       hostname='localhost')
+        event2 = Event('ok', 'sky.fallen', 'Sky has not fallen', 2.0, 60.0,
+                       hostname=''.join(['local', 'host']))
+
+        self.assertFalse(hasattr(event1, '__dict__'))
+        self.assertRaises(AttributeError, setattr, event1, 'foo', 'bar')
+
+        # Service and host names are interned
+        self.assertIs(event1.service, event2.service)
+        self.assertIs(event1.hostname, event2.hostname)
+
+        event3 = event1.copyWithMetric(3.0)
+        self.assertEqual(event3.metric, 3.0)
+        self.assertEqual(event3.id(), 'localhost.sky.fallen')
+        self.assertEqual(dict(event3)['service'], 'sky.fallen')
+
+    def test_event_batch(self):
+        events = [
+            Event('ok', 'sky.%s' % i, 'Sky has not fallen', float(i), 60.0,
+                  hostname='localhost', evtime=i + 1)
+            for i in range(4)
+        ]
+
+        batch = EventBatch(events)
+
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(list(batch), events)
+        self.assertEqual(batch, events)
+        self.assertEqual(list(batch.time), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(batch.metric, [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(batch.sid[1], 'localhost.sky.1')
+
+        batch.setMetric(1, 10.0)
+        batch.setState(2, 'critical')
+        self.assertEqual(events[1].metric, 10.0)
+        self.assertEqual(batch.metric[1], 10.0)
+        self.assertEqual(events[2].state, 'critical')
+        self.assertEqual(batch.state[2], 'critical')
+
+        sub = batch.select([1, 2])
+        self.assertEqual(sub, events[1:3])
+        self.assertEqual(sub.metric, [10.0, 2.0])
+        self.assertEqual(list(sub.time), [2.0, 3.0])
+
+        batch.append(events[0])
+        self.assertEqual(len(batch.metric), 5)
+
     @defer.inlineCallbacks
     def test_tcp_riemann(self):
 
@@ -1,8 +1,11 @@
+import os
+
 from twisted.trial import unittest
 
 from twisted.internet import defer, reactor, error
 
 from tensor import utils
+from tensor.objects import Event
 
 class Tests(unittest.TestCase):
     def test_persistent_cache(self):
@@ -28,3 +31,162 @@ class Tests(unittest.TestCase):
 
         self.assertFalse(pc.contains('bar'))
 
+    def test_state_store_eviction(self):
+        store = utils.StateStore(maxsize=2)
+
+        store.set('a', 1)
+        store.set('b', 2)
+        store.set('a', 3)
+        store.set('c', 4)
+
+        # 'b' was least recently updated
+        self.assertEquals(len(store), 2)
+        self.assertEquals(store.get('b'), None)
+        self.assertEquals(store.get('a'), 3)
+        self.assertEquals(store['c'], 4)
+        self.assertEquals(store.evictions, 1)
+
+    def test_state_store_resize(self):
+        store = utils.StateStore(maxsize=4)
+
+        for i in range(4):
+            store.set(i, i)
+
+        store.resize(2)
+
+        self.assertEquals(len(store), 2)
+        self.assertEquals(store.get(1), None)
+        self.assertEquals(store.get(3), 3)
+        self.assertEquals(store.evictions, 2)
+
+    def test_state_store_expiry(self):
+        store = utils.StateStore(ttl=10)
+
+        store.set('a', 1, now=100)
+        store.set('b', 2, now=105, ttl=0)
+        store.set('c', 3, now=108)
+
+        self.assertEquals(store.get('a', now=109), 1)
+        self.assertEquals(store.get('a', now=111), None)
+        self.assertEquals(store.expirations, 1)
+
+        store.expire(now=200)
+        # 'b' never expires, but doesn't hold up 'c' behind it
+        self.assertEquals(len(store), 1)
+        self.assertTrue('b' in store)
+        self.assertEquals(store.expirations, 2)
+
+    def test_state_store_mixed_ttls(self):
+        store = utils.StateStore()
+
+        store.set('long', 1, now=10, ttl=7200)
+        for i in range(1000):
+            store.set(i, i, now=10, ttl=120)
+        # Updated since, so its first deadline is stale
+        store.set(0, 0, now=2900, ttl=120)
+
+        store.expire(now=3000)
+
+        self.assertEquals(len(store), 2)
+        self.assertEquals(store.get('long', now=3000), 1)
+        self.assertEquals(store.get(0, now=3000), 0)
+        self.assertEquals(store.expirations, 999)
+
+    def test_ring_buffer(self):
+        buf = utils.RingBuffer(5)
+
+        self.assertEquals(buf.extend([1, 2, 3]), 0)
+        self.assertEquals(buf.drain(2), [1, 2])
+
+        # Wraps around the end of the list
+        self.assertEquals(buf.extend([4, 5, 6, 7, 8, 9]), 2)
+        self.assertEquals(len(buf), 5)
+        self.assertEquals(buf.dropped, 2)
+        self.assertEquals(buf.drain(), [3, 4, 5, 6, 7])
+        self.assertEquals(buf.drain(), [])
+        self.assertEquals(buf.items, [None] * 5)
+
+    def test_ring_buffer_overwrite(self):
+        buf = utils.RingBuffer(4, overflow='overwrite')
+
+        buf.extend([1, 2, 3])
+        self.assertEquals(buf.extend([4, 5]), 1)
+        self.assertEquals(buf.drain(), [2, 3, 4, 5])
+
+        self.assertEquals(buf.extend(range(10)), 6)
+        self.assertEquals(buf.drain(), [6, 7, 8, 9])
+        self.assertEquals(buf.dropped, 7)
+
+    def test_event_queue(self):
+        queue = utils.EventQueue(maxsize=6, expiring=True)
+
+        events = [
+            Event('ok', 'sky.%s' % i, 'Sky has not fallen', float(i),
+                  [10, 5, 20, 5, None, 10, 10][i], evtime=100)
+            for i in range(7)
+        ]
+
+        self.assertEquals(queue.extend(events), 1)
+        self.assertEquals(queue.dropped, 1)
+        self.assertEquals(queue.drain(1), events[:1])
+
+        # sky.1 and sky.3 expire, sky.4 has no TTL
+        self.assertEquals(queue.expire(now=106), 2)
+        self.assertEquals(len(queue), 3)
+        self.assertIs(queue.peek(), events[2])
+        self.assertEquals(queue.drain(2), [events[2], events[4]])
+
+        self.assertEquals(queue.expire(now=200), 1)
+        self.assertEquals(queue.expired, 3)
+        self.assertEquals(queue.drain(), [])
+        self.assertEquals(len(queue), 0)
+        self.assertEquals(queue.peek(), None)
+
+    @defer.inlineCallbacks
+    def test_thread_executor(self):
+        executor = utils.ThreadExecutor(2)
+        self.addCleanup(executor.stop)
+
+        result = yield executor.run(utils.inPoolThread)
+        self.assertTrue(result)
+        self.assertFalse(utils.inPoolThread())
+
+        def fail():
+            raise ValueError()
+
+        yield self.assertFailure(executor.run(fail), ValueError)
+
+        self.assertEqual(executor.calls, 2)
+        self.assertEqual(executor.pending, 0)
+        self.assertTrue(executor.runTime >= 0)
+
+    @defer.inlineCallbacks
+    def test_fqdn(self):
+        lookups = []
+
+        def lookup():
+            lookups.append(1)
+            return 'host.example.com'
+
+        self.patch(utils, '_lookupFQDN', lookup)
+        self.patch(utils, '_fqdn', None)
+
+        name = yield utils.resolveFQDN()
+        self.assertEqual(name, 'host.example.com')
+
+        self.assertEqual(utils.getFQDN(), 'host.example.com')
+        self.assertEqual(utils.getFQDN(), 'host.example.com')
+        self.assertEqual(len(lookups), 1)
+
+    def test_lazy_imports(self):
+        # Optional protocols shouldn't be loaded unless a source needs them
+        import subprocess
+        import sys
+
+        out = subprocess.check_output([sys.executable, '-c',
+            'import sys, tensor.service, tensor.sources.linux.basic;'
+            'print(",".join(m for m in sys.modules if m.startswith('
+            '("twisted.conch", "twisted.names", "pysnmp", "construct"))))'],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+
+        self.assertEqual(out.strip(), b'')
@@ -0,0 +1,222 @@
+"""Event transforms
+
+The `transforms` option is a list of rules which drop, keep, rename or
+label events by their service name before they are aggregated and routed::
+
+    transforms:
+        - match: nginx.client.**
+          drop: true
+        - match: "*.user-agent.**"
+          drop: true
+        - match: cpu.**
+          rename: system.cpu
+        - match: "**"
+          tags: [agent]
+          attributes:
+            dc: jhb
+
+Patterns are matched against the dot separated segments of the service
+name. `*` matches exactly one segment, `**` any number of segments
+(including none), and other segments may contain shell style wildcards
+such as `eth?` or `sd[ab]`.
+
+`rename` replaces the leading segments of the service which the pattern
+gives literally (`cpu` above) with a new prefix. If any rule has `keep`,
+events which no `keep` rule matches are dropped. Every rule is matched
+against the original service name, and applied in the order given.
+
+Rules are compiled into a trie of pattern segments, and the actions for
+each service name are worked out once and cached, so the cost per event
+does not grow with the number of rules.
+"""
+
+import fnmatch
+import re
+
+
+class Node(object):
+    """A node in the pattern trie"""
+    __slots__ = ('children', 'globs', 'any', 'rules')
+
+    def __init__(self):
+        # Literal segment to child
+        self.children = {}
+        # (compiled segment wildcard, child)
+        self.globs = []
+        # Child for `**`
+        self.any = None
+        # Indexes of rules whose pattern ends here
+        self.rules = []
+
+
+class Rule(object):
+    """A single transform rule
+
+    :param config: Rule configuration
+    :type config: dict.
+    """
+    def __init__(self, config):
+        self.pattern = config['match']
+        self.segments = self.pattern.split('.')
+
+        self.drop = bool(config.get('drop', False))
+        self.keep = bool(config.get('keep', False))
+        self.rename = config.get('rename')
+        self.tags = list(config.get('tags', []))
+        self.attributes = config.get('attributes')
+
+        # Literal leading segments, replaced on rename
+        literal = 0
+        for segment in self.segments:
+            if (segment == '**') or re.search(r'[*?\[]', segment):
+                break
+            literal += 1
+        self.literal = literal
+
+
+class Action(object):
+    """The combined effect of the rules matching one service name"""
+    __slots__ = ('drop', 'service', 'tags', 'attributes')
+
+    def __init__(self, service, rules, keeping):
+        self.drop = False
+        self.service = service
+        self.tags = []
+        self.attributes = {}
+
+        kept = False
+
+        for rule in rules:
+            if rule.drop:
+                self.drop = True
+            if rule.keep:
+                kept = True
+            if rule.rename is not None:
+                rest = service.split('.')[rule.literal:]
+                self.service = '.'.join([rule.rename] + rest)
+            self.tags.extend(rule.tags)
+            if rule.attributes:
+                self.attributes.update(rule.attributes)
+
+        if keeping and not kept:
+            self.drop = True
+
+    def changes(self, service):
+        return (self.service != service) or self.tags or self.attributes
+
+
+class Transforms(object):
+    """Compiled transform rules
+
+    :param configs: List of rule configurations
+    :type configs: list.
+    """
+
+    # Limit on cached service names, for sources with unbounded cardinality
+    cacheSize = 100000
+
+    def __init__(self, configs):
+        self.rules = [Rule(c) for c in configs]
+        self.keeping = any(rule.keep for rule in self.rules)
+
+        self.root = Node()
+        for i, rule in enumerate(self.rules):
+            self._insert(i, rule.segments)
+
+        self.cache = {}
+        self.dropped = 0
+
+    def _insert(self, index, segments):
+        node = self.root
+
+        for segment in segments:
+            if segment == '**':
+                if node.any is None:
+                    node.any = Node()
+                node = node.any
+            elif re.search(r'[*?\[]', segment):
+                regex = re.compile(fnmatch.translate(segment))
+                for pattern, child in node.globs:
+                    if pattern.pattern == regex.pattern:
+                        node = child
+                        break
+                else:
+                    child = Node()
+                    node.globs.append((regex, child))
+                    node = child
+            else:
+                node = node.children.setdefault(segment, Node())
+
+        node.rules.append(index)
+
+    def _walk(self, node, segments, i, found):
+        if node.any is not None:
+            # `**` consumes any number of the remaining segments
+            for j in range(i, len(segments) + 1):
+                self._walk(node.any, segments, j, found)
+
+        if i == len(segments):
+            found.update(node.rules)
+            return
+
+        segment = segments[i]
+
+        child = node.children.get(segment)
+        if child is not None:
+            self._walk(child, segments, i + 1, found)
+
+        for pattern, child in node.globs:
+            if pattern.match(segment):
+                self._walk(child, segments, i + 1, found)
+
+    def match(self, service):
+        """Returns the :class:`Action` for `service`, or None if no rules
+        change it"""
+        if service in self.cache:
+            return self.cache[service]
+
+        found = set()
+        self._walk(self.root, service.split('.'), 0, found)
+
+        action = Action(service, [self.rules[i] for i in sorted(found)],
+            self.keeping)
+
+        if not (action.drop or action.changes(service)):
+            action = None
+
+        if len(self.cache) >= self.cacheSize:
+            self.cache.clear()
+        self.cache[service] = action
+
+        return action
+
+    def apply(self, events):
+        """Returns a list of the events from `events` which are kept, with
+        any changes made"""
+        result = []
+
+        for ev in events:
+            action = self.match(ev.service)
+
+            if action is None:
+                result.append(ev)
+                continue
+
+            if action.drop:
+                self.dropped += 1
+                continue
+
+            ev.service = action.service
+
+            if action.tags:
+                # Sources share one tag list between their events
+                ev.tags = ev.tags + action.tags
+
+            if action.attributes:
+                attributes = dict(ev.attributes or {})
+                attributes.update(action.attributes)
+                ev.attributes = attributes
+
+            result.append(ev)
+
+        return result
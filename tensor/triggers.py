@@ -0,0 +1,121 @@
+"""State triggers
+
+Warning and critical rules from a source configuration are compiled here
+once, when the source is set up, rather than being evaluated from their
+source text for every event.
+"""
+
+import ast
+import operator
+import re
+
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+_comparison = re.compile(r'^\s*(>=|<=|==|!=|>|<)\s*(.+?)\s*$')
+
+
+def compileExpression(expr):
+    """Compiles a trigger expression such as "> 500" into a predicate
+    function of the event metric.
+
+    Simple comparisons against a literal become a single operator call,
+    anything else is compiled once and evaluated with the metric bound
+    to `service` as it always has been.
+    """
+    match = _comparison.match(expr)
+    if match:
+        op, value = match.groups()
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        else:
+            fn = OPERATORS[op]
+            return lambda metric: fn(metric, value)
+
+    code = compile("service %s" % expr, '<trigger>', 'eval')
+
+    return lambda metric: eval(code, {'service': metric})
+
+
+class Triggers(object):
+    """Compiled warning and critical rules for a source
+
+    The rules which apply to each service name are worked out the first
+    time that service is seen and cached, so regular expressions are not
+    matched again for every event.
+
+    :param warning: Dictionary of service regular expression to trigger
+                    expression
+    :type warning: dict.
+    :param critical: Dictionary of service regular expression to trigger
+                     expression
+    :type critical: dict.
+    """
+
+    # Limit on cached service names, for sources with unbounded cardinality
+    cacheSize = 100000
+
+    def __init__(self, warning=None, critical=None):
+        self.warning = self._compile(warning)
+        self.critical = self._compile(critical)
+        self.cache = {}
+
+    def _compile(self, rules):
+        return [
+            (re.compile(k), compileExpression(v))
+            for k, v in (rules or {}).items()
+        ]
+
+    def match(self, service):
+        """Returns a tuple of the (warning, critical) predicates for
+        `service`"""
+        rules = self.cache.get(service)
+
+        if rules is None:
+            if len(self.cache) >= self.cacheSize:
+                self.cache.clear()
+
+            rules = (
+                tuple(p for r, p in self.warning if r.match(service)),
+                tuple(p for r, p in self.critical if r.match(service))
+            )
+            self.cache[service] = rules
+
+        return rules
+
+    def apply(self, batch):
+        """Raises the state of any 'ok' events in `batch` (a
+        `tensor.objects.EventBatch`) which meet a warning or critical
+        rule"""
+        states = batch.state
+        metrics = batch.metric
+
+        for i, ev in enumerate(batch.events):
+            if states[i] != 'ok':
+                continue
+
+            warning, critical = self.match(ev.service)
+
+            if not (warning or critical):
+                continue
+
+            metric = metrics[i]
+
+            for p in critical:
+                if p(metric):
+                    batch.setState(i, 'critical')
+                    break
+            else:
+                for p in warning:
+                    if p(metric):
+                        batch.setState(i, 'warning')
+                        break
@@ -3,6 +3,12 @@ import json
 import time
 import urllib
 import os
+import socket
+import threading
+import heapq
+import itertools
+
+from collections import OrderedDict, deque
 
 try:
     from StringIO import StringIO
@@ -16,12 +22,12 @@ except ImportError:
 
 from zope.interface import implementer
 
-from twisted.internet import reactor, protocol, defer, error
+from twisted.internet import reactor, protocol, defer, error, threads
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from twisted.web.client import Agent
-from twisted.names import client
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 
 from twisted.internet.endpoints import clientFromString
 
@@ -44,6 +50,8 @@ class Resolver(object):
     """
 
     def __init__(self):
+        from twisted.names import client
+
         self.recs = {}
         
         self.resolver = client.getResolver()
@@ -73,6 +81,38 @@ class Resolver(object):
             name=self.reverseNameFromIPAddress(address=ip)
         ).addCallback(_ret, ip).addErrback(_ret, ip)
 
+_fqdn = None
+
+def _lookupFQDN():
+    hostname = socket.gethostname()
+    try:
+        return socket.gethostbyaddr(hostname)[0]
+    except (socket.herror, socket.gaierror):
+        return hostname
+
+def getFQDN():
+    """Returns the fully qualified name of this host, which is only looked
+    up the first time it is needed"""
+    global _fqdn
+    if _fqdn is None:
+        _fqdn = _lookupFQDN()
+    return _fqdn
+
+def resolveFQDN():
+    """Looks up the fully qualified name of this host in a thread, so the
+    reactor isn't blocked by DNS, and caches it for :func:`getFQDN`.
+    Returns a Deferred which fires with the name"""
+    if _fqdn is not None:
+        return defer.succeed(_fqdn)
+
+    def _cache(hostname):
+        global _fqdn
+        if _fqdn is None:
+            _fqdn = hostname
+        return _fqdn
+
+    return threads.deferToThread(_lookupFQDN).addCallback(_cache)
+
 class BodyReceiver(protocol.Protocol):
     """ Simple buffering consumer for body objects """
     def __init__(self, finished):
@@ -366,3 +406,470 @@ class PersistentCache(object):
         """Remove key `k` from the cache"""
         self._remove_key(k)
 
+class StateStore(object):
+    """A bounded in-memory store of per-series state, such as the last
+    counter value used to compute derivatives.
+
+    Entries are kept in the order they were last updated. When `maxsize`
+    entries are held the least recently updated entry is evicted, and an
+    entry which has not been updated within its TTL is treated as missing
+    and removed by :meth:`expire`. Entries can have different TTLs, so
+    their deadlines are also kept in a heap for :meth:`expire`.
+
+    :param maxsize: Maximum number of entries (0 is no limit)
+    :type maxsize: int.
+    :param ttl: Default entry TTL in seconds (0 never expires)
+    :type ttl: float.
+    """
+
+    def __init__(self, maxsize=0, ttl=0):
+        self.store = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # Heap of (deadline, sequence, key). Entries for keys which have
+        # since been updated or removed are skipped by expire().
+        self.deadlines = []
+        self.sequence = itertools.count()
+
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, now=None):
+        """Returns the value for `key`, or None if it is missing or
+        expired"""
+        entry = self.store.get(key)
+
+        if entry is None:
+            return None
+
+        value, deadline = entry
+
+        if deadline and (deadline < (now or time.time())):
+            del self.store[key]
+            self.expirations += 1
+            return None
+
+        return value
+
+    def set(self, key, value, now=None, ttl=None):
+        """Sets `key` to `value`, expiring it after `ttl` seconds without
+        an update"""
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl:
+            deadline = (now or time.time()) + ttl
+        else:
+            deadline = 0
+
+        # Re-insert to move this key to the most recently updated end
+        self.store.pop(key, None)
+        self.store[key] = (value, deadline)
+
+        if deadline:
+            heapq.heappush(self.deadlines,
+                (deadline, next(self.sequence), key))
+
+            if len(self.deadlines) > 2 * len(self.store) + 1024:
+                self._reindex()
+
+        if self.maxsize and (len(self.store) > self.maxsize):
+            self.store.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        """Changes `maxsize`, evicting the least recently updated entries
+        right away if the store holds more than that
+
+        :param maxsize: Maximum number of entries (0 is no limit)
+        :type maxsize: int.
+        """
+        self.maxsize = maxsize
+
+        if maxsize:
+            while len(self.store) > maxsize:
+                self.store.popitem(last=False)
+                self.evictions += 1
+
+    def items(self):
+        """Returns a list of (key, value) for every entry, least recently
+        updated first"""
+        return [(key, entry[0]) for key, entry in self.store.items()]
+
+    def delete(self, key):
+        """Remove `key` from the store"""
+        self.store.pop(key, None)
+
+    def _reindex(self):
+        # Rebuild the heap from the live entries, dropping the deadlines
+        # of keys updated since, which would otherwise pile up
+        sequence = self.sequence
+        self.deadlines = [
+            (deadline, next(sequence), key)
+            for key, (value, deadline) in self.store.items() if deadline
+        ]
+        heapq.heapify(self.deadlines)
+
+    def expire(self, now=None):
+        """Removes all entries whose deadline has passed"""
+        now = now or time.time()
+        store = self.store
+        deadlines = self.deadlines
+
+        while deadlines and (deadlines[0][0] < now):
+            deadline, seq, key = heapq.heappop(deadlines)
+
+            entry = store.get(key)
+            if (entry is not None) and (entry[1] == deadline):
+                del store[key]
+                self.expirations += 1
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __len__(self):
+        return len(self.store)
+
+class RingBuffer(object):
+    """A bounded FIFO buffer backed by a preallocated list
+
+    :param capacity: Maximum number of items held
+    :type capacity: int.
+    :param overflow: What to do when the buffer is full, either `drop` new
+                     items or `overwrite` the oldest ones (default: drop)
+    :type overflow: str.
+    """
+
+    def __init__(self, capacity, overflow='drop'):
+        if capacity < 1:
+            raise ValueError("Buffer capacity must be at least 1")
+
+        if overflow not in ('drop', 'overwrite'):
+            raise ValueError("Unknown overflow policy %r" % overflow)
+
+        self.capacity = capacity
+        self.overflow = overflow
+        self.items = [None] * capacity
+        self.head = 0
+        self.size = 0
+
+        self.dropped = 0
+
+    def _write(self, items):
+        # Copy items into the free space after the tail, in at most two
+        # slices if it wraps around the end of the list
+        n = len(items)
+        tail = (self.head + self.size) % self.capacity
+        first = min(n, self.capacity - tail)
+
+        self.items[tail:tail + first] = items[:first]
+        if n > first:
+            self.items[:n - first] = items[first:]
+
+        self.size += n
+
+    def extend(self, items):
+        """Adds a list of items to the buffer, applying the overflow policy
+        to any which don't fit. Returns the number of items dropped."""
+        if not isinstance(items, list):
+            items = list(items)
+
+        free = self.capacity - self.size
+        dropped = 0
+
+        if len(items) > free:
+            if self.overflow == 'drop':
+                dropped = len(items) - free
+                items = items[:free]
+            else:
+                if len(items) > self.capacity:
+                    dropped = len(items) - self.capacity
+                    items = items[dropped:]
+
+                # Discard the oldest items to make room
+                discard = len(items) - free
+                self._consume(discard)
+                dropped += discard
+
+        if items:
+            self._write(items)
+
+        self.dropped += dropped
+        return dropped
+
+    def _consume(self, n):
+        head = self.head
+        first = min(n, self.capacity - head)
+
+        items = self.items[head:head + first]
+        self.items[head:head + first] = [None] * first
+
+        if n > first:
+            items.extend(self.items[:n - first])
+            self.items[:n - first] = [None] * (n - first)
+
+        self.head = (head + n) % self.capacity
+        self.size -= n
+
+        return items
+
+    def drain(self, limit=None):
+        """Removes and returns up to `limit` items (or all of them) as a
+        list, oldest first"""
+        if limit is None:
+            n = self.size
+        else:
+            n = min(limit, self.size)
+
+        if n == 0:
+            return []
+
+        items = self._consume(n)
+
+        if self.size == 0:
+            self.head = 0
+
+        return items
+
+    def peek(self):
+        """Returns the oldest item without removing it, or None"""
+        if self.size:
+            return self.items[self.head]
+        return None
+
+    def __len__(self):
+        return self.size
+
+
+class EventQueue(object):
+    """An unbounded or size limited FIFO queue of events, which can expire
+    events once their TTL has passed
+
+    Events are held in a deque, so removing the oldest `k` costs O(k)
+    however long the queue is. With `expiring` set, each event's deadline
+    (its time plus TTL) is also kept in a heap with its position in the
+    queue, so that expiring an event costs O(log n) rather than a scan of
+    the queue. Expired events are skipped when they reach the front.
+
+    :param maxsize: Maximum number of events (0 is no limit)
+    :type maxsize: int.
+    :param expiring: Index events by deadline for :meth:`expire`
+    :type expiring: bool.
+    """
+
+    def __init__(self, maxsize=0, expiring=False):
+        self.maxsize = maxsize
+        self.expiring = expiring
+
+        self.queue = deque()
+        # Position of the front of the queue since it was created
+        self.first = 0
+
+        # Heap of (deadline, position), and positions of expired events
+        # which are still in the queue
+        self.deadlines = []
+        self.dead = set()
+
+        self.dropped = 0
+        self.expired = 0
+
+    def extend(self, events):
+        """Adds events to the back of the queue, dropping any which don't
+        fit. Returns the number of events dropped."""
+        if not isinstance(events, list):
+            events = list(events)
+
+        dropped = 0
+
+        if self.maxsize > 0:
+            free = max(self.maxsize - len(self), 0)
+            if len(events) > free:
+                dropped = len(events) - free
+                events = events[:free]
+                self.dropped += dropped
+
+        if self.expiring:
+            position = self.first + len(self.queue)
+            for i, ev in enumerate(events):
+                if ev.ttl:
+                    heapq.heappush(self.deadlines,
+                        (ev.time + ev.ttl, position + i))
+
+        self.queue.extend(events)
+
+        return dropped
+
+    def drain(self, limit=None):
+        """Removes and returns up to `limit` events (or all of them) as a
+        list, oldest first"""
+        queue = self.queue
+
+        if not self.dead:
+            n = len(queue) if limit is None else min(limit, len(queue))
+
+            if n == len(queue):
+                events = list(queue)
+                queue.clear()
+            else:
+                popleft = queue.popleft
+                events = [popleft() for i in range(n)]
+
+            self.first += n
+        else:
+            events = []
+            dead = self.dead
+
+            while queue and ((limit is None) or (len(events) < limit)):
+                ev = queue.popleft()
+                position = self.first
+                self.first += 1
+
+                if position in dead:
+                    dead.discard(position)
+                else:
+                    events.append(ev)
+
+            self._trim()
+
+        if self.expiring and (len(self.deadlines) > 2 * len(queue) + 1024):
+            self._reindex()
+
+        return events
+
+    def _reindex(self):
+        # Rebuild the heap without the deadlines of events already
+        # removed, which would otherwise pile up while nothing expires
+        self.deadlines = [
+            (ev.time + ev.ttl, self.first + i)
+            for i, ev in enumerate(self.queue)
+            if ev.ttl and (self.first + i) not in self.dead
+        ]
+        heapq.heapify(self.deadlines)
+
+    def expire(self, now=None):
+        """Expires events whose TTL has passed. Returns the number
+        expired."""
+        now = now or time.time()
+        deadlines = self.deadlines
+        expired = 0
+
+        while deadlines and (deadlines[0][0] < now):
+            deadline, position = heapq.heappop(deadlines)
+
+            if (position >= self.first) and (position not in self.dead):
+                self.dead.add(position)
+                expired += 1
+
+        self._trim()
+
+        self.expired += expired
+        return expired
+
+    def _trim(self):
+        # Keep a live event at the front of the queue
+        queue, dead = self.queue, self.dead
+        while queue and (self.first in dead):
+            queue.popleft()
+            dead.discard(self.first)
+            self.first += 1
+
+    def peek(self):
+        """Returns the oldest event without removing it, or None"""
+        if self.queue:
+            return self.queue[0]
+        return None
+
+    def __len__(self):
+        return len(self.queue) - len(self.dead)
+
+
+_threadState = threading.local()
+
+def inPoolThread():
+    """Returns True when called from a :class:`ThreadExecutor` thread"""
+    return getattr(_threadState, 'pool', False)
+
+class _ThreadPool(ThreadPool):
+    """A ThreadPool which doesn't wait for running calls when stopped, and
+    whose threads don't hold up exit, so a hung call can't block shutdown"""
+
+    def threadFactory(self, *a, **kw):
+        thread = threading.Thread(*a, **kw)
+        thread.daemon = True
+        return thread
+
+    def stop(self):
+        self.joined = True
+        self.started = False
+        # Idle threads exit now and busy ones once their call returns
+        self._team.quit()
+
+
+class ThreadExecutor(object):
+    """A bounded thread pool for running blocking calls off the reactor
+    thread, which keeps account of how long calls wait and run
+
+    :param size: Maximum number of threads
+    :type size: int.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.pool = None
+
+        self.calls = 0
+        self.pending = 0
+        self.waitTime = 0.0
+        self.runTime = 0.0
+
+    def start(self):
+        if self.pool is None:
+            self.pool = _ThreadPool(minthreads=0, maxthreads=self.size,
+                name='tensor')
+            self.pool.start()
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def run(self, fn, *a, **kw):
+        """Calls `fn` in the pool, returning a Deferred which fires with its
+        result"""
+        self.start()
+
+        times = [time.time(), None, None]
+
+        def call():
+            _threadState.pool = True
+            times[1] = time.time()
+            try:
+                return fn(*a, **kw)
+            finally:
+                times[2] = time.time()
+                _threadState.pool = False
+
+        def done(result):
+            self.pending -= 1
+            self.calls += 1
+            if times[2] is not None:
+                self.waitTime += times[1] - times[0]
+                self.runTime += times[2] - times[1]
+            return result
+
+        self.pending += 1
+
+        return threads.deferToThreadPool(reactor, self.pool, call
+            ).addBoth(done)
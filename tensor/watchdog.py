@@ -0,0 +1,158 @@
+"""Source watchdog
+
+Sources which stop producing events for 10 times their interval are marked
+stale, and restarted if they have `watchdog: true` set. Rather than walking
+every source periodically, the :class:`Watchdog` keeps them in a heap
+ordered by when they would next become stale. The heap is only updated
+when an entry comes due, at which point it is pushed back to its real
+deadline if the source has sent events since, so a healthy source costs one
+heap operation per deadline however many events it sends.
+
+Restarts of a source which stays stale back off exponentially, from
+`watchdog_backoff` seconds up to `watchdog_max_backoff`.
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from tensor.scheduler import TimerHeap
+
+
+class SourceHealth(object):
+    """Watchdog state for a source, kept across restarts
+
+    :ivar state: `ok`, `stale`, `restarting` or `failed`
+    :ivar restarts: Number of times the source has been restarted
+    :ivar failures: Restarts since the source last sent events
+    """
+    def __init__(self, since):
+        self.state = 'ok'
+        self.since = since
+        self.restarts = 0
+        self.failures = 0
+        self.restartAt = None
+
+
+class Watchdog(object):
+    """Tracks when each source last sent events and restarts stale ones
+
+    :param tensor: The TensorService, whose `lastEvents` are checked
+    :param clock: Provider of `IReactorTime` (default the reactor)
+    """
+
+    # Intervals without events before a source is stale
+    staleIntervals = 10
+
+    def __init__(self, tensor, clock=None):
+        self.tensor = tensor
+        self.clock = clock or reactor
+
+        self.health = {}
+        self.timers = TimerHeap(self._due, self.clock)
+
+    def __len__(self):
+        return len(self.health)
+
+    def timeout(self, source):
+        return source.currentInterval * self.staleIntervals
+
+    def backoff(self, failures):
+        """Returns the delay before restarting a source which has already
+        been restarted `failures` times without recovering"""
+        if not failures:
+            return 0
+
+        return min(self.tensor.watchdogBackoff * 2 ** (failures - 1),
+                   self.tensor.watchdogMaxBackoff)
+
+    def add(self, source, delay=0, health=None):
+        """Starts watching `source`, which is stale if it sends no events
+        within `delay` seconds plus its timeout"""
+        now = self.clock.seconds()
+
+        if health is None:
+            health = SourceHealth(now + delay)
+        else:
+            health.since = now + delay
+
+        self.health[source] = health
+        self._push(source, health.since + self.timeout(source))
+
+    def remove(self, source):
+        self.health.pop(source, None)
+        self.timers.discard(source)
+
+    def state(self, source):
+        """Returns the health state of `source`, or None if not watched"""
+        health = self.health.get(source)
+        return health.state if health else None
+
+    def stop(self):
+        self.health = {}
+        self.timers.clear()
+
+    def _push(self, source, when):
+        self.timers.push(source, when)
+
+    def _due(self, source, now):
+        health = self.health.get(source)
+        if health is not None:
+            self.check(source, health, now)
+
+    def check(self, source, health, now):
+        """Checks `source` when its deadline comes due"""
+        last = self.tensor.lastEvents.get(source)
+        timeout = self.timeout(source)
+
+        if (last is not None) and (last >= health.since):
+            deadline = last + timeout
+        else:
+            deadline = health.since + timeout
+
+        if source.paused:
+            # Not stale, just held back by a saturated output
+            self._push(source, now + timeout)
+            return
+
+        if deadline > now:
+            if (last is not None) and (last >= health.since):
+                health.state = 'ok'
+                health.failures = 0
+                health.restartAt = None
+            self._push(source, deadline)
+            return
+
+        if not source.config.get('watchdog', False):
+            health.state = 'stale'
+            self._push(source, now + timeout)
+            return
+
+        if health.restartAt is None:
+            health.state = 'stale'
+            health.restartAt = now + self.backoff(health.failures)
+
+            log.msg("Source %r is stale (%ss since events), restarting "
+                    "in %ss" % (source, int(now - (last or health.since)),
+                    int(health.restartAt - now)))
+
+        if health.restartAt > now:
+            self._push(source, health.restartAt)
+        else:
+            self.restart(source, health)
+
+    def restart(self, source, health):
+        health.restartAt = None
+        health.restarts += 1
+        health.failures += 1
+
+        try:
+            source = self.tensor.restartSource(source)
+        except Exception as e:
+            log.msg("Could not restart source %r: %s" % (source, e))
+            health.state = 'failed'
+        else:
+            health.state = 'restarting'
+
+        # The source is checked again after a timeout, restarting it after
+        # a longer backoff if it still hasn't sent anything
+        self.add(source, health=health)
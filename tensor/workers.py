@@ -0,0 +1,261 @@
+"""Source worker processes
+
+When the `workers` option is set, sources are divided between that many
+child processes instead of all running on the main reactor. Each worker
+runs its own :class:`tensor.service.TensorService` with the sources
+assigned to it, and streams the resulting events back to the main process
+over a pipe, where they are routed to the outputs as usual.
+
+Sources are assigned to a worker by a hash of their service name, or
+explicitly with the `worker` option. `worker: false` keeps a source in the
+main process.
+"""
+
+import json
+import os
+import struct
+import sys
+import zlib
+
+from twisted.internet import defer, protocol, reactor, stdio
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+from tensor.objects import Event, EventBatch, Output
+
+
+# File descriptor in the worker which events are written to, keeping them
+# separate from anything a source prints to stdout
+EVENT_FD = 3
+
+
+def workerOptions(config):
+    """Returns the global options from `config` which are passed on to
+    every worker process"""
+    config = dict(config)
+
+    for k in ('workers', 'include_path', 'outputs', 'sources'):
+        config.pop(k, None)
+
+    return config
+
+
+def assignWorker(source, workers):
+    """Returns the index of the worker process that `source` (a source
+    configuration dictionary) should run in, or None for the main
+    process"""
+    worker = source.get('worker')
+
+    if worker is False:
+        return None
+
+    if worker is not None:
+        return int(worker) % workers
+
+    return zlib.crc32(source['service'].encode('utf-8')) % workers
+
+
+def encodeEvents(route, events):
+    """Encodes a batch of events for `route` into a message"""
+    return json.dumps({
+        'route': route,
+        'events': [
+            [e.state, e.service, e.description, e.metric, e.ttl, e.tags,
+             e.hostname, e.time, e.attributes, e._type]
+            for e in events
+        ]
+    }).encode('utf-8')
+
+
+def decodeEvents(message):
+    """Decodes the events in a message into an EventBatch"""
+    return EventBatch([
+        Event(state, service, description, metric, ttl, tags=tags,
+              hostname=hostname, evtime=evtime, attributes=attributes,
+              type=type)
+        for (state, service, description, metric, ttl, tags, hostname,
+             evtime, attributes, type) in message['events']
+    ])
+
+
+def encodeMessage(**kw):
+    return json.dumps(kw, default=str).encode('utf-8')
+
+
+class MessageReceiver(Int32StringReceiver):
+    """Length prefixed JSON messages between the main process and its
+    workers"""
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def stringReceived(self, string):
+        self.handler(json.loads(string.decode('utf-8')))
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """Runs and supervises one worker process from the main process
+
+    :param tensor: The main TensorService
+    :param index: Worker number
+    :param sources: List of source configurations for this worker
+    """
+
+    restartDelay = 5
+
+    def __init__(self, tensor, index, sources):
+        self.tensor = tensor
+        self.index = index
+        self.sources = sources
+
+        self.receiver = MessageReceiver(self.messageReceived)
+        self.running = False
+        self.restarts = 0
+        self.restartCall = None
+
+    def config(self):
+        """Builds the configuration for the worker service"""
+        config = workerOptions(self.tensor.config)
+
+        config['sources'] = self.sources
+        config['outputs'] = [
+            {'output': 'tensor.workers.WorkerOutput', 'name': name}
+            for name in self.tensor.outputs
+        ]
+
+        return config
+
+    def start(self):
+        """Spawns the worker process"""
+        self.running = True
+        self.restartCall = None
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+
+        reactor.spawnProcess(self, sys.executable,
+            [sys.executable, '-m', 'tensor.workers'], env=env,
+            childFDs={0: 'w', 1: 'r', 2: 'r', EVENT_FD: 'r'})
+
+    def stop(self):
+        """Stops the worker, without restarting it"""
+        self.running = False
+
+        if self.restartCall and self.restartCall.active():
+            self.restartCall.cancel()
+
+        if self.transport and (self.transport.pid is not None):
+            self.transport.closeStdin()
+
+    def send(self, **kw):
+        if self.transport and (self.transport.pid is not None):
+            data = encodeMessage(**kw)
+            self.transport.writeToChild(0,
+                struct.pack(MessageReceiver.structFormat, len(data)) + data)
+
+    def connectionMade(self):
+        log.msg("Started worker %s (pid %s) with %s sources" % (
+            self.index, self.transport.pid, len(self.sources)))
+
+        self.send(config=self.config())
+        self.sendPressure(self.tensor.saturatedRoutes())
+
+    def sendPressure(self, routes):
+        """Tells the worker which routes are saturated"""
+        self.send(pressure=list(routes))
+
+    def childDataReceived(self, fd, data):
+        if fd == EVENT_FD:
+            self.receiver.dataReceived(data)
+        else:
+            for line in data.decode('utf-8', 'replace').splitlines():
+                log.msg("[worker %s] %s" % (self.index, line))
+
+    def messageReceived(self, message):
+        if 'events' in message:
+            self.tensor.workerEvents(message['route'], decodeEvents(message))
+
+    def processEnded(self, reason):
+        log.msg("Worker %s exited: %s" % (self.index, reason.value))
+        self.receiver = MessageReceiver(self.messageReceived)
+
+        if self.running:
+            self.restarts += 1
+            self.restartCall = reactor.callLater(
+                self.restartDelay, self.start)
+
+
+class WorkerOutput(Output):
+    """Output used inside a worker process which sends events for one
+    route to the main process"""
+
+    def __init__(self, *a):
+        Output.__init__(self, *a)
+        self.name = self.config.get('name')
+
+    def eventsReceived(self, events):
+        self.tensor.workerProtocol.sendEvents(self.name, events)
+
+        if self.name in self.tensor.workerProtocol.saturated:
+            if self.drained is None:
+                self.drained = defer.Deferred()
+            return self.drained
+
+    def resume(self):
+        if self.drained is not None:
+            d, self.drained = self.drained, None
+            d.callback(None)
+
+
+class WorkerProtocol(Int32StringReceiver):
+    """Worker side of the pipe to the main process"""
+    MAX_LENGTH = MessageReceiver.MAX_LENGTH
+
+    def __init__(self):
+        self.service = None
+        self.saturated = set()
+
+    def stringReceived(self, string):
+        message = json.loads(string.decode('utf-8'))
+
+        if 'config' in message:
+            self.startService(message['config'])
+
+        if 'pressure' in message:
+            self.saturated = set(message['pressure'])
+
+            if self.service:
+                for outputs in self.service.outputs.values():
+                    for output in outputs:
+                        if output.name not in self.saturated:
+                            output.resume()
+
+    def startService(self, config):
+        from tensor.service import TensorService
+
+        self.service = TensorService(config)
+        self.service.workerProtocol = self
+
+        reactor.addSystemEventTrigger('before', 'shutdown',
+            self.service.stopService)
+
+        self.service.startService()
+
+    def sendEvents(self, route, events):
+        self.sendString(encodeEvents(route, events))
+
+    def connectionLost(self, reason):
+        # The main process has gone away
+        if reactor.running:
+            reactor.stop()
+
+
+def main():
+    log.startLogging(sys.stderr)
+    stdio.StandardIO(WorkerProtocol(), stdin=0, stdout=EVENT_FD)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ import tensor
 class Options(usage.Options):
     optParameters = [
         ["config", "c", "tensor.yml", "Config file"],
+        ["workers", "w", None, "Number of source worker processes"],
     ]
  
 
@@ -22,7 +23,13 @@ class TensorServiceMaker(object):
     options = Options
  
     def makeService(self, options):
-        config = yaml.load(open(options['config']))
-        return tensor.makeService(config)
+        config = yaml.safe_load(open(options['config']))
+
+        # Re-applied whenever the configuration is reloaded
+        overrides = {}
+        if options['workers'] is not None:
+            overrides['workers'] = int(options['workers'])
+
+        return tensor.makeService(config, options['config'], overrides)
  
 serviceMaker = TensorServiceMaker()